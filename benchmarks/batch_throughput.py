@@ -0,0 +1,63 @@
+"""
+Compare sending many small files as one batch with sending one file of the same size.
+
+    python -m benchmarks.batch_throughput [file_count] [file_kb]
+
+batch:  wlan_sender.send_files on a directory of file_count files
+single: wlan_sender.send_files on one file holding the same bytes
+Both run over loopback into a temporary directory; the difference is the
+per-file cost of the batch (manifest, framing, creating files on the receiver).
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from wlan import wlan_receiver, wlan_sender
+
+
+def _run(paths, dest):
+    os.makedirs(dest)
+    receiver = threading.Thread(target=wlan_receiver.receive_file_blocking, kwargs={
+        'host': '127.0.0.1', 'log_callback': lambda msg: None,
+        'dir_callback': lambda name, file_count, total_size: dest})
+    receiver.start()
+    time.sleep(0.3)
+    start = time.perf_counter()
+    ok = wlan_sender.send_files('127.0.0.1', paths, log_callback=lambda msg: None, compress=False)
+    elapsed = time.perf_counter() - start
+    receiver.join()
+    if not ok:
+        raise RuntimeError("Transfer failed")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 4096
+    work = tempfile.mkdtemp()
+    try:
+        tree = os.path.join(work, "tree")
+        single = os.path.join(work, "single.bin")
+        with open(single, "wb") as whole:
+            for i in range(count):
+                directory = os.path.join(tree, f"d{i // 1000}")
+                os.makedirs(directory, exist_ok=True)
+                data = os.urandom(size)
+                with open(os.path.join(directory, f"f{i}"), "wb") as f:
+                    f.write(data)
+                whole.write(data)
+
+        total = count * size
+        print(f"{count} files of {size // 1024} KiB over loopback")
+        for name, paths in (("batch", [tree]), ("single", [single])):
+            elapsed = _run(paths, os.path.join(work, f"out-{name}"))
+            print(f"{name:>7}: {total / elapsed / 1e6:8.1f} MB/s, {elapsed:.2f} s")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Size and parse cost of discovery beacons, binary vs the JSON of older versions.
+
+    python -m benchmarks.beacon_parse [devices] [rounds]
+
+json:     the old indented JSON beacon, parsed with json.loads and lower-cased keys
+binary:   the binary beacon, every one decoded from scratch
+repeated: the binary beacon as a listener sees it, the same bytes again until
+          the device changes, so decoding is a cache lookup
+"""
+import json
+import sys
+import time
+
+from wlan import discovery
+
+
+def _info(i):
+    return {
+        'name': f"DESKTOP-{i:05d}", 'model': "Windows", 'ip': f"192.168.{i // 250}.{i % 250 + 1}",
+        'mac': f"02:00:00:00:{i // 256:02x}:{i % 256:02x}", 'interval': discovery.BEACON_MAX,
+        'port': 54321, 'version': 1, 'codecs': 7, 'features': 31, 'max_streams': 8, 'free_space': 200 << 30,
+    }
+
+
+def _old_parse(data):
+    info = json.loads(data.decode())
+    return {k.lower(): v for k, v in info.items()}
+
+
+def _measure(parse, payloads, rounds, before_round=None):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if before_round:
+            before_round()
+        for payload in payloads:
+            parse(payload)
+    return len(payloads) * rounds / (time.perf_counter() - start)
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    infos = [_info(i) for i in range(devices)]
+    old = [json.dumps({key: info[key] for key in ('name', 'model', 'ip', 'mac')}, indent=4).encode()
+           for info in infos]
+    new = [discovery.encode_beacon(info) for info in infos]
+
+    print(f"{devices} devices, {rounds} rounds")
+    print(f"json      {sum(map(len, old)) / devices:5.0f} bytes  "
+          f"{_measure(_old_parse, old, rounds) / 1000:7.0f} k beacons/s  (name, model, ip, mac only)")
+    print(f"binary    {sum(map(len, new)) / devices:5.0f} bytes  "
+          f"{_measure(discovery.decode_beacon, new, rounds, discovery._decoded.clear) / 1000:7.0f} k beacons/s")
+    print(f"repeated  {sum(map(len, new)) / devices:5.0f} bytes  "
+          f"{_measure(discovery.decode_beacon, new, rounds) / 1000:7.0f} k beacons/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Bluetooth sends over an emulated RFCOMM link (blue/transport.py), no radio needed.
+
+    python -m benchmarks.bluetooth_emulated [size_kb] [kbytes_per_s] [latency_ms]
+
+legacy: the old sender, 1024 byte send() calls after the metadata, and the old
+        receiver's recv(1024) loop
+engine: rfcomm.send_stream/receive_stream, with writes coalesced to whole frames
+        and a reader thread on each side
+The data is random, so compression plays no part.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from blue import rfcomm, transport
+
+
+def _legacy(path, dest, size, bandwidth, latency):
+    sender, receiver = transport.emulated_pair(bandwidth, latency)
+
+    def receive():
+        metadata = receiver.recv(1024).decode()
+        file_size = int(metadata.split("::")[1])
+        with open(os.path.join(dest, "legacy"), "wb") as f:
+            received = 0
+            while received < file_size:
+                data = receiver.recv(1024)
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    start = time.perf_counter()
+    sender.send(f"legacy::{size}".encode())
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024)
+            if not chunk:
+                break
+            sender.send(chunk)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return elapsed, sender.frames_sent
+
+
+def _engine(path, dest, size, bandwidth, latency):
+    sender, receiver = transport.emulated_pair(bandwidth, latency)
+
+    def receive():
+        reader = rfcomm.StreamReader(receiver)
+        try:
+            rfcomm.receive_stream(reader, receiver, lambda name: os.path.join(dest, name), log=lambda msg: None)
+        finally:
+            reader.close()
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        ok = rfcomm.send_stream(sender, f, "engine", size, log=lambda msg: None, compress=False)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    receiver.close()
+    if not ok:
+        raise RuntimeError("The engine send failed")
+    return elapsed, sender.frames_sent
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 1024 * 1024
+    bandwidth = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else transport.EMULATED_BANDWIDTH
+    latency = int(sys.argv[3]) / 1000 if len(sys.argv) > 3 else transport.EMULATED_LATENCY
+    dest = tempfile.mkdtemp(prefix="qs-bt-bench-")
+    try:
+        path = os.path.join(dest, "source.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        print(f"{size // 1024} KiB over {bandwidth // 1024} KiB/s, {latency * 1000:.0f} ms, MTU {transport.RFCOMM_MTU}")
+        for label, run in (("legacy", _legacy), ("engine", _engine)):
+            elapsed, frames = run(path, dest, size, bandwidth, latency)
+            print(f"{label}: {size / elapsed / 1024:6.1f} KiB/s  {frames} frames  "
+                  f"({size / frames:.0f} payload bytes per frame)")
+        for name in ("legacy", "engine"):
+            with open(path, "rb") as a, open(os.path.join(dest, name), "rb") as b:
+                if a.read() != b.read():
+                    raise RuntimeError(f"{name} copy differs from the source")
+    finally:
+        shutil.rmtree(dest, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
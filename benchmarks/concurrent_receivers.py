@@ -0,0 +1,76 @@
+"""
+Aggregate throughput of one receiver serving many senders at the same time.
+
+    python -m benchmarks.concurrent_receivers [file_mb] [senders ...]
+
+For each sender count, that many send_file_async coroutines run at once on the
+engine's event loop against one ReceiverServer on loopback; each sends its own
+file. Reports the aggregate rate, and how many sends had to wait for a free
+worker or failed.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from wlan import engine, wlan_receiver, wlan_sender
+
+PORT = 54321
+
+
+async def _run(sources, dest):
+    busy = []
+    server = wlan_receiver.ReceiverServer(
+        '127.0.0.1', PORT, gui_callback=lambda filename: os.path.join(dest, filename),
+        log_callback=lambda msg: None)
+    if not await server.start() or server.port != PORT:
+        server.close()
+        raise RuntimeError(f"Port {PORT} is in use")
+    serving = asyncio.create_task(server.serve())
+
+    def log_for(i):
+        def log(msg):
+            if "again" in msg:
+                busy.append(i)
+        return log
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        wlan_sender.send_file_async('127.0.0.1', source, log_callback=log_for(i), compress=False)
+        for i, source in enumerate(sources)))
+    elapsed = time.perf_counter() - start
+    while server.completed < results.count(True):
+        await asyncio.sleep(0.01)  # Let the receiver finish storing chunks before it is stopped
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+    return elapsed, results.count(False), len(set(busy))
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 16 * 1024 * 1024
+    counts = [int(n) for n in sys.argv[2:]] or [1, 8, 32]
+    work = tempfile.mkdtemp()
+    try:
+        sources = []
+        for i in range(max(counts)):
+            path = os.path.join(work, f"src{i}.bin")
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            sources.append(path)
+
+        print(f"Files of {size // (1024 * 1024)} MiB over loopback")
+        for count in counts:
+            dest = os.path.join(work, f"out{count}")
+            os.makedirs(dest)
+            elapsed, failed, retried = engine.run(_run(sources[:count], dest))
+            print(f"{count:>3} senders: {count * size / elapsed / 1e6:8.1f} MB/s aggregate, "
+                  f"{elapsed:.2f} s, {retried} retried, {failed} failed")
+            shutil.rmtree(dest, ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
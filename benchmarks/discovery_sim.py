@@ -0,0 +1,108 @@
+"""
+Discovery traffic on a LAN of many devices, simulated (no sockets).
+
+    python -m benchmarks.discovery_sim [hosts] [seconds] [scans_per_minute]
+
+fixed:    every device broadcasts its beacon every BEACON_MIN seconds (the old behaviour)
+adaptive: beacons back off to BEACON_MAX while nothing changes, scanners only listen
+probe:    adaptive beacons, and a scanner also broadcasts one probe that every device answers
+
+Each device changes (new address, renamed) about once an hour. Scanners are
+new devices joining at random; time to full list is how long one takes until
+it has heard from every device. Every broadcast is received, and has to be
+processed, by every device on the LAN, so broadcasts/s is also the discovery
+load per device. Replies to a probe are unicast and only reach the scanner.
+"""
+import heapq
+import random
+import statistics
+import sys
+
+from wlan import discovery
+
+RTT = 0.005  # Seconds, a busy Wi-Fi LAN
+CHANGE_INTERVAL = 3600.0  # Mean seconds between changes of one device
+WARMUP = 120.0  # Seconds before counting, so the start-up burst of short intervals is left out
+
+
+def simulate(mode, hosts, seconds, scans_per_minute, seed=1):
+    """Returns: dict with broadcasts and unicasts per second, and the times to full list of the scans"""
+    if seconds <= WARMUP:
+        raise ValueError(f"Simulate more than the {WARMUP:.0f} s warm-up, not {seconds:g} s")
+    rng = random.Random(seed)
+    random.seed(seed)  # discovery.reply_delay() uses the module generator
+    adaptive = mode != 'fixed'
+    schedules = [discovery.BeaconSchedule() for _ in range(hosts)]
+    limiters = [discovery.ReplyLimiter() for _ in range(hosts)]
+    changed = [True] * hosts
+    next_beacon = [0.0] * hosts
+
+    events = []  # (time, kind, host or scan number)
+    for host in range(hosts):
+        heapq.heappush(events, (rng.uniform(0, discovery.BEACON_MIN), 'beacon', host))
+        heapq.heappush(events, (rng.expovariate(1 / CHANGE_INTERVAL), 'change', host))
+    scan = 0
+    t = WARMUP
+    while scans_per_minute:
+        t += rng.expovariate(scans_per_minute / 60)
+        if t >= seconds:
+            break
+        heapq.heappush(events, (t, 'scan', scan))
+        scan += 1
+
+    broadcasts = unicasts = 0
+    full_list = []
+    while events:
+        now, kind, who = heapq.heappop(events)
+        if now >= seconds:
+            break
+        counting = now >= WARMUP
+        if kind == 'beacon':
+            broadcasts += counting
+            interval = schedules[who].next_interval(changed[who]) if adaptive else discovery.BEACON_MIN
+            changed[who] = False
+            next_beacon[who] = now + interval
+            heapq.heappush(events, (next_beacon[who], 'beacon', who))
+        elif kind == 'change':
+            changed[who] = True
+            heapq.heappush(events, (now + rng.expovariate(1 / CHANGE_INTERVAL), 'change', who))
+        elif kind == 'scan':
+            if mode == 'probe':
+                broadcasts += 1
+                arrivals = []
+                for host in range(hosts):
+                    if limiters[host].allow(f"scanner{who}", now):
+                        unicasts += 1
+                        arrivals.append(min(RTT + discovery.reply_delay(), next_beacon[host] - now + RTT / 2))
+                full_list.append(max(arrivals))
+            else:
+                # Only listening: every device is heard at its next beacon
+                full_list.append(max(next_beacon) - now + RTT / 2)
+
+    counted = seconds - WARMUP
+    return {
+        'broadcasts': broadcasts / counted,
+        'unicasts': unicasts / counted,
+        'full_list': full_list,
+    }
+
+
+def main():
+    hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1800.0
+    scans_per_minute = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+    print(f"{hosts} devices, {seconds:.0f} s, {scans_per_minute:g} scans/min")
+    for mode in ('fixed', 'adaptive', 'probe'):
+        result = simulate(mode, hosts, seconds, scans_per_minute)
+        times = sorted(result['full_list'])
+        if times:
+            median = statistics.median(times)
+            worst = times[-1]
+            latency = f"full list median {median * 1000:7.1f} ms, worst {worst * 1000:7.1f} ms"
+        else:
+            latency = "no scans"
+        print(f"{mode:9s} {result['broadcasts']:7.1f} broadcasts/s  {result['unicasts']:6.1f} unicasts/s  {latency}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+What the hash cache saves the sender on a file it sent before.
+
+    python -m benchmarks.hash_cache [size_mb]
+
+cold: chunk manifest and leaf digests computed by reading the whole file, as on a first send
+warm: the same taken from the cache, as on every later send of the unchanged file
+The cache lives in a temporary directory, not in the user's state directory.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from wlan import hash_cache
+
+
+def _hash(source, size, cache):
+    start = time.perf_counter()
+    for _ in hash_cache.chunk_file(source, cache):
+        pass
+    for _ in hash_cache.leaf_hashes(source, size, cache=cache):
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    work = tempfile.mkdtemp()
+    try:
+        source = os.path.join(work, "source.bin")
+        with open(source, "wb") as f:
+            for _ in range(size // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+        cache = hash_cache.HashCache(os.path.join(work, "hashes.sqlite3"))
+        cold = _hash(source, size, cache)
+        warm = _hash(source, size, cache)
+        cache.close()
+        print(f"{size // (1024 * 1024)} MiB, manifest and leaf digests")
+        print(f"cold: {cold * 1000:9.1f} ms  ({size / cold / 1e6:.1f} MB/s)")
+        print(f"warm: {warm * 1000:9.1f} ms  ({cold / warm:.0f}x faster)")
+        print(f"a 50 GB file: ~{50e9 / size * cold:.0f} s of hashing skipped")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
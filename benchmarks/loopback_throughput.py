@@ -0,0 +1,92 @@
+"""
+Compare the Wi-Fi sender's file paths over loopback TCP.
+
+    python -m benchmarks.loopback_throughput [size_mb]
+
+legacy:   the original 4 KiB f.read() + sendall() loop
+buffered: send_range without sendfile (1 MiB reads written to the stream)
+sendfile: send_range with the kernel sendfile path (where the OS has one)
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from wlan import engine, wlan_sender
+
+
+def _drain(server, total):
+    conn, _ = server.accept()
+    buf = bytearray(1024 * 1024)
+    received = 0
+    with conn:
+        while received < total:
+            n = conn.recv_into(buf)
+            if not n:
+                break
+            received += n
+
+
+async def _legacy_send(writer, f, offset, count, on_bytes=None):
+    f.seek(offset)
+    while chunk := f.read(4096):
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def _send(send, address, path, size):
+    _, writer = await asyncio.open_connection(*address)
+    try:
+        with open(path, "rb") as f:
+            cpu_start = time.thread_time()
+            await send(writer, f, 0, size)
+            await writer.drain()
+            return time.thread_time() - cpu_start
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def _run(send, path, size):
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        drain = threading.Thread(target=_drain, args=(server, size))
+        drain.start()
+
+        start = time.perf_counter()
+        cpu = engine.run(_send(send, server.getsockname(), path, size))
+        drain.join()
+        elapsed = time.perf_counter() - start
+    return size / elapsed / 1e6, cpu
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 512) * 1024 * 1024
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(size // len(block)):
+                f.write(block)
+
+        variants = [
+            ("legacy", _legacy_send),
+            ("buffered", lambda *a: wlan_sender.send_range(*a, use_sendfile=False)),
+        ]
+        if wlan_sender.HAVE_SENDFILE:
+            variants.append(("sendfile", lambda *a: wlan_sender.send_range(*a, use_sendfile=True)))
+
+        print(f"{size // (1024 * 1024)} MiB over loopback")
+        for name, send in variants:
+            rate, cpu = _run(send, path, size)
+            print(f"{name:>9}: {rate:8.1f} MB/s, sender CPU {cpu:.2f} s")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
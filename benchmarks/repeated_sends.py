@@ -0,0 +1,74 @@
+"""
+Many small sends in a row to one receiver, with and without kept-alive connections.
+
+    python -m benchmarks.repeated_sends [sends] [file_kb]
+
+pooled: successive sends reuse the connection parked in the session pool
+fresh:  the pool is emptied after every send, so each one opens a new connection
+Over loopback the handshake is nearly free; on Wi-Fi every new connection also
+costs a round trip and a TCP slow start.
+"""
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from wlan import engine, session, wlan_receiver, wlan_sender
+
+PORT = 54321
+
+
+async def _run(source, dest, sends, pooled):
+    names = itertools.count()
+    server = wlan_receiver.ReceiverServer(
+        '127.0.0.1', PORT, gui_callback=lambda filename: os.path.join(dest, f"{next(names)}_{filename}"),
+        log_callback=lambda msg: None)
+    if not await server.start() or server.port != PORT:
+        server.close()
+        raise RuntimeError(f"Port {PORT} is in use")
+    serving = asyncio.create_task(server.serve())
+
+    pool = session.get_pool()
+    pool.close_all()
+    before = pool.stats()
+    start = time.perf_counter()
+    failed = 0
+    for _ in range(sends):
+        if not await wlan_sender.send_file_async('127.0.0.1', source, log_callback=lambda msg: None, compress=False):
+            failed += 1
+        if not pooled:
+            pool.close_all()
+    elapsed = time.perf_counter() - start
+    after = pool.stats()
+
+    pool.close_all()
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+    return elapsed, failed, after['hits'] - before['hits'], after['misses'] - before['misses']
+
+
+def main():
+    sends = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 16 * 1024
+    work = tempfile.mkdtemp()
+    try:
+        source = os.path.join(work, "small.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(size))
+
+        print(f"{sends} sends of {size // 1024} KiB over loopback")
+        for name, pooled in (("pooled", True), ("fresh", False)):
+            dest = os.path.join(work, name)
+            os.makedirs(dest)
+            elapsed, failed, hits, misses = engine.run(_run(source, dest, sends, pooled))
+            print(f"{name:>7}: {sends / elapsed:8.1f} sends/s, {elapsed * 1000 / sends:.2f} ms each, "
+                  f"pool hits {hits}, misses {misses}, {failed} failed")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Sends to many devices one at a time (what the UI used to do) vs through the send queue.
+
+    python -m benchmarks.send_queue [devices]
+
+Each device gets a mix of small and large files; a simulated send takes size / LINK_RATE
+seconds, since every device has its own link. Reports when the whole queue finished,
+the average time until a file arrived, and the queue's aggregate throughput.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from common import scheduler, telemetry
+
+LINK_RATE = 200 * 1024 * 1024  # Bytes/s of one simulated device's link
+SIZES = (64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024)
+
+
+def _send(job, progress_callback):
+    for step in range(1, 11):
+        time.sleep(job.size / LINK_RATE / 10)
+        progress_callback(job.size * step // 10, job.size)
+    return True
+
+
+def _run(files, devices, max_active):
+    finished = []
+    idle = threading.Event()
+    start = time.perf_counter()
+    queue = scheduler.TransferScheduler(_send, max_active=max_active, max_per_peer=1,
+                                        on_job=lambda job: finished.append(time.perf_counter() - start),
+                                        on_idle=idle.set)
+    for device in range(devices):
+        for path in files:
+            queue.submit([path], None, peer=device)
+    peak = 0.0
+    while not idle.wait(0.1):
+        sample = queue.sample()
+        peak = max(peak, sample['smoothed_rate'] if sample else 0.0)
+    return time.perf_counter() - start, sum(finished) / len(finished), peak
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    work = tempfile.mkdtemp()
+    try:
+        random.seed(1)
+        files = []
+        for index, size in enumerate(random.choice(SIZES) for _ in range(6)):
+            path = os.path.join(work, f"{index}.bin")
+            with open(path, "wb") as f:
+                f.truncate(size)
+            files.append(path)
+        print(f"{len(files)} files to each of {devices} devices, {telemetry.format_rate(LINK_RATE)} per device")
+        for label, max_active in (("one at a time", 1), ("queue", scheduler.MAX_ACTIVE)):
+            total, mean, rate = _run(files, devices, max_active)
+            print(f"{label:>14}: all done in {total:6.2f} s, a file arrives after {mean:6.2f} s on average, "
+                  f"{telemetry.format_rate(rate)}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
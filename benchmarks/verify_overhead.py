@@ -0,0 +1,84 @@
+"""
+Cost of leaf verification (FEATURE_VERIFY) on a Wi-Fi send over loopback.
+
+    python -m benchmarks.verify_overhead [size_mb] [rounds]
+
+hash:     integrity.leaf_hashes over the file, one thread, what the sender adds
+raw:      sends with VERIFY_LEAVES off, the file goes through sendfile untouched
+verified: the same sends with every leaf hashed by the sender and checked by the receiver
+The chunk store, hash cache and compression are off so only the data path is measured.
+Loopback is far faster than Wi-Fi; on a real link the hashing hides behind the network.
+"""
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from wlan import engine, hash_cache, integrity, session, wlan_receiver, wlan_sender
+
+PORT = 54321
+
+
+async def _run(source, dest, rounds, verify):
+    names = itertools.count()
+    server = wlan_receiver.ReceiverServer(
+        '127.0.0.1', PORT, gui_callback=lambda filename: os.path.join(dest, f"{next(names)}_{filename}"),
+        log_callback=lambda msg: None)
+    if not await server.start() or server.port != PORT:
+        server.close()
+        raise RuntimeError(f"Port {PORT} is in use")
+    serving = asyncio.create_task(server.serve())
+    wlan_sender.VERIFY_LEAVES = verify
+    try:
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            if not await wlan_sender.send_file_async('127.0.0.1', source, log_callback=lambda msg: None,
+                                                     compress=False):
+                raise RuntimeError("Send failed")
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            session.get_pool().close_all()
+            for name in os.listdir(dest):
+                os.remove(os.path.join(dest, name))
+        return best
+    finally:
+        wlan_sender.VERIFY_LEAVES = True
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    wlan_receiver.USE_CHUNK_STORE = False
+    hash_cache.ENABLED = False
+    work = tempfile.mkdtemp()
+    try:
+        source = os.path.join(work, "source.bin")
+        with open(source, "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(size // len(block)):
+                f.write(block)
+        dest = os.path.join(work, "dest")
+        os.makedirs(dest)
+
+        print(f"{size // (1024 * 1024)} MiB over loopback, {integrity.LEAF_SIZE // 1024} KiB leaves, "
+              f"best of {rounds}")
+        start = time.perf_counter()
+        for _ in integrity.leaf_hashes(source, size):
+            pass
+        print(f"    hash: {size / (time.perf_counter() - start) / 1e6:8.1f} MB/s")
+        raw = engine.run(_run(source, dest, rounds, False))
+        print(f"     raw: {size / raw / 1e6:8.1f} MB/s")
+        verified = engine.run(_run(source, dest, rounds, True))
+        print(f"verified: {size / verified / 1e6:8.1f} MB/s  ({(verified / raw - 1) * 100:+.0f}% time)")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
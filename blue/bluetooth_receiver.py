@@ -1,5 +1,12 @@
 import bluetooth
+import collections
 import os
+import select
+import socket
+import threading
+import time
+
+from . import device_cache, rfcomm, transport
 
 
 def ensure_bluetooth_on_and_visible():
@@ -51,56 +58,261 @@ def receive_file(save_path, client_sock, file_size, progress_callback=None):
         return False
 
 
-def start_receiver_blocking(gui_callback=None, progress_callback=None, log_callback=None):
+def _receive_legacy(reader, link, gui_callback, progress_callback, log):
     """
-    Start receiver in blocking mode
-    gui_callback: function(filename) -> save_path or None
-    progress_callback: function(bytes_received, total_size)
-    log_callback: function(message)
+    Receive from a sender older than rfcomm.py's format: "name::size[::codecs]"
+    metadata, then the raw file or, when codecs were offered, compressed blocks.
     Returns: True if successful, False otherwise
     """
-    def log(msg):
-        if log_callback:
-            log_callback(msg)
+    metadata = reader.recv(1024).decode()
+    fields = metadata.split("::")
+    filename, file_size = fields[0], int(fields[1])
+    # Senders that compress append the codecs they can use and wait for the accepted ones
+    offered_codecs = int(fields[2]) if len(fields) > 2 else None
+
+    log(f"Incoming file: {filename} ({file_size} bytes)")
+    save_path = prompt_save_path(filename, gui_callback)
+
+    if not save_path:
+        log("File save cancelled")
+        return False
+
+    if offered_codecs is None:
+        return receive_file(save_path, reader, file_size, progress_callback)
+    codecs = offered_codecs & rfcomm.SUPPORTED_CODECS
+    link.send(bytes([codecs]))
+    stats = rfcomm.receive_blocks(save_path, reader, file_size, codecs, progress_callback)
+    log(f"File saved to: {save_path}")
+    log(f"Compressed transfer: {stats.summary()}")
+    return True
+
+
+ACCEPT_BACKLOG = 4  # Connections the stack holds while every worker is busy
+MAX_CLIENTS = 3  # Senders served at once; a piconet has at most 7 active peers and they share its bandwidth
+STOP_POLL = 0.5  # Seconds between checks of the stop flag while waiting for a sender
+STATS_KEPT = 32  # Finished connections stats() still reports
+
+
+class BluetoothReceiverServer:
+    """
+    Long-lived Bluetooth listener that serves many senders, one after another
+    or at the same time.
+
+    The RFCOMM socket is bound and its SDP record advertised once, instead of
+    once per file, so a sender that finds the receiver can connect again right
+    away. Every connection is served on its own thread, at most max_clients at
+    a time; connections past that wait in the accept backlog. Save prompts are
+    shown one at a time. stats() reports bytes and throughput per connection.
+    """
+
+    def __init__(self, gui_callback=None, progress_callback=None, log_callback=None, max_clients=MAX_CLIENTS,
+                 server_sock=None):
+        """
+        server_sock: an already listening socket to accept on, instead of binding and advertising one
+        """
+        self.gui_callback = gui_callback
+        self.progress_callback = progress_callback
+        self.log_callback = log_callback
+        self.server_sock = server_sock
+        self.channel = None
+        self.completed = 0  # Files received successfully
+        self._advertised = False
+        self._closed = threading.Event()
+        self._clients = threading.Semaphore(max_clients)
+        self._prompt_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._active = {}  # link -> stats of the connection it serves
+        self._finished = collections.deque(maxlen=STATS_KEPT)
+        self._workers = set()
+
+    def log(self, msg):
+        if self.log_callback:
+            self.log_callback(msg)
         else:
             print(msg)
-    
-    ensure_bluetooth_on_and_visible()
 
-    server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-    server_sock.bind(("", bluetooth.PORT_ANY))
-    server_sock.listen(1)
+    def start(self):
+        """
+        Bind an RFCOMM channel and advertise it, unless a socket was passed in.
+        Returns: False if Bluetooth is not available
+        """
+        if self.server_sock is None:
+            ensure_bluetooth_on_and_visible()
+            try:
+                self.server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+                self.server_sock.bind(("", bluetooth.PORT_ANY))
+                self.server_sock.listen(ACCEPT_BACKLOG)
+                bluetooth.advertise_service(self.server_sock, device_cache.SERVICE_NAME,
+                                            service_classes=[bluetooth.SERIAL_PORT_CLASS],
+                                            profiles=[bluetooth.SERIAL_PORT_PROFILE])
+            except (OSError, bluetooth.BluetoothError) as e:
+                self.log(f"Cannot start the Bluetooth receiver: {e}")
+                self.close()
+                return False
+            self._advertised = True
+        self.channel = self.server_sock.getsockname()[1]
+        self.log(f"Waiting for connections on RFCOMM channel {self.channel}...")
+        return True
 
-    port = server_sock.getsockname()[1]
-    bluetooth.advertise_service(server_sock, "BtFileReceiver",
-                                service_classes=[bluetooth.SERIAL_PORT_CLASS],
-                                profiles=[bluetooth.SERIAL_PORT_PROFILE])
+    def ask_save_path(self, filename):
+        """Returns: where to save an incoming file, or None if the user cancelled"""
+        with self._prompt_lock:
+            return prompt_save_path(filename, self.gui_callback)
 
-    log(f"Waiting for connection on RFCOMM channel {port}...")
+    def serve(self, stop_flag=None, until_first=False):
+        """
+        Accept senders until stop_flag is set or close() is called, then wait for
+        the transfers still running.
+        until_first: return once the first transfer finished, as start_receiver_blocking did
+        Returns: the number of files received successfully
+        """
+        def stopped():
+            return self._closed.is_set() or (stop_flag is not None and stop_flag.is_set()) or \
+                (until_first and self._finished and not self._workers)
 
-    try:
-        client_sock, client_info = server_sock.accept()
-        log(f"Connected to {client_info}")
+        while not stopped():
+            # Only accept when a worker is free, so waiting senders stay in the stack's backlog
+            if not self._clients.acquire(timeout=STOP_POLL):
+                continue
+            try:
+                # select() instead of a socket timeout: pybluez raises its own exception type for it
+                readable, _, _ = select.select([self.server_sock], [], [], STOP_POLL)
+                if not readable or stopped():
+                    self._clients.release()
+                    continue
+                client_sock, client_info = self.server_sock.accept()
+            except (OSError, ValueError) as e:
+                self._clients.release()
+                if not self._closed.is_set():
+                    self.log(f"Receiver error: {e}")
+                    self._closed.wait(1)  # Do not spin on a broken listener
+                continue
+            worker = threading.Thread(target=self._serve_client, args=(client_sock, client_info),
+                                      name="bluetooth-client", daemon=True)
+            with self._lock:
+                self._workers.add(worker)
+            worker.start()
 
-        metadata = client_sock.recv(1024).decode()
-        filename, file_size = metadata.split("::")
-        file_size = int(file_size)
+        if stop_flag is not None and stop_flag.is_set():
+            self.close()
+        for worker in list(self._workers):
+            worker.join()
+        return self.completed
 
-        log(f"Incoming file: {filename} ({file_size} bytes)")
-        save_path = prompt_save_path(filename, gui_callback)
-        
-        if not save_path:
-            log("File save cancelled")
-            return False
+    def _serve_client(self, client_sock, client_info):
+        """Receive one file from an accepted sender"""
+        link = transport.RfcommTransport(client_sock)
+        record = {'peer': str(client_info[0]), 'file': None, 'started': time.time(), 'seconds': 0.0,
+                  'bytes': 0, 'rate': 0.0, 'success': None}
+        with self._lock:
+            self._active[link] = record
+        self.log(f"Connected to {client_info}")
+        start = time.monotonic()
+        reader = rfcomm.StreamReader(link)
+        success = False
 
-        success = receive_file(save_path, client_sock, file_size, progress_callback)
+        def save_path(filename):
+            record['file'] = filename
+            return self.ask_save_path(filename)
 
-        client_sock.close()
-        server_sock.close()
-        return success
-    except Exception as e:
-        log(f"Receiver error: {e}")
+        try:
+            if rfcomm.is_current(reader):
+                success = rfcomm.receive_stream(reader, link, save_path, self.progress_callback, self.log) is not None
+            else:
+                success = _receive_legacy(reader, link, save_path, self.progress_callback, self.log)
+        except Exception as e:
+            if not self._closed.is_set():
+                self.log(f"Receiver error: {e}")
+        finally:
+            reader.close()
+            link.close()
+            record['seconds'] = time.monotonic() - start
+            record['bytes'] = link.bytes_received
+            record['rate'] = link.bytes_received / record['seconds'] if record['seconds'] > 0 else 0.0
+            record['success'] = success
+            with self._lock:
+                del self._active[link]
+                self._finished.append(record)
+                self._workers.discard(threading.current_thread())
+                if success:
+                    self.completed += 1
+            self._clients.release()
+        if record['bytes']:
+            self.log(f"{record['peer']}: {record['bytes']} bytes in {record['seconds']:.1f} s "
+                     f"({record['rate'] / 1024:.1f} KiB/s)")
+
+    def stats(self):
+        """
+        Returns: list of dicts with peer, file, started (time.time()), seconds, bytes
+        received, rate (bytes/s) and success (None while running), one per connection,
+        the running ones last
+        """
+        with self._lock:
+            finished = [dict(record) for record in self._finished]
+            active = []
+            for link, record in self._active.items():
+                record = dict(record, bytes=link.bytes_received)
+                record['seconds'] = time.time() - record['started']
+                record['rate'] = record['bytes'] / record['seconds'] if record['seconds'] > 0 else 0.0
+                active.append(record)
+        return finished + active
+
+    def close(self):
+        """Stop advertising and accepting, and cut the transfers in progress"""
+        self._closed.set()
+        if self.server_sock is not None:
+            if self._advertised:
+                try:
+                    bluetooth.stop_advertising(self.server_sock)
+                except (OSError, bluetooth.BluetoothError):
+                    pass
+                self._advertised = False
+            try:
+                self.server_sock.close()
+            except OSError:
+                pass
+        with self._lock:
+            links = list(self._active)
+        for link in links:
+            try:
+                link.sock.shutdown(socket.SHUT_RDWR)  # Wakes the reader thread blocked in recv
+            except (OSError, AttributeError):
+                pass
+            link.close()
+
+
+def serve_forever(gui_callback=None, progress_callback=None, log_callback=None, stop_flag=None):
+    """
+    Receive files from any number of senders until stop_flag is set, on one
+    advertised channel (see BluetoothReceiverServer). Callbacks as for
+    start_receiver_blocking.
+    Returns: False if the receiver could not start, True once stopped
+    """
+    server = BluetoothReceiverServer(gui_callback, progress_callback, log_callback)
+    if not server.start():
+        return False
+    try:
+        server.serve(stop_flag)
+    finally:
+        server.close()
+    return True
+
+
+def start_receiver_blocking(gui_callback=None, progress_callback=None, log_callback=None):
+    """
+    Receive one file, then stop
+    gui_callback: function(filename) -> save_path or None
+    progress_callback: function(bytes_received, total_size)
+    log_callback: function(message)
+    Returns: True if successful, False otherwise
+    """
+    server = BluetoothReceiverServer(gui_callback, progress_callback, log_callback, max_clients=1)
+    if not server.start():
         return False
+    try:
+        return server.serve(until_first=True) > 0
+    finally:
+        server.close()
 
 
 def start_receiver():
@@ -1,19 +1,56 @@
 import bluetooth
 import os
 
+from . import device_cache, rfcomm, transport
+
+COMPRESS_WORKERS = None  # Compression processes, compression.WORKERS by default
+DEFAULT_CHANNEL = 1  # For receivers whose SDP record cannot be found
+
 
 def ensure_bluetooth_on():
     print("Make sure Bluetooth is turned on.")
 
 
 def discover_devices():
+    """
+    One short inquiry added to the devices found before (see device_cache.py)
+    Returns: list of (addr, name), most recently seen first
+    """
     print("Scanning for Bluetooth devices...")
-    devices = bluetooth.discover_devices(duration=8, lookup_names=True)
+    cache = device_cache.get_cache()
+    cache.refresh()
+    devices = sorted(cache.snapshot().values(), key=lambda device: device.get('last_seen', 0), reverse=True)
+    devices = [(device['addr'], device['name'] or device['addr']) for device in devices]
     for i, (addr, name) in enumerate(devices, start=1):
         print(f"{i}. {name} [{addr}]") # Debug only
     return devices
 
 
+def _connect(addr, log):
+    """
+    Connect to the channel addr advertises the receiver on, looked up over SDP
+    and cached (see device_cache.py). A cached channel that refuses the
+    connection is looked up again once, the receiver may have moved.
+    Returns: the connected socket
+    """
+    cache = device_cache.get_cache()
+    cached = cache.get(addr) or {}
+    channel = cache.resolve_channel(addr)
+    for attempt in range(2):
+        port = channel or DEFAULT_CHANNEL
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        try:
+            sock.connect((addr, port))
+            return sock
+        except (OSError, bluetooth.BluetoothError):
+            sock.close()
+            if attempt or not channel or channel != cached.get('channel'):
+                raise
+        log(f"Channel {port} refused the connection, looking it up again...")
+        cache.forget_channel(addr)
+        channel = cache.resolve_channel(addr, refresh=True)
+
+
 def choose_device(devices):
     while True:
         try:
@@ -33,12 +70,15 @@ def get_valid_file_path():
         print("File not found.")
 
 
-def send_file(addr, file_path, progress_callback=None, log_callback=None):
+def send_file(addr, file_path, progress_callback=None, log_callback=None, compress=True):
     """
     Send file to Bluetooth device
     progress_callback: function(bytes_sent, total_size)
     log_callback: function(message)
-    Returns: True if successful, False otherwise
+    compress: announce the codecs this sender can use and send compressed blocks
+              (False sends every block as it is)
+    The file goes over rfcomm.py's format, which receivers older than it do not understand.
+    Returns: True if the receiver saved the file, None if it declined, False otherwise
     """
     def log(msg):
         if log_callback:
@@ -47,29 +87,15 @@ def send_file(addr, file_path, progress_callback=None, log_callback=None):
             print(msg)
     
     try:
-        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        port = 1  # RFCOMM default
-        sock.connect((addr, port))
-
-        file_size = os.path.getsize(file_path)
-        filename = os.path.basename(file_path)
-        metadata = f"{filename}::{file_size}"
-        sock.send(metadata.encode())
-
-        with open(file_path, 'rb') as f:
-            log(f"Sending '{filename}' ({file_size} bytes)...")
-            bytes_sent = 0
-            while True:
-                chunk = f.read(1024)
-                if not chunk:
-                    break
-                sock.send(chunk)
-                bytes_sent += len(chunk)
-                
-                if progress_callback:
-                    progress_callback(bytes_sent, file_size)
-
-        sock.close()
+        link = transport.RfcommTransport(_connect(addr, log))
+        try:
+            with open(file_path, 'rb') as f:
+                sent = rfcomm.send_stream(link, f, os.path.basename(file_path), os.path.getsize(file_path),
+                                          progress_callback, log, compress, COMPRESS_WORKERS)
+                if not sent:
+                    return sent
+        finally:
+            link.close()
         log("File sent successfully.")
         return True
     except Exception as e:
@@ -80,6 +106,7 @@ def send_file(addr, file_path, progress_callback=None, log_callback=None):
 def send_file_to_device(device_addr, file_path, progress_callback=None, log_callback=None):
     """
     Wrapper function for UI - sends file to specific device address
+    Returns: see send_file
     """
     if not os.path.isfile(file_path):
         if log_callback:
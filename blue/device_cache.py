@@ -0,0 +1,259 @@
+"""
+Bluetooth devices seen before, kept on disk so the list is there at once.
+
+A background thread refreshes the cache with short inquiries that add what
+they find to what is already known, instead of one long blocking scan per
+refresh. Device names and the RFCOMM channel of the receiver's SDP record
+("BtFileReceiver") are looked up once per address and reused until they
+expire, so a send connects to the advertised channel on the first try.
+
+Devices are dicts with addr, name, last_seen, and channel and channel_time
+once the channel was looked up. The cache is saved as JSON under
+app_dirs.state_dir("bluetooth").
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from wlan import app_dirs
+
+try:
+    import bluetooth
+except ImportError:  # pybluez missing: the cache still loads, inquiries find nothing
+    bluetooth = None
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "BtFileReceiver"  # SDP record bluetooth_receiver advertises
+INQUIRY_DURATION = 2  # Inquiry length in units of 1.28 s (was 8, about 10 s, for every refresh)
+NAME_TIMEOUT = 5  # Seconds to wait for a remote name
+REFRESH_INTERVAL = 30.0  # Seconds between background inquiries
+NAME_TTL = 7 * 24 * 3600.0  # Seconds a looked-up name is trusted
+NAME_RETRY = 300.0  # Seconds before a device that did not tell its name is asked again
+CHANNEL_TTL = 600.0  # Seconds a looked-up channel is trusted; the receiver binds any free channel
+DEVICE_TTL = 30 * 24 * 3600.0  # Seconds a device that is never seen again stays in the cache
+
+EVENT_APPEAR = "appear"
+EVENT_UPDATE = "update"
+EVENT_SCAN_DONE = "scan_done"  # device is None
+
+
+def _inquire(duration):
+    """Returns: addresses of the discoverable devices in range"""
+    if bluetooth is None:
+        return []
+    return bluetooth.discover_devices(duration=duration, lookup_names=False)
+
+
+def _lookup_name(addr):
+    if bluetooth is None:
+        return None
+    return bluetooth.lookup_name(addr, timeout=NAME_TIMEOUT)
+
+
+def _find_channel(addr):
+    """Returns: the RFCOMM channel of addr's SERVICE_NAME record, or None"""
+    if bluetooth is None:
+        return None
+    for service in bluetooth.find_service(name=SERVICE_NAME, address=addr):
+        if service.get("protocol") == "RFCOMM" and service.get("port"):
+            return service["port"]
+    return None
+
+
+class BluetoothDeviceCache:
+    """
+    Thread-safe. inquire, lookup_name and find_channel default to pybluez and
+    can be replaced, e.g. to run without Bluetooth.
+    """
+
+    def __init__(self, path=None, inquire=_inquire, lookup_name=_lookup_name, find_channel=_find_channel):
+        self.path = path
+        self.inquire = inquire
+        self.lookup_name = lookup_name
+        self.find_channel = find_channel
+        self.scanning = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # The inquiry thread and senders both save
+        self._devices = {}  # addr -> device; replaced on every change, never changed in place
+        self._subscribers = []
+        self._thread = None
+        self._pauses = 0  # Transfers that want the radio to themselves, see pause()
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                devices = json.load(f)["devices"]
+        except (OSError, ValueError, KeyError):
+            return
+        deadline = time.time() - DEVICE_TTL
+        self._devices = {device['addr']: device for device in devices
+                         if isinstance(device, dict) and device.get('addr') and device.get('last_seen', 0) >= deadline}
+
+    def _save(self):
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                devices = list(self._devices.values())
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump({"devices": devices}, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning("Cannot save the Bluetooth device cache: %s", e)
+
+    def _set(self, addr, **fields):
+        """Merge fields into the device at addr. Returns: the event, None if nothing visible changed"""
+        with self._lock:
+            old = self._devices.get(addr)
+            device = dict(old or {'addr': addr, 'name': None}, **fields)
+            self._devices[addr] = device
+        if old is None:
+            event = EVENT_APPEAR
+        elif old.get('name') != device.get('name'):
+            event = EVENT_UPDATE
+        else:
+            return None
+        self._notify(event, device)
+        return event
+
+    def snapshot(self):
+        """Returns: dict addr -> device of every known device"""
+        with self._lock:
+            return dict(self._devices)
+
+    def get(self, addr):
+        return self._devices.get(addr)
+
+    def refresh(self):
+        """
+        One short inquiry, then names for the devices whose name is unknown or expired.
+        Returns: the addresses found
+        """
+        self.scanning = True
+        try:
+            try:
+                found = self.inquire(INQUIRY_DURATION)
+            except Exception as e:
+                logger.warning("Bluetooth inquiry failed: %s", e)
+                found = []
+            now = time.time()
+            for addr in found:
+                self._set(addr, last_seen=now)
+            for addr in found:
+                device = self._devices[addr]
+                if now - device.get('name_time', 0) < (NAME_TTL if device.get('name') else NAME_RETRY):
+                    continue
+                try:
+                    name = self.lookup_name(addr)
+                except Exception as e:
+                    logger.warning("Name lookup for %s failed: %s", addr, e)
+                    name = None
+                self._set(addr, name=name or device.get('name'), name_time=time.time())
+            self._save()
+            return found
+        finally:
+            self.scanning = False
+            self._notify(EVENT_SCAN_DONE, None)
+
+    def resolve_channel(self, addr, refresh=False):
+        """
+        refresh: ignore a cached channel, e.g. after connecting to it failed
+        Returns: the RFCOMM channel addr advertises the receiver on, or None if it advertises none
+        """
+        device = self._devices.get(addr)
+        if not refresh and device and device.get('channel') and time.time() - device['channel_time'] < CHANNEL_TTL:
+            return device['channel']
+        channel = self.find_channel(addr)
+        if channel:
+            self._set(addr, channel=channel, channel_time=time.time())
+            self._save()
+        return channel
+
+    def forget_channel(self, addr):
+        """Drop the cached channel of addr, which turned out to be wrong"""
+        if self._devices.get(addr, {}).get('channel'):
+            self._set(addr, channel=None, channel_time=0)
+
+    def start(self, interval=REFRESH_INTERVAL):
+        """Refresh now and then every interval seconds on a background thread, until stop()"""
+        self._stopped.clear()
+        self._wake.set()
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="bluetooth-inquiry", daemon=True)
+        self._thread.start()
+
+    def refresh_now(self):
+        """Have the background thread start its next inquiry right away"""
+        self._wake.set()
+
+    def stop(self):
+        """Stop refreshing after the inquiry in progress, if any"""
+        self._stopped.set()
+        self._wake.set()
+
+    def pause(self):
+        """
+        Skip background inquiries until resume(), e.g. while an RFCOMM transfer runs:
+        an inquiry takes airtime from it. Calls nest, one resume() per pause().
+        """
+        with self._lock:
+            self._pauses += 1
+
+    def resume(self):
+        with self._lock:
+            self._pauses = max(self._pauses - 1, 0)
+
+    def _run(self, interval):
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+            if self._pauses:
+                continue
+            self.refresh()
+
+    def subscribe(self, callback):
+        """
+        callback: function(event, device), called from the thread that made the change
+        Returns: function that unsubscribes callback again
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def _notify(self, event, device):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, device)
+            except Exception as e:
+                logger.warning("Bluetooth device cache subscriber failed: %s", e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns: the cache shared by the UI and the sender, loaded from disk on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = BluetoothDeviceCache(os.path.join(app_dirs.state_dir("bluetooth"), "devices.json"))
+        return _cache
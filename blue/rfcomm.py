@@ -0,0 +1,302 @@
+"""
+Bluetooth file transfer over any transport (see transport.py).
+
+Wire format, version 1:
+    sender -> receiver  HEADER (magic, version, file size, codecs the sender can
+                        use, name length), then the file name in UTF-8
+    receiver -> sender  ACCEPT (status, codecs accepted); STATUS_FAILED declines
+    sender -> receiver  the file as blocks (common.compression.encode_block),
+                        compressed or CODEC_NONE
+    receiver -> sender  RESULT (status) once the file is written
+The header is read on its own, so no file bytes end up in the metadata, and
+the sender learns whether the file arrived.
+
+Writes go through a Coalescer, which hands the link whole RFCOMM frames: a
+1024 byte write costs a full frame plus a 16 byte one. Both sides keep the
+link busy with a Pump thread. The sender reads the file ahead while blocks
+go out, and the receiver drains the link while it decompresses and writes.
+"""
+import queue
+import struct
+import threading
+
+from common import compression
+
+MAGIC = b"QSBT"
+VERSION = 1
+HEADER = struct.Struct("!4sBQBH")  # magic, version, file size, codec mask, name length
+ACCEPT = struct.Struct("!BB")      # status, codec mask
+RESULT = struct.Struct("!B")       # status
+STATUS_FAILED = 0
+STATUS_OK = 1
+
+SUPPORTED_CODECS = compression.ALL_CODECS
+BLOCK_SIZE = 256 * 1024  # Smaller than on Wi-Fi so progress still moves on a slow link
+MAX_BLOCK = 4 * 1024 * 1024  # Largest uncompressed block accepted from a sender
+WRITE_FRAMES = 16  # RFCOMM frames handed to the link per write
+READ_AHEAD = 4  # File blocks (sender) or link reads (receiver) a Pump holds
+RECV_SIZE = 64 * 1024  # Bytes asked for per read from the link
+
+
+class Pump:
+    """
+    Calls produce() on a thread, staying up to depth results ahead of the
+    consumer, until it returns something empty. get() hands the results over
+    in order and raises what produce() raised.
+    """
+
+    def __init__(self, produce, depth=READ_AHEAD, name="pump"):
+        self._produce = produce
+        self._queue = queue.Queue(depth)
+        self._stopped = threading.Event()
+        self._last = None  # (result, error) once produce() is exhausted or failed
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                result = self._produce()
+                self._put((result, None))
+                if not result:
+                    return
+        except BaseException as e:
+            self._put((None, e))
+
+    def _put(self, entry):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self):
+        """Returns: the next result, or an empty one for good once produce() is exhausted"""
+        if self._last is None:
+            result, error = self._queue.get()
+            if error is None and result:
+                return result
+            self._last = (result, error)
+        result, error = self._last
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        """Stop producing; a produce() call in progress still finishes"""
+        self._stopped.set()
+
+
+class StreamReader:
+    """Reads a transport on a Pump thread, so the link is drained while the caller works"""
+
+    def __init__(self, link, size=RECV_SIZE, depth=READ_AHEAD):
+        self._pump = Pump(lambda: link.recv(size), depth, "bluetooth-reader")
+        self._buffer = bytearray()
+
+    def peek(self, size):
+        """Returns: the next size bytes without consuming them, fewer only if the peer closed"""
+        while len(self._buffer) < size:
+            chunk = self._pump.get()
+            if not chunk:
+                break
+            self._buffer += chunk
+        return bytes(self._buffer[:size])
+
+    def recv(self, size):
+        """Returns: up to size bytes, b"" once the peer closed"""
+        if not self._buffer:
+            self._buffer += self._pump.get()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def recv_exact(self, size):
+        """Returns: exactly size bytes. Raises: ConnectionError if the peer closes first"""
+        data = self.peek(size)
+        if len(data) < size:
+            raise ConnectionError(f"Connection closed after {len(data)} of {size} bytes")
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self._pump.close()
+
+
+class Coalescer:
+    """Collects writes and passes them to the link in whole multiples of frames RFCOMM frames"""
+
+    def __init__(self, link, frames=WRITE_FRAMES):
+        self.link = link
+        self.size = link.mtu * frames
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.size:
+            end = len(self._buffer) - len(self._buffer) % self.size
+            view = memoryview(self._buffer)
+            try:
+                self.link.send(view[:end])
+            finally:
+                view.release()
+            del self._buffer[:end]
+
+    def flush(self):
+        """Send what is left, e.g. before waiting for the peer's answer"""
+        if self._buffer:
+            self.link.send(self._buffer)
+            self._buffer = bytearray()
+
+
+def send_blocks(writer, blocks, file_size, compressor, progress_callback=None):
+    """
+    Send the file as a stream of blocks, each compressed with the codec that
+    suits it or left as it is when it does not compress. Blocks are compressed
+    in parallel and sent in order.
+    writer: Coalescer of the link
+    blocks: Pump of the file's raw blocks
+    """
+    bytes_sent = 0
+
+    def emit(done):
+        nonlocal bytes_sent
+        for raw_length, (codec, payload) in done:
+            writer.write(compression.BLOCK_HEADER.pack(codec, raw_length, len(payload)))
+            writer.write(payload)
+            bytes_sent += raw_length
+            if progress_callback:
+                progress_callback(bytes_sent, file_size)
+
+    window = compression.ReorderWindow(compressor.window)
+    bytes_read = 0
+    while bytes_read < file_size:
+        block = blocks.get()
+        if not block:
+            raise EOFError(f"File shrank while sending (offset {bytes_read})")
+        bytes_read += len(block)
+        codec = compressor.choose(compression.sample(block)) if compressor.codecs else compression.CODEC_NONE
+        emit(window.add(len(block), compressor.submit(block, codec)))
+    emit(window.drain())
+
+
+def receive_blocks(save_path, reader, file_size, codecs, progress_callback=None):
+    """
+    Receive a file sent as a stream of (possibly compressed) blocks, decompressing
+    several at once and writing them in order
+    reader: StreamReader of the link
+    codecs: mask of the codecs accepted for this transfer
+    Returns: CompressionStats of the transfer
+    """
+    decompressor = compression.Decompressor()
+    window = compression.ReorderWindow(decompressor.window)
+    with open(save_path, 'wb') as f:
+        bytes_written = 0
+
+        def write(done):
+            nonlocal bytes_written
+            for _, data in done:
+                f.write(data)
+                bytes_written += len(data)
+                if progress_callback:
+                    progress_callback(bytes_written, file_size)
+
+        bytes_received = 0
+        while bytes_received < file_size:
+            codec, raw_length, payload_length = compression.BLOCK_HEADER.unpack(
+                reader.recv_exact(compression.BLOCK_HEADER.size))
+            if codec != compression.CODEC_NONE and not codec & codecs:
+                raise ValueError(f"Block compressed with codec {codec}, which was not negotiated")
+            if raw_length > MAX_BLOCK or payload_length > raw_length or bytes_received + raw_length > file_size:
+                raise ValueError(f"Block of {raw_length} bytes does not fit the announced file")
+
+            payload = reader.recv_exact(payload_length)
+            write(window.add(None, decompressor.submit(codec, payload, raw_length)))
+            bytes_received += raw_length
+        write(window.drain())
+    return decompressor.stats
+
+
+def send_stream(link, f, name, file_size, progress_callback=None, log=print, compress=True, workers=None):
+    """
+    Send file_size bytes of the open file f, to be saved as name.
+    compress: offer the codecs this sender can use; False sends every block as it is
+    workers: compression processes, compression.WORKERS by default
+    Returns: True once the receiver reports the file written, None if it declined, False if it failed
+    Raises: ConnectionError or OSError if the link breaks
+    """
+    name_bytes = name.encode("utf-8")
+    offered = compression.ALL_CODECS if compress else compression.CODEC_NONE
+    link.send(HEADER.pack(MAGIC, VERSION, file_size, offered, len(name_bytes)) + name_bytes)
+    status, codecs = ACCEPT.unpack(link.recv_exact(ACCEPT.size))
+    if status != STATUS_OK:
+        log("Transfer was cancelled by the receiver")
+        return None
+
+    compressor = compression.Compressor(codecs & offered, compression.PROFILE_SMALL, workers, BLOCK_SIZE)
+    log(f"Sending '{name}' ({file_size} bytes)...")
+    remaining = file_size
+
+    def read_block():
+        nonlocal remaining
+        block = f.read(min(BLOCK_SIZE, remaining))
+        remaining -= len(block)
+        return block
+
+    blocks = Pump(read_block, READ_AHEAD, "bluetooth-file-reader")
+    try:
+        writer = Coalescer(link)
+        send_blocks(writer, blocks, file_size, compressor, progress_callback)
+        writer.flush()
+    finally:
+        blocks.close()
+    if compressor.codecs:
+        log(f"Compressed transfer: {compressor.stats.summary()}")
+
+    status, = RESULT.unpack(link.recv_exact(RESULT.size))
+    if status != STATUS_OK:
+        log("The receiver could not save the file")
+        return False
+    return True
+
+
+def is_current(reader):
+    """Returns: True if the sender speaks this format, False for an older one"""
+    return reader.peek(len(MAGIC)) == MAGIC
+
+
+def receive_stream(reader, link, save_path_callback, progress_callback=None, log=print):
+    """
+    Receive one file in this format (see is_current).
+    reader: StreamReader of link
+    save_path_callback: function(filename) -> save path, or None to decline
+    Returns: the path the file was saved to, or None if declined
+    Raises: ConnectionError if the link breaks, ValueError if the sender breaks the format
+    """
+    magic, version, file_size, offered, name_length = HEADER.unpack(reader.recv_exact(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported transfer format {magic!r} version {version}")
+    name = reader.recv_exact(name_length).decode("utf-8", "replace")
+
+    log(f"Incoming file: {name} ({file_size} bytes)")
+    save_path = save_path_callback(name)
+    if not save_path:
+        log("File save cancelled")
+        link.send(ACCEPT.pack(STATUS_FAILED, compression.CODEC_NONE))
+        return None
+
+    codecs = offered & SUPPORTED_CODECS
+    link.send(ACCEPT.pack(STATUS_OK, codecs))
+    try:
+        stats = receive_blocks(save_path, reader, file_size, codecs, progress_callback)
+    except (ValueError, OSError):
+        try:
+            link.send(RESULT.pack(STATUS_FAILED))
+        except OSError:
+            pass
+        raise
+    link.send(RESULT.pack(STATUS_OK))
+    log(f"File saved to: {save_path}")
+    if codecs:
+        log(f"Compressed transfer: {stats.summary()}")
+    return save_path
@@ -0,0 +1,159 @@
+"""
+Byte streams the Bluetooth transfer engine (rfcomm.py) runs over.
+
+A transport has send(data), which sends all of data however many calls the
+link needs, send_some(data), which sends what one call can and returns how
+much that was, recv(size), which returns up to size bytes and b"" once the
+peer closed, close(), and mtu, the payload of one RFCOMM frame.
+bytes_sent and bytes_received count what went over the link so far.
+
+RfcommTransport wraps a connected RFCOMM socket, from pybluez or the
+standard library's AF_BLUETOOTH. EmulatedTransport runs over any stream
+socket, typically one end of socket.socketpair(), and delivers data the way
+a radio link of a given bandwidth, latency and frame size would, so the
+engine can run on a machine without Bluetooth (see emulated_pair).
+"""
+import socket
+import struct
+import time
+
+# Payload of one RFCOMM frame with the L2CAP MTU most stacks negotiate (1013
+# bytes less the RFCOMM header). Neither pybluez nor the socket module report
+# the negotiated value, so this is an assumption; pass mtu= where it is known.
+RFCOMM_MTU = 1008
+
+EMULATED_BANDWIDTH = 250 * 1024  # Bytes/s, about what Bluetooth EDR manages for RFCOMM payload
+EMULATED_LATENCY = 0.02  # Seconds one way
+FRAME_OVERHEAD = 0.0006  # Seconds of air time every frame costs on top of its payload (headers, a baseband slot)
+MAX_SEND = 64 * 1024  # Bytes offered to a socket per call
+SEND_BUFFER_TIME = 0.05  # Seconds of data the emulated link queues before send_some blocks
+EMULATED_FRAME = struct.Struct("!dH")  # delivery time (time.monotonic), payload length
+
+
+class Transport:
+    """What the transports share: complete sends and exact reads on top of send_some and recv"""
+
+    mtu = RFCOMM_MTU
+    bytes_sent = 0
+    bytes_received = 0
+
+    def send_some(self, data):
+        raise NotImplementedError
+
+    def recv(self, size):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def send(self, data):
+        """Send all of data; a link may take less than offered in one call"""
+        view = memoryview(data)
+        while view:
+            view = view[self.send_some(view):]
+
+    def recv_exact(self, size):
+        """Returns: exactly size bytes. Raises: ConnectionError if the peer closes first"""
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(f"Connection closed after {len(data)} of {size} bytes")
+            data += chunk
+        return bytes(data)
+
+
+class RfcommTransport(Transport):
+    """A connected RFCOMM socket"""
+
+    def __init__(self, sock, mtu=RFCOMM_MTU):
+        self.sock = sock
+        self.mtu = mtu
+
+    def send_some(self, data):
+        # pybluez only takes bytes; copying at most MAX_SEND keeps short sends from copying the rest over and over
+        sent = self.sock.send(bytes(data[:MAX_SEND]))
+        self.bytes_sent += sent
+        return sent
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.bytes_received += len(data)
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+class EmulatedTransport(Transport):
+    """
+    One end of an emulated radio link over a stream socket; the other end must
+    be an EmulatedTransport too. Every send_some() is at most one frame of mtu
+    bytes, like the RFCOMM layer cutting up each write. A frame occupies the
+    link for its payload at bandwidth plus frame_overhead, and is handed to the
+    peer's recv() latency seconds after it finished sending.
+    """
+
+    def __init__(self, sock, bandwidth=EMULATED_BANDWIDTH, latency=EMULATED_LATENCY, mtu=RFCOMM_MTU,
+                 frame_overhead=FRAME_OVERHEAD):
+        self.sock = sock
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.mtu = mtu
+        self.frame_overhead = frame_overhead
+        self.frames_sent = 0
+        self._busy_until = 0.0  # When the link has sent everything queued so far
+        self._pending = b""  # Rest of a received frame that did not fit the caller's size
+
+    def send_some(self, data):
+        frame = data[:self.mtu]
+        now = time.monotonic()
+        self._busy_until = max(now, self._busy_until) + len(frame) / self.bandwidth + self.frame_overhead
+        backlog = self._busy_until - now
+        if backlog > SEND_BUFFER_TIME:
+            time.sleep(backlog - SEND_BUFFER_TIME)  # The link's queue is full
+        self.sock.sendall(EMULATED_FRAME.pack(self._busy_until + self.latency, len(frame)) + bytes(frame))
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+        return len(frame)
+
+    def _read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def recv(self, size):
+        if not self._pending:
+            header = self._read(EMULATED_FRAME.size)
+            if header is None:
+                return b""
+            deliver_at, length = EMULATED_FRAME.unpack(header)
+            frame = self._read(length)
+            if frame is None:
+                return b""
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._pending = frame
+        data, self._pending = self._pending[:size], self._pending[size:]
+        self.bytes_received += len(data)
+        return data
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes a reader blocked in recv on the other end
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def emulated_pair(bandwidth=EMULATED_BANDWIDTH, latency=EMULATED_LATENCY, mtu=RFCOMM_MTU,
+                  frame_overhead=FRAME_OVERHEAD):
+    """Returns: two EmulatedTransports connected to each other over a local socketpair"""
+    a, b = socket.socketpair()
+    return (EmulatedTransport(a, bandwidth, latency, mtu, frame_overhead),
+            EmulatedTransport(b, bandwidth, latency, mtu, frame_overhead))
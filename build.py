@@ -7,7 +7,7 @@ import shutil
 exe_name = "QuickSilver"
 entry_script = "ui.py"
 icon_path = "assets/favicon.ico"
-folders_to_include = ["assets", "wlan", "blue"]
+folders_to_include = ["assets", "common", "wlan", "blue"]
 separator = ';' if os.name == 'nt' else ':'
 
 # === Cleanup old builds ===
@@ -0,0 +1,311 @@
+"""
+Block compression shared by the Wi-Fi and Bluetooth senders.
+
+Files are compressed in independent blocks and the codec is picked per block
+from a small sample: data that does not compress (JPEG, ZIP, MP4, ...) is sent
+untouched, everything else with the codec that suits the link. The set of
+codecs a sender may use is negotiated when the transfer starts.
+
+The sample test is a zlib level 1 pass over a few KiB of the block. It costs
+less than a byte histogram and, unlike an entropy estimate, also recognises
+repetitive data whose byte values happen to be evenly spread.
+
+Because blocks are independent they can be (de)compressed on several cores at
+once, pigz-style: jobs go to a shared process pool and come back in order
+through a ReorderWindow that bounds how many blocks are held in memory. With a
+single worker the jobs run on a thread instead, which still overlaps them with
+the network since the codecs release the GIL.
+"""
+import asyncio
+import bz2
+import collections
+import concurrent.futures
+import lzma
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Codec bits, a transfer negotiates a mask of them and each block names one
+CODEC_NONE = 0
+CODEC_ZLIB = 1 << 0
+CODEC_LZMA = 1 << 1
+CODEC_BZ2 = 1 << 2
+ALL_CODECS = CODEC_ZLIB | CODEC_LZMA | CODEC_BZ2
+CODEC_NAMES = {CODEC_NONE: "none", CODEC_ZLIB: "zlib", CODEC_LZMA: "lzma", CODEC_BZ2: "bz2"}
+
+# Profiles: how much CPU is worth spending per byte saved
+PROFILE_FAST = "fast"    # Link faster than the heavy codecs, e.g. Wi-Fi: cheap zlib only
+PROFILE_SMALL = "small"  # Slow link, e.g. Bluetooth: best ratio
+
+BLOCK_SIZE = 1024 * 1024
+WORKERS = min(8, os.cpu_count() or 1)  # Compression processes; 1 compresses on a thread
+WINDOW_PER_WORKER = 2  # Blocks in flight per worker, bounds memory to about 2 * window * block size
+SAMPLE_COUNT = 4
+SAMPLE_SIZE = 1024
+MIN_SAVING = 0.10  # A block is only sent compressed if that saves at least 10%
+
+# Framing of a plain stream of blocks (Bluetooth); Wi-Fi carries blocks in its own frames
+BLOCK_HEADER = struct.Struct("!BII")  # codec, uncompressed length, payload length
+
+_TEXT_BYTES = bytes(range(32, 127)) + b"\t\r\n"
+_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": BLOCK_SIZE}]
+
+
+def sample_ranges(length):
+    """Returns: (offset, size) slices spread over a block of length bytes, enough to judge how it compresses"""
+    if length <= SAMPLE_COUNT * SAMPLE_SIZE:
+        return [(0, length)]
+    step = (length - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+    return [(i * step, SAMPLE_SIZE) for i in range(SAMPLE_COUNT)]
+
+
+def sample(data):
+    """The sample of a block that is already in memory"""
+    return b"".join(bytes(data[offset:offset + size]) for offset, size in sample_ranges(len(data)))
+
+
+class CompressionStats:
+    """Running totals of one transfer, updated from any number of stream threads"""
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+        self.blocks = collections.Counter()  # codec -> block count
+        self._lock = threading.Lock()
+
+    def record(self, codec, raw_bytes, wire_bytes, cpu_time=0.0):
+        with self._lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_time += cpu_time
+            self.blocks[codec] += 1
+
+    @property
+    def ratio(self):
+        """Wire bytes per raw byte, 1.0 when nothing was compressed"""
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def summary(self):
+        codecs = ", ".join(f"{CODEC_NAMES[c]}: {n}" for c, n in sorted(self.blocks.items()))
+        return (f"compression ratio {self.ratio:.2f} ({self.raw_bytes} -> {self.wire_bytes} bytes), "
+                f"{self.cpu_time:.2f} s CPU, blocks {codecs or 'none'}")
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(workers):
+    """
+    Returns: the pool with this many workers, started on first use and shared by all transfers.
+    Workers are spawned rather than forked so they do not inherit the sockets
+    (and locks) of the threads that are transferring, and behave the same as on Windows.
+    A single worker is a thread: a process would only add the cost of copying blocks.
+    """
+    with _pools_lock:
+        if workers not in _pools:
+            if workers == 1:
+                _pools[workers] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            else:
+                _pools[workers] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pools[workers]
+
+
+def completed(result):
+    """Returns: a Future that already holds result"""
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+class ReorderWindow:
+    """
+    Jobs that finish in any order, handed back in the order they were added.
+    At most size jobs are outstanding: adding one more waits for the oldest.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._pending = collections.deque()
+
+    def add(self, item, future):
+        """Queue a job. Returns: [(item, result)] of the oldest jobs that are now due, in order"""
+        self._pending.append((item, future))
+        due = []
+        while self._pending and (len(self._pending) > self.size or self._pending[0][1].done()):
+            item, future = self._pending.popleft()
+            due.append((item, future.result()))
+        return due
+
+    def drain(self):
+        """Returns: [(item, result)] of every remaining job, in order"""
+        due = [(item, future.result()) for item, future in self._pending]
+        self._pending.clear()
+        return due
+
+    async def add_async(self, item, future):
+        """add() for coroutines: waits for the oldest job without blocking the event loop"""
+        if len(self._pending) >= self.size:
+            await asyncio.wrap_future(self._pending[0][1])
+        return self.add(item, future)
+
+    async def drain_async(self):
+        """drain() for coroutines"""
+        for _, future in list(self._pending):
+            await asyncio.wrap_future(future)
+        return self.drain()
+
+
+def _compress_block(data, codec, profile):
+    """Runs in a pool worker. Returns: (codec, payload, cpu_time)"""
+    started = time.thread_time()
+    if codec == CODEC_ZLIB:
+        payload = zlib.compress(data, 1 if profile == PROFILE_FAST else 6)
+    elif codec == CODEC_LZMA:
+        payload = lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, filters=_LZMA_FILTERS)
+    elif codec == CODEC_BZ2:
+        payload = bz2.compress(data, 9)
+    else:
+        payload = data
+    cpu_time = time.thread_time() - started
+
+    if codec != CODEC_NONE and len(payload) > len(data) * (1 - MIN_SAVING):
+        codec, payload = CODEC_NONE, data
+    return codec, payload, cpu_time
+
+
+def _decompress_block(codec, payload, raw_length):
+    """Runs in a pool worker. Returns: (data, cpu_time)"""
+    started = time.thread_time()
+    if codec == CODEC_NONE:
+        data = payload
+    elif codec == CODEC_ZLIB:
+        data = zlib.decompressobj().decompress(payload, raw_length)
+    elif codec == CODEC_LZMA:
+        data = lzma.LZMADecompressor().decompress(payload, raw_length)
+    elif codec == CODEC_BZ2:
+        data = bz2.BZ2Decompressor().decompress(payload, raw_length)
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    if len(data) != raw_length:
+        raise ValueError(f"Block decompressed to {len(data)} bytes instead of {raw_length}")
+    return data, time.thread_time() - started
+
+
+def _then(job, convert):
+    """Returns: a Future of convert(job.result()), computed when the pool job finishes"""
+    future = concurrent.futures.Future()
+
+    def done(job):
+        try:
+            future.set_result(convert(job.result()))
+        except BaseException as e:
+            future.set_exception(e)
+
+    job.add_done_callback(done)
+    return future
+
+
+class Compressor:
+    """
+    Picks a codec for each block and compresses it.
+    codecs: mask of codecs the receiver accepted
+    profile: PROFILE_FAST or PROFILE_SMALL
+    workers: processes compressing blocks in parallel (1: one thread), WORKERS by default
+    block_size: bytes per block for senders that cut the file into blocks
+    window: blocks in flight per stream, WINDOW_PER_WORKER per worker by default
+    """
+
+    def __init__(self, codecs, profile=PROFILE_FAST, workers=None, block_size=BLOCK_SIZE, window=None):
+        self.codecs = codecs
+        self.profile = profile
+        self.workers = max(1, workers or WORKERS)
+        self.block_size = block_size
+        self.window = window or WINDOW_PER_WORKER * self.workers
+        self.stats = CompressionStats()
+
+    def _first_allowed(self, *preference):
+        for codec in preference:
+            if self.codecs & codec:
+                return codec
+        return CODEC_NONE
+
+    def choose(self, sample_data):
+        """Returns: the codec to try for a block represented by sample_data"""
+        if not self.codecs or not sample_data:
+            return CODEC_NONE
+        if len(zlib.compress(sample_data, 1)) > len(sample_data) * (1 - MIN_SAVING):
+            return CODEC_NONE
+        if self.profile == PROFILE_FAST:
+            return self._first_allowed(CODEC_ZLIB)
+        # bz2 usually wins on text (logs, CSV), lzma on structured binary data
+        is_text = len(sample_data.translate(None, _TEXT_BYTES)) < len(sample_data) // 20
+        if is_text:
+            return self._first_allowed(CODEC_BZ2, CODEC_LZMA, CODEC_ZLIB)
+        return self._first_allowed(CODEC_LZMA, CODEC_BZ2, CODEC_ZLIB)
+
+    def pass_through(self, length):
+        """Count a block that is sent as it is without trying to compress it"""
+        self.stats.record(CODEC_NONE, length, length)
+
+    def submit(self, data, codec):
+        """
+        Start compressing one block with codec, as picked by choose().
+        Returns: a Future of (codec, payload), where codec is CODEC_NONE and payload
+        the block itself if compressing did not save enough
+        """
+        def record(result):
+            codec, payload, cpu_time = result
+            self.stats.record(codec, len(data), len(payload), cpu_time)
+            return codec, payload
+
+        if codec == CODEC_NONE:
+            return completed(record(_compress_block(data, codec, self.profile)))
+        return _then(get_pool(self.workers).submit(_compress_block, data, codec, self.profile), record)
+
+    def compress(self, data, codec):
+        """
+        Compress a small block in the calling thread, where the round trip to a
+        pool worker would cost more than the work. Returns: (codec, payload) like submit()
+        """
+        codec, payload, cpu_time = _compress_block(data, codec, self.profile)
+        self.stats.record(codec, len(data), len(payload), cpu_time)
+        return codec, payload
+
+
+class Decompressor:
+    """Decompresses blocks on the shared pool (see get_pool) and keeps the transfer's stats"""
+
+    def __init__(self, workers=None, window=None):
+        self.workers = max(1, workers or WORKERS)
+        self.window = window or WINDOW_PER_WORKER * self.workers
+        self.stats = CompressionStats()
+
+    def submit(self, codec, payload, raw_length):
+        """
+        Start decompressing one block; it never produces more than raw_length bytes.
+        Returns: a Future of the data, failing with ValueError if the block does not
+        decompress to exactly raw_length bytes
+        """
+        def record(result):
+            data, cpu_time = result
+            self.stats.record(codec, raw_length, len(payload), cpu_time)
+            return data
+
+        if codec == CODEC_NONE:
+            try:
+                return completed(record(_decompress_block(codec, payload, raw_length)))
+            except ValueError as e:
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+                return future
+        return _then(get_pool(self.workers).submit(_decompress_block, codec, payload, raw_length), record)
+
+
+def encode_block(codec, raw_length, payload):
+    return BLOCK_HEADER.pack(codec, raw_length, len(payload)) + payload
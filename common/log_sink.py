@@ -0,0 +1,77 @@
+"""
+Bounded, batched log output.
+
+Messages for the user go into a LogSink, a ring buffer of at most MAX_PENDING
+lines that any thread can write to without touching the UI. The UI drains it
+FLUSH_INTERVAL apart and inserts the lines in one go, and keeps MAX_LINES of
+them on screen. When a burst overflows the buffer the oldest lines are
+dropped and counted instead, so a long-running receiver neither grows nor
+slows down from logging.
+
+Diagnostics go through the logging module at DEBUG level, which costs one
+level check when they are off (the default). Set QUICKSILVER_DEBUG=1 to
+print them; warnings and errors also reach the sink (see configure_logging).
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+MAX_PENDING = 1000  # Lines held between two flushes
+MAX_LINES = 2000  # Lines the UI log keeps
+FLUSH_INTERVAL = 0.25  # Seconds between two flushes into the UI
+DEBUG_ENV = "QUICKSILVER_DEBUG"
+
+
+class LogSink:
+    """Thread-safe ring buffer of timestamped lines"""
+
+    def __init__(self, capacity=MAX_PENDING):
+        self._lines = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.written = 0  # Lines written since the start
+        self._drained = 0  # Lines written up to the last drain()
+
+    def write(self, message):
+        line = f"[{time.strftime('%H:%M:%S')}] {message}"
+        with self._lock:
+            self._lines.append(line)
+            self.written += 1
+
+    def drain(self):
+        """
+        Returns: (the lines written since the last drain, oldest first, how many
+        more were written but dropped because the buffer was full)
+        """
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+            dropped = self.written - self._drained - len(lines)
+            self._drained = self.written
+        return lines, dropped
+
+
+class SinkHandler(logging.Handler):
+    """Passes log records on to a LogSink"""
+
+    def __init__(self, sink, level=logging.WARNING):
+        super().__init__(level)
+        self.sink = sink
+
+    def emit(self, record):
+        try:
+            self.sink.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def configure_logging(sink=None):
+    """
+    Print warnings, and debug output too if QUICKSILVER_DEBUG is set, to stderr.
+    sink: LogSink that also gets the warnings and errors
+    """
+    level = logging.DEBUG if os.environ.get(DEBUG_ENV) else logging.WARNING
+    logging.basicConfig(level=level, format="%(levelname)s %(name)s: %(message)s")
+    if sink is not None:
+        logging.getLogger().addHandler(SinkHandler(sink))
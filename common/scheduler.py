@@ -0,0 +1,253 @@
+"""
+Queue of sends to many devices.
+
+Every job is some files for one device. The scheduler runs up to MAX_ACTIVE
+of them at once, and at most MAX_PER_PEER to the same device, so a few slow
+receivers do not hold up the rest and no receiver gets flooded. Among the
+jobs that may start, the one with the highest priority goes first, then the
+smallest: a short file is not stuck behind a huge one. Waiting counts as
+AGING_RATE bytes less per second, so a huge job still gets its turn.
+
+Job sizes are measured on a worker thread, once for all the jobs submitted
+with the same paths, since a folder can take a while to walk; a job is not
+started before its size is known.
+
+A failed job goes back into the queue after the next of RETRY_DELAYS and is
+given up once they are used up; one that raised PermanentFailure, e.g. the
+receiver declined it, is given up at once. Each job reports its progress to its own
+TransferTelemetry; sample() adds them up into the throughput and time left
+of the whole queue.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+
+from . import telemetry
+
+logger = logging.getLogger(__name__)
+
+MAX_ACTIVE = 4  # Sends running at once
+MAX_PER_PEER = 2  # Sends running at once to the same device
+RETRY_DELAYS = (5, 30, 120)  # Seconds before each new attempt of a failed job
+AGING_RATE = 16 * 1024 * 1024  # Bytes a job counts as smaller per second it waits
+
+# Job states
+QUEUED = "queued"
+ACTIVE = "active"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class PermanentFailure(Exception):
+    """Raised by a send that trying again cannot fix; its message becomes the job's error"""
+
+
+def path_size(path):
+    """Returns: bytes in the file, or in all files under the folder"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for folder, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    return total
+
+
+class Job:
+    """One send: paths to one device"""
+
+    def __init__(self, job_id, paths, device, peer, priority, peer_limit):
+        self.id = job_id
+        self.paths = paths
+        self.device = device
+        self.peer = peer  # Key the per-device limit counts by
+        self.priority = priority
+        self.peer_limit = peer_limit
+        self.size = None  # Bytes to send, None until measured
+        self.state = QUEUED
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.not_before = 0.0  # monotonic time before which a retry may not start
+        self.progress = telemetry.TransferTelemetry()
+        self.error = None
+
+    def done_bytes(self):
+        if self.size is None:
+            return 0
+        if self.state == DONE:
+            return self.size
+        return min(self.progress.done, self.size) if self.state == ACTIVE else 0
+
+    def rank(self, now):
+        """Returns: sort key among the queued jobs, lowest starts first"""
+        return -self.priority, self.size - (now - self.queued_at) * AGING_RATE, self.id
+
+
+class TransferScheduler:
+    """
+    send: function(job, progress_callback) -> bool, blocking, called on a worker
+          thread per job; False or raising counts as failing, and the job is
+          retried unless it raised PermanentFailure
+    on_job: function(job) called from the worker thread when a job is done, failed
+            or is going to be retried
+    on_idle: function() called once nothing is queued or running any more
+    """
+
+    def __init__(self, send, max_active=MAX_ACTIVE, max_per_peer=MAX_PER_PEER, retry_delays=RETRY_DELAYS,
+                 on_job=None, on_idle=None):
+        self.send = send
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self.retry_delays = retry_delays
+        self.on_job = on_job
+        self.on_idle = on_idle
+        self.jobs = []  # Every job since the last clear_finished(), in submission order
+        self._ids = itertools.count(1)
+        self._active = {}  # peer -> jobs running to it
+        self._measuring = set()  # Tuples of paths whose size a worker thread is measuring
+        self._lock = threading.Lock()
+        self._timer = None  # Wakes the queue when the earliest retry is due
+        self._wake = None  # monotonic time self._timer fires at
+        self._aggregate = telemetry.TransferTelemetry()
+
+    def submit(self, paths, device, peer, priority=0, peer_limit=None):
+        """
+        Queue a send of paths to device.
+        peer: hashable key of the device, e.g. its MAC address
+        priority: higher starts first
+        peer_limit: sends to this peer at once, instead of max_per_peer
+        Returns: the Job
+        """
+        job = Job(next(self._ids), list(paths), device, peer, priority, peer_limit or self.max_per_peer)
+        key = tuple(job.paths)
+        with self._lock:
+            self.jobs.append(job)
+            measure = key not in self._measuring
+            self._measuring.add(key)
+        if measure:
+            threading.Thread(target=self._measure, args=(key,), name="send-size", daemon=True).start()
+        return job
+
+    def _measure(self, key):
+        """Size the jobs waiting for it with these paths, then start what can start"""
+        try:
+            size = sum(path_size(path) for path in key)
+        except OSError as e:
+            logger.warning("Cannot size %s: %s", key[0], e)
+            size = 0
+        with self._lock:
+            self._measuring.discard(key)
+            for job in self.jobs:
+                if job.size is None and tuple(job.paths) == key:
+                    job.size = size
+        self._dispatch()
+
+    def cancel_pending(self):
+        """Drop the queued jobs; running sends finish"""
+        with self._lock:
+            for job in self.jobs:
+                if job.state == QUEUED:
+                    job.state = CANCELLED
+            idle = not self._running()
+        if idle:
+            self._notify_idle()
+
+    def clear_finished(self):
+        """Forget the finished jobs, so the next sample() only covers what is left"""
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job.state in (QUEUED, ACTIVE)]
+            self._aggregate = telemetry.TransferTelemetry()
+
+    def _running(self):
+        return sum(len(jobs) for jobs in self._active.values())
+
+    def _dispatch(self):
+        """Start queued jobs while the limits allow"""
+        with self._lock:
+            now = time.monotonic()
+            queued = sorted((job for job in self.jobs if job.state == QUEUED and job.size is not None),
+                            key=lambda job: job.rank(now))
+            running = self._running()
+            wake = None
+            for job in queued:
+                if running >= self.max_active:
+                    break
+                if job.not_before > now:
+                    wake = job.not_before if wake is None else min(wake, job.not_before)
+                    continue
+                if len(self._active.get(job.peer, ())) >= job.peer_limit:
+                    continue
+                job.state = ACTIVE
+                job.attempts += 1
+                self._active.setdefault(job.peer, []).append(job)
+                running += 1
+                threading.Thread(target=self._run, args=(job,), name=f"send-{job.id}", daemon=True).start()
+            if wake is not None and (self._timer is None or not self._timer.is_alive() or wake < self._wake):
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._wake = wake
+                self._timer = threading.Timer(wake - now, self._dispatch)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _run(self, job):
+        retry = True
+        try:
+            success = self.send(job, job.progress.update)
+            job.error = None if success else "Send failed"
+        except PermanentFailure as e:
+            job.error = str(e)
+            retry = False
+        except Exception as e:
+            logger.warning("Send job %s to %s failed: %s", job.id, job.peer, e)
+            job.error = str(e)
+        with self._lock:
+            self._active[job.peer].remove(job)
+            if not self._active[job.peer]:
+                del self._active[job.peer]
+            if job.error is None:
+                job.state = DONE
+            elif retry and job.attempts <= len(self.retry_delays):
+                job.state = QUEUED
+                job.not_before = time.monotonic() + self.retry_delays[job.attempts - 1]
+            else:
+                job.state = FAILED
+            idle = not self._running() and not any(other.state == QUEUED for other in self.jobs)
+        if self.on_job:
+            self.on_job(job)
+        if idle:
+            self._notify_idle()
+        else:
+            self._dispatch()
+
+    def _notify_idle(self):
+        if self.on_idle:
+            self.on_idle()
+
+    def counts(self):
+        """Returns: dict of job state -> number of jobs in it"""
+        with self._lock:
+            counts = dict.fromkeys((QUEUED, ACTIVE, DONE, FAILED, CANCELLED), 0)
+            for job in self.jobs:
+                counts[job.state] += 1
+        return counts
+
+    def sample(self):
+        """
+        Returns: telemetry sample (see TransferTelemetry.sample) over the jobs not
+        cancelled or given up, plus the counts() under 'jobs'; None if there are none
+        """
+        with self._lock:
+            jobs = [job for job in self.jobs if job.state not in (CANCELLED, FAILED)]
+            if not jobs:
+                return None
+            self._aggregate.update(sum(job.done_bytes() for job in jobs), sum(job.size or 0 for job in jobs))
+            sample = self._aggregate.sample()
+        sample['jobs'] = self.counts()
+        return sample
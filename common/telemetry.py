@@ -0,0 +1,102 @@
+"""
+Transfer progress, sampled off the transfer's hot path.
+
+A sender reports progress after every few KiB, which is far more often than
+anyone can read it. Handing each report to Tk queued one closure per chunk, a
+million for a 4 GB file, and the transfer thread paid for every one of them.
+
+TransferTelemetry.update() is the progress callback instead: it only stores
+the two counters, so it never blocks or allocates. Whoever shows the progress
+calls sample() at its own pace (PUBLISH_RATE times a second in the UI) and
+gets one coalesced update with the instantaneous and smoothed throughput and
+the time left.
+"""
+import math
+import time
+
+PUBLISH_RATE = 10  # Updates per second worth showing
+SMOOTHING = 3.0  # Seconds over which the smoothed throughput averages, so the ETA does not jump around
+
+
+class TransferTelemetry:
+    """
+    Counters written by the transfer thread and read by one sampler; plain
+    attribute stores are atomic, so neither side takes a lock.
+    """
+
+    def __init__(self, smoothing=SMOOTHING, clock=time.monotonic):
+        self.smoothing = smoothing
+        self.clock = clock
+        self.done = 0
+        self.total = 0
+        self.updates = 0  # Progress reports since the start, to tell how many a sample coalesced
+        self._started = None
+        self._last_time = None
+        self._last_done = 0
+        self._rate = 0.0
+        self._smoothed = None
+
+    def update(self, done, total):
+        """Progress callback: function(bytes_done, total_size)"""
+        self.done = done
+        self.total = total
+        self.updates += 1
+
+    def sample(self):
+        """
+        Returns: dict with done, total, fraction (0..1), rate (bytes/s since the
+        last sample), smoothed_rate (bytes/s), eta (seconds, None while unknown),
+        elapsed (seconds) and updates; None if nothing was reported yet
+        """
+        if not self.updates:
+            return None
+        now = self.clock()
+        done, total = self.done, self.total
+        if self._started is None:
+            self._started = self._last_time = now
+            self._last_done = done  # A resumed transfer starts above 0; only what moves from here counts
+        interval = now - self._last_time
+        if done < self._last_done:
+            self._last_done = done  # The sender started over, e.g. a retry
+        if interval > 0:
+            self._rate = (done - self._last_done) / interval
+            if self._smoothed is None:
+                self._smoothed = self._rate
+            else:
+                weight = 1 - math.exp(-interval / self.smoothing)
+                self._smoothed += weight * (self._rate - self._smoothed)
+            self._last_time, self._last_done = now, done
+        smoothed = self._smoothed or 0.0
+        remaining = max(total - done, 0)
+        if not remaining:
+            eta = 0.0
+        elif smoothed > 0:
+            eta = remaining / smoothed
+        else:
+            eta = None
+        return {
+            'done': done, 'total': total, 'fraction': min(done / total, 1.0) if total > 0 else 0.0,
+            'rate': self._rate, 'smoothed_rate': smoothed, 'eta': eta,
+            'elapsed': now - self._started, 'updates': self.updates,
+        }
+
+
+def format_rate(rate):
+    """Returns: rate in bytes/s as text, e.g. "12.3 MB/s\""""
+    if rate < 1024:
+        return f"{rate:.0f} B/s"
+    for unit in ("KB/s", "MB/s"):
+        rate /= 1024
+        if rate < 1024:
+            return f"{rate:.1f} {unit}"
+    return f"{rate / 1024:.1f} GB/s"
+
+
+def format_eta(seconds):
+    """Returns: seconds left as text, e.g. "1:05" or "2:03:10\""""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds + 0.5)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
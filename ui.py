@@ -1,5 +1,7 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, PhotoImage
+import logging
+import multiprocessing
 import threading
 import os
 import time
@@ -14,6 +16,13 @@ import wlan.wlan_receiver as wlan_receiver
 # Import Bluetooth modules
 import blue.bluetooth_sender as bluetooth_sender
 import blue.bluetooth_receiver as bluetooth_receiver
+import blue.device_cache as device_cache
+
+import common.log_sink as log_sink
+import common.scheduler as scheduler
+import common.telemetry as telemetry
+
+logger = logging.getLogger(__name__)
 
 def resource_path(relative_path):
     """Get the absolute path to a resource, works for dev and PyInstaller"""
@@ -30,18 +39,36 @@ class FileTransferApp:
         root.iconphoto(True, PhotoImage(file=resource_path('assets/logo_cropped.png')))
 
         
-        self.sending = False
+        self.sending = False  # Sends are queued or running
+        # Sends to every selected device are queued and run a few at a time, small ones first
+        self.send_scheduler = scheduler.TransferScheduler(
+            self._send_job,
+            on_job=lambda job: self.root.after(0, self._job_finished, job),
+            on_idle=lambda: self.root.after(0, self._send_queue_idle))
         self.receiving = False
         self.receiver_stop_flag = threading.Event()
         self.broadcast_stop_flag = threading.Event()
-        
+        # Messages from any thread collect here and reach the log widget in batches
+        self.log_sink = log_sink.LogSink()
+        log_sink.configure_logging(self.log_sink)
+
         self.file_path = tk.StringVar()
+        self.send_paths = []  # Files/folders picked with the browse buttons, shown in file_path
         self.send_method = tk.StringVar(value="Wi-Fi")
-        self.selected_device = None
+        self.selected_devices = []
         self.devices_list = []
+        # Wi-Fi devices are kept current by a background listener; the list follows its changes
+        self.device_registry = ipReceiver.get_registry()
+        self._unsubscribe_devices = self.device_registry.subscribe(
+            lambda event, device: self.root.after(0, self._show_wifi_devices))
+        # Bluetooth devices seen before are listed at once, short inquiries in the background add the rest
+        self.bluetooth_cache = device_cache.get_cache()
+        self._unsubscribe_bluetooth = self.bluetooth_cache.subscribe(
+            lambda event, device: self.root.after(0, self._show_bluetooth_devices))
         
         self.create_notebook()
-        
+        self._flush_log()
+
         # Start broadcasting in background
         # self.start_background_broadcast()
         
@@ -72,13 +99,16 @@ class FileTransferApp:
     def build_send_ui(self, parent):
         """Build the UI for sending files"""
         # File selection row
-        ttk.Label(parent, text="File:").pack(anchor="w")
+        ttk.Label(parent, text="Files or folder:").pack(anchor="w")
         file_frame = ttk.Frame(parent)
         file_frame.pack(fill="x", pady=(0, 10))
         
         file_entry = ttk.Entry(file_frame, textvariable=self.file_path)
         file_entry.pack(side="left", fill="x", expand=True)
         
+        folder_button = ttk.Button(file_frame, text="Folder", command=self.browse_folder)
+        folder_button.pack(side="right", padx=(5, 0))
+
         browse_button = ttk.Button(file_frame, text="Browse", command=self.browse_file)
         browse_button.pack(side="right", padx=(5, 0))
         
@@ -97,9 +127,9 @@ class FileTransferApp:
         refresh_btn.pack(side="right")
         
         # Computer selection
-        ttk.Label(parent, text="Select a device:").pack(anchor="w", pady=(10, 0))
+        ttk.Label(parent, text="Select devices:").pack(anchor="w", pady=(10, 0))
         
-        self.device_listbox = tk.Listbox(parent, height=8, exportselection=False)
+        self.device_listbox = tk.Listbox(parent, height=8, exportselection=False, selectmode="extended")
         self.device_listbox.pack(fill="both", expand=True, pady=(0, 10))
         self.device_listbox.bind("<<ListboxSelect>>", self.on_device_select)
         
@@ -178,201 +208,310 @@ class FileTransferApp:
             self.root.after(500, self.start_receiver)
         
     def log(self, message):
-        """Add a message to the log with timestamp"""
-        timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert("end", f"[{timestamp}] {message}\n")
-        self.log_text.see("end")
-        self.root.update_idletasks()
+        """Add a message to the log with timestamp; safe from any thread, shown on the next flush"""
+        self.log_sink.write(message)
+
+    def _flush_log(self):
+        """Move the collected messages into the log widget, keeping its last MAX_LINES lines"""
+        lines, dropped = self.log_sink.drain()
+        if dropped:
+            lines.insert(0, f"... {dropped} messages skipped")
+        if lines:
+            self.log_text.insert("end", "\n".join(lines) + "\n")
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - log_sink.MAX_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_text.see("end")
+        self.root.after(int(log_sink.FLUSH_INTERVAL * 1000), self._flush_log)
     
     def browse_file(self):
-        """Open file browser to select a file"""
-        file = filedialog.askopenfilename(title="Select a file")
-        if file:
-            self.file_path.set(file)
+        """Open file browser to select one or more files"""
+        files = filedialog.askopenfilenames(title="Select files")
+        if files:
+            self._set_send_paths(list(files))
+
+    def browse_folder(self):
+        """Open folder browser to select a folder to send with everything in it"""
+        folder = filedialog.askdirectory(title="Select a folder")
+        if folder:
+            self._set_send_paths([folder])
+
+    def _set_send_paths(self, paths):
+        self.send_paths = paths
+        if len(paths) == 1:
+            self.file_path.set(paths[0])
+        else:
+            self.file_path.set(f"{len(paths)} files: " + ", ".join(os.path.basename(p) for p in paths))
+
+    def _get_send_paths(self):
+        """Returns: the picked files/folders, or the path typed into the entry"""
+        text = self.file_path.get()
+        if self.send_paths and (len(self.send_paths) > 1 or text == self.send_paths[0]):
+            return self.send_paths
+        return [text] if text else []
     
     def refresh_devices(self):
         """Refresh the list of available devices"""
-        self.status_label.config(text="Scanning for devices...")
+        if self.send_method.get() == "Wi-Fi":
+            # Show what the registry has now; devices that answer the probe appear within a fraction of a second
+            ipReceiver.probe()
+            if self.bluetooth_cache.scanning and not self.sending:
+                self.progress_bar.stop()
+                self.progress_bar.pack_forget()
+                self.status_label.config(text="Ready")
+            self.bluetooth_cache.stop()
+            self._show_wifi_devices()
+            return
+
+        self.bluetooth_cache.start()
+        self._show_bluetooth_devices()
+
+    def _show_bluetooth_devices(self):
+        """List the Bluetooth devices in the cache, most recently seen first"""
+        if self.send_method.get() != "Bluetooth":
+            return
         self.devices_list = []
-        self.device_listbox.delete(0, tk.END)
-        
-        # Show progress bar while scanning
-        self.progress_bar.pack(side="right", fill="x", expand=True, padx=(10, 0))
-        self.progress_bar.config(mode="indeterminate")
-        self.progress_bar.start()
-        
-        # Run device discovery in a thread
-        threading.Thread(target=self._refresh_devices_thread, daemon=True).start()
-    
-    def _refresh_devices_thread(self):
-        """Background thread to discover devices"""
-        method = self.send_method.get()
-        
-        try:
-            if method == "Wi-Fi":
-                # Use existing ipReceiver module
-                models = ipReceiver.get_devices_by_model(timeout=3)
-                self.devices_list = []
-                
-                for model in sorted(models.keys()):
-                    for device in models[model]:
-                        display_text = f"{device['name']} [{device['ip']}] - {ipReceiver.format_time_ago(device['last_seen'])}"
-                        self.devices_list.append({
-                            'display': display_text,
-                            'ip': device['ip'],
-                            'name': device['name'],
-                            'mac': device['mac'],
-                            'type': 'wifi'
-                        })
-            else:
-                # Use existing bluetooth_sender module
-                bt_devices = bluetooth_sender.discover_devices()
-                self.devices_list = []
-                
-                for addr, name in bt_devices:
-                    display_text = f"{name} [{addr}]"
-                    self.devices_list.append({
-                        'display': display_text,
-                        'addr': addr,
-                        'name': name,
-                        'type': 'bluetooth'
-                    })
-        except Exception as e:
-            self.root.after(0, lambda: self.log(f"Error discovering devices: {e}"))
-        
-        # Update UI in main thread
-        self.root.after(0, self._update_device_listbox)
-    
-    def _update_device_listbox(self):
-        """Update the device listbox with discovered devices"""
+        devices = sorted(self.bluetooth_cache.snapshot().values(),
+                         key=lambda device: device.get('last_seen', 0), reverse=True)
+        for device in devices:
+            name = device['name'] or device['addr']
+            display_text = f"{name} [{device['addr']}]"
+            if device.get('last_seen'):
+                display_text += f" - {ipReceiver.format_time_ago(device['last_seen'])}"
+            self.devices_list.append({
+                'display': display_text,
+                'addr': device['addr'],
+                'name': name,
+                'mac': device['addr'],
+                'type': 'bluetooth'
+            })
+        self._fill_device_listbox()
+        if self.sending:
+            return  # The status and progress bar show the sends until they are done
+        if self.bluetooth_cache.scanning:
+            self.status_label.config(text="Scanning for devices...")
+            self.progress_bar.pack(side="right", fill="x", expand=True, padx=(10, 0))
+            self.progress_bar.config(mode="indeterminate")
+            self.progress_bar.start()
+        else:
+            self.progress_bar.stop()
+            self.progress_bar.pack_forget()
+            self.status_label.config(text="Ready")
+
+    def _show_wifi_devices(self):
+        """List the Wi-Fi devices currently in the registry, keeping the selected one selected"""
+        if self.send_method.get() != "Wi-Fi":
+            return
+        self.devices_list = []
+        models = ipReceiver.group_by_model(self.device_registry.snapshot().values())
+        for model in sorted(models.keys()):
+            for device in models[model]:
+                display_text = f"{device['name']} [{device['ip']}] - {ipReceiver.format_time_ago(device['last_seen'])}"
+                self.devices_list.append({
+                    'display': display_text,
+                    'ip': device['ip'],
+                    'name': device['name'],
+                    'mac': device['mac'],
+                    'peer': device,  # What its beacon advertised, lets the sender skip asking
+                    'type': 'wifi'
+                })
+        self._fill_device_listbox()
+
+    def _fill_device_listbox(self):
+        """Show devices_list in the device listbox"""
         self.device_listbox.delete(0, tk.END)
         
         if not self.devices_list:
             self.device_listbox.insert(tk.END, "No devices found")
             self.device_listbox.config(state="disabled")
-        else:
-            self.device_listbox.config(state="normal")
-            for device in self.devices_list:
-                self.device_listbox.insert(tk.END, device['display'])
-        
-        # Stop progress bar
-        self.progress_bar.stop()
-        self.progress_bar.pack_forget()
-        self.status_label.config(text="Ready")
-    
+            return
+
+        self.device_listbox.config(state="normal")
+        selected_macs = {device.get('mac') for device in self.selected_devices} - {None}
+        selected = []
+        for index, device in enumerate(self.devices_list):
+            self.device_listbox.insert(tk.END, device['display'])
+            if device.get('mac') in selected_macs:
+                self.device_listbox.selection_set(index)
+                selected.append(device)  # Same device, maybe at a new IP
+        self.selected_devices = selected
+
     def on_device_select(self, event):
         """Handle device selection from listbox"""
         selection = self.device_listbox.curselection()
         if not selection or not self.devices_list:
-            self.selected_device = None
+            self.selected_devices = []
             return
-        
-        index = selection[0]
-        if 0 <= index < len(self.devices_list):
-            self.selected_device = self.devices_list[index]
-            device_name = self.selected_device.get('name', 'Unknown')
-            self.status_label.config(text=f"Selected: {device_name}")
+
+        self.selected_devices = [self.devices_list[index] for index in selection
+                                 if 0 <= index < len(self.devices_list)]
+        if self.sending or not self.selected_devices:
+            return
+        if len(self.selected_devices) == 1:
+            self.status_label.config(text=f"Selected: {self.selected_devices[0].get('name', 'Unknown')}")
+        else:
+            self.status_label.config(text=f"Selected: {len(self.selected_devices)} devices")
     
-    def update_progress(self, bytes_sent, total_size):
-        """Update progress bar during file transfer"""
-        if total_size > 0:
-            progress = (bytes_sent / total_size) * 100
+    def update_progress(self, sample):
+        """Update progress bar from a scheduler sample while sends run"""
+        if sample['total'] > 0:
+            progress = sample['fraction'] * 100
+            jobs = sample['jobs']
+            count = jobs['queued'] + jobs['active'] + jobs['done']
             self.progress_bar.config(value=progress)
-            self.status_label.config(text=f"Sending... {progress:.1f}%")
-            self.root.update_idletasks()
+            self.status_label.config(text=f"Sending ({jobs['done']}/{count} done)... {progress:.1f}%  "
+                                          f"{telemetry.format_rate(sample['smoothed_rate'])}  "
+                                          f"{telemetry.format_eta(sample['eta'])} left")
+
+    def _poll_progress(self):
+        """Show the progress of the queued sends PUBLISH_RATE times a second while they run"""
+        if not self.sending:
+            return
+        sample = self.send_scheduler.sample()
+        if sample:
+            self.update_progress(sample)
+        self.root.after(1000 // telemetry.PUBLISH_RATE, self._poll_progress)
     
     def send_file(self):
-        """Initiate file sending process"""
-        if self.sending:
-            return
-        
+        """Queue the picked files for every selected device; more can be queued while they are sent"""
         # Validate inputs
-        if not self.file_path.get():
+        paths = self._get_send_paths()
+        if not paths:
             messagebox.showerror("Error", "Please select a file to send")
             return
         
-        if not os.path.isfile(self.file_path.get()):
+        if not all(os.path.exists(path) for path in paths):
             messagebox.showerror("Error", "The selected file does not exist")
             return
+
+        if self.send_method.get() == "Bluetooth" and (len(paths) > 1 or not os.path.isfile(paths[0])):
+            messagebox.showerror("Error", "Bluetooth can only send a single file")
+            return
         
-        if not self.selected_device:
+        if not self.selected_devices:
             messagebox.showerror("Error", "Please select a device to send to")
             return
         
-        # Start sending
-        self.sending = True
-        self.send_button.config(state="disabled")
-        self.status_label.config(text="Connecting...")
-        self.progress_bar.config(mode="determinate", value=0)
-        self.progress_bar.pack(side="right", fill="x", expand=True, padx=(10, 0))
-        
-        # Run the transfer in a background thread
-        threading.Thread(target=self._send_file_thread, daemon=True).start()
+        for device in self.selected_devices:
+            # One RFCOMM link per Bluetooth device at a time
+            self.send_scheduler.submit(paths, device, peer=device.get('mac') or device.get('ip') or device.get('addr'),
+                                       peer_limit=1 if device['type'] == 'bluetooth' else None)
+        self.log(f"Queued {len(paths)} item(s) for {len(self.selected_devices)} device(s)")
+
+        if not self.sending:
+            self.sending = True
+            self.status_label.config(text="Connecting...")
+            self.progress_bar.config(mode="determinate", value=0)
+            self.progress_bar.pack(side="right", fill="x", expand=True, padx=(10, 0))
+            # The transfers only store their byte counts; the UI samples them at a fixed rate
+            self._poll_progress()
     
-    def _send_file_thread(self):
-        """Background thread to handle file sending"""
-        success = False
-        try:
-            method = self.send_method.get()
-            file_path = self.file_path.get()
-            
-            if method == "Wi-Fi" and self.selected_device['type'] == 'wifi':
-                # Use existing wlan_sender module
-                ip = self.selected_device['ip']
-                self.root.after(0, lambda: self.status_label.config(text=f"Connecting to {ip}..."))
-                success = wlan_sender.send_file_to_device(
+    def _send_job(self, job, progress_callback):
+        """
+        Send one queued job, on a scheduler worker thread
+        Returns: True if it was sent, False if it is worth trying again
+        Raises: scheduler.PermanentFailure if a file is gone or the receiver declined
+        """
+        device = job.device
+        paths = job.paths
+        if not all(os.path.exists(path) for path in paths):
+            raise scheduler.PermanentFailure("File not found")
+        sent = self._send_to_device(device, paths, progress_callback)
+        if sent is None:
+            raise scheduler.PermanentFailure("Declined")
+        return sent
+
+    def _send_to_device(self, device, paths, progress_callback):
+        """Returns: what the device type's sender returns, None if the receiver declined"""
+        file_path = paths[0]
+        if device['type'] == 'wifi':
+            # Use existing wlan_sender module
+            ip = device['ip']
+            self.log(f"Sending to {device['name']} [{ip}]...")
+            if len(paths) == 1 and os.path.isfile(file_path):
+                return wlan_sender.send_file_to_device(
                     ip, file_path, 
-                    progress_callback=lambda sent, total: self.root.after(0, lambda: self.update_progress(sent, total)),
-                    log_callback=lambda msg: self.root.after(0, lambda: self.log(msg))
+                    progress_callback=progress_callback,
+                    log_callback=self.log,
+                    peer=device.get('peer'),
+                    retries=0  # The queue retries with its own backoff; the receiver's journal still resumes
                 )
-            elif method == "Bluetooth" and self.selected_device['type'] == 'bluetooth':
-                # Use existing bluetooth_sender module
-                addr = self.selected_device['addr']
-                self.root.after(0, lambda: self.status_label.config(text=f"Connecting to {addr}..."))
-                success = bluetooth_sender.send_file_to_device(
+            # Several files or a folder go over one connection as a batch
+            return wlan_sender.send_files_to_device(
+                ip, paths,
+                progress_callback=progress_callback,
+                log_callback=self.log,
+                peer=device.get('peer'),
+                retries=0  # The queue retries; a broken batch starts over either way
+            )
+        if device['type'] == 'bluetooth':
+            # Use existing bluetooth_sender module
+            addr = device['addr']
+            self.log(f"Sending to {device['name']} [{addr}]...")
+            self.bluetooth_cache.pause()  # No inquiries while the transfer needs the radio
+            try:
+                return bluetooth_sender.send_file_to_device(
                     addr, file_path,
-                    progress_callback=lambda sent, total: self.root.after(0, lambda: self.update_progress(sent, total)),
-                    log_callback=lambda msg: self.root.after(0, lambda: self.log(msg))
+                    progress_callback=progress_callback,
+                    log_callback=self.log
                 )
-            else:
-                self.root.after(0, lambda: messagebox.showerror("Error", "Device type mismatch"))
-                return
-                
-            # Show result
-            if success:
-                self.root.after(0, lambda: messagebox.showinfo("Success", "File sent successfully"))
-            else:
-                self.root.after(0, lambda: messagebox.showerror("Error", "Failed to send file"))
-                
-        except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {str(e)}"))
-        finally:
-            # Reset UI state
-            self.root.after(0, self._reset_send_ui)
+            finally:
+                self.bluetooth_cache.resume()
+        raise scheduler.PermanentFailure("Device type mismatch")
+
+    def _job_finished(self, job):
+        """Log the outcome of one queued send"""
+        name = job.device.get('name', job.peer)
+        if job.state == scheduler.DONE:
+            self.log(f"Sent to {name}")
+        elif job.state == scheduler.QUEUED:
+            self.log(f"Sending to {name} failed ({job.error}), trying again "
+                     f"in {self.send_scheduler.retry_delays[job.attempts - 1]} s")
+        else:
+            self.log(f"Giving up sending to {name}: {job.error}")
+
+    def _send_queue_idle(self):
+        """Show the result once every queued send has finished"""
+        if not self.sending:
+            return
+        counts = self.send_scheduler.counts()
+        if counts[scheduler.QUEUED] or counts[scheduler.ACTIVE]:
+            return  # More was queued since; its own idle callback will report it all
+        failed = [f"{job.device.get('name', job.peer)} ({job.error})" for job in self.send_scheduler.jobs
+                  if job.state == scheduler.FAILED]
+        sent = counts[scheduler.DONE]
+        self.send_scheduler.clear_finished()
+        self._reset_send_ui()
+        if failed:
+            messagebox.showerror("Error", f"Failed to send to {', '.join(failed)}")
+        elif sent == 1:
+            messagebox.showinfo("Success", "File sent successfully")
+        elif sent:
+            messagebox.showinfo("Success", f"All {sent} sends finished")
     
     def _reset_send_ui(self):
         """Reset UI after send operation"""
         self.sending = False
-        self.send_button.config(state="normal")
         self.status_label.config(text="Ready")
         self.progress_bar.stop()
         self.progress_bar.pack_forget()
+        self._show_bluetooth_devices()  # Shows a scan that ran meanwhile, if Bluetooth is picked
     
     def start_background_broadcast(self):
-        print("DEBUG: start_background_broadcast function called")
+        logger.debug("start_background_broadcast function called")
         self.broadcast_stop_flag.clear() # So the broadcast can always start when this function is called
         """Start broadcasting system info in background"""
         def broadcast_loop():
             try:
                 ipBroadcast.start_broadcasting_loop(self.broadcast_stop_flag)
             except Exception as e:
-                print(f"Broadcast error: {e}")
+                logger.warning("Broadcast error: %s", e)
         
         self.broadcast_thread = threading.Thread(target=broadcast_loop, daemon=True)
         self.broadcast_thread.start()
 
     def stop_background_broadcast(self):
-        print("DEBUG: stop_background_broadcast function called")
+        logger.debug("stop_background_broadcast function called")
         self.broadcast_stop_flag.set()
         if hasattr(self, 'broadcast_thread') and self.broadcast_thread.is_alive():
             self.broadcast_thread.join(timeout=1)
@@ -433,6 +572,14 @@ class FileTransferApp:
         )
         return save_path if save_path else None
 
+    def gui_save_dir_callback(self, name, file_count, total_size):
+        """GUI callback for the folder dialog of a batch of files"""
+        save_dir = filedialog.askdirectory(
+            title=f"Save '{name}' ({file_count} files, {total_size / 1e6:.1f} MB) in:",
+            mustexist=True
+        )
+        return save_dir if save_dir else None
+
     def _run_receiver(self):
         """Run the appropriate receiver in a background thread"""
         
@@ -441,37 +588,36 @@ class FileTransferApp:
             method = self.receive_method.get()
             try:
                 if method == "Wi-Fi":
-                    # Use existing wlan_receiver module
-                    success = wlan_receiver.receive_file_blocking(
-                        host='0.0.0.0', 
+                    # One listener serves every sender until the receiver is stopped
+                    bound = wlan_receiver.serve_forever(
+                        host='0.0.0.0',
                         port=54321,
                         gui_callback=self.gui_save_callback,
-                        log_callback=lambda msg: self.root.after(0, lambda: self.log(msg)),
-                        stop_flag=self.receiver_stop_flag
+                        log_callback=self.log,
+                        stop_flag=self.receiver_stop_flag,
+                        dir_callback=self.gui_save_dir_callback
                     )
-                    if success:
-                        self.root.after(0, lambda: self.log("File received successfully - receiver still active"))
-                    # Continue the loop to keep receiving more files
+                    if not bound:
+                        time.sleep(1)  # Port still taken, try binding again
                 else:
-                    
-                    # Use existing bluetooth_receiver module
-                    success = bluetooth_receiver.start_receiver_blocking(
+                    # One advertised channel serves every sender until the receiver is stopped
+                    started = bluetooth_receiver.serve_forever(
                         gui_callback=self.gui_save_callback,
                         progress_callback=None,
-                        log_callback=lambda msg: self.root.after(0, lambda: self.log(msg))
+                        log_callback=self.log,
+                        stop_flag=self.receiver_stop_flag
                     )
-                    if success:
-                        self.root.after(0, lambda: self.log("File received successfully - receiver still active"))
-                    # Continue the loop to keep receiving more files
-                        
+                    if not started:
+                        time.sleep(1)  # Bluetooth off or busy, try again
+
             except Exception as e:
                 if self.receiving:  # Only log error if we're still supposed to be receiving
-                    self.root.after(0, lambda: self.log(f"Error in receiver: {e}"))
+                    self.log(f"Error in receiver: {e}")
                     # Brief pause before retrying
                     time.sleep(1)
         
         # Clean up when loop exits
-        self.root.after(0, lambda: self.log("Receiver stopped"))
+        self.log("Receiver stopped")
     
     def _get_local_ip(self):
         """Get local IP address"""
@@ -487,6 +633,10 @@ class FileTransferApp:
 
     def on_closing(self):
         """Handle application closing"""
+        self._unsubscribe_devices()
+        self._unsubscribe_bluetooth()
+        self.send_scheduler.cancel_pending()
+        self.bluetooth_cache.stop()
         self.broadcast_stop_flag.set()
         self.receiver_stop_flag.set()
         self.root.destroy()
@@ -500,4 +650,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Compression workers of the frozen build start through this executable
     main()
\ No newline at end of file
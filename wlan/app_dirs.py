@@ -0,0 +1,12 @@
+import os
+
+
+def state_dir(*parts):
+    """
+    Per-user directory for Quicksilver's persistent state, created on first use.
+    %APPDATA%\\Quicksilver on Windows, ~/.config/Quicksilver elsewhere.
+    """
+    base = os.environ.get("APPDATA") or os.path.join(os.path.expanduser("~"), ".config")
+    path = os.path.join(base, "Quicksilver", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
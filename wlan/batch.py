@@ -0,0 +1,173 @@
+"""
+Several files, or a whole directory, sent as one transfer.
+
+The sender announces the batch with a manifest of relative paths, sizes and
+modification times, then streams the files back to back over the same
+connection: a FILE frame names the manifest entry, DATA (or ZDATA) frames carry
+its bytes in order. Small files are packed into the send buffer together, so a
+folder of many small files costs about as much as one file of the same total size
+instead of one connection and one save dialog per file. The receiver writes
+each file as its bytes arrive and restores the modification times at the end.
+"""
+import os
+
+from . import protocol
+
+SMALL_FILE = 256 * 1024         # Files up to this size are read into the send buffer instead of sendfile
+SEND_BUFFER = 1024 * 1024       # Bytes of small files collected before one write
+ENTRIES_BATCH = 2048            # Manifest entries per ENTRIES frame
+
+
+def _entry(kind, path, st, source=None):
+    return {'kind': kind, 'size': st.st_size if kind == protocol.ENTRY_FILE else 0,
+            'mtime_ns': st.st_mtime_ns, 'path': path, 'source': source}
+
+
+def collect_entries(paths):
+    """
+    Manifest of the files and directories to send, in the order they are sent.
+    A directory contributes itself and everything under it, with paths relative
+    to its parent, so the receiver recreates it by name; a file contributes its name.
+    Returns: list of dicts with kind, size, mtime_ns, path ("/"-separated) and source (local path)
+    Raises: ValueError if two selected items would land on the same name
+    """
+    entries = []
+    names = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        name = os.path.basename(path.rstrip(os.sep)) or path
+        if name in names:
+            raise ValueError(f"Two selected items are both named {name}")
+        names.add(name)
+        if not os.path.isdir(path):
+            entries.append(_entry(protocol.ENTRY_FILE, name, os.stat(path), path))
+            continue
+
+        entries.append(_entry(protocol.ENTRY_DIR, name, os.stat(path)))
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, os.path.dirname(path)).replace(os.sep, "/")
+            for dirname in dirnames:
+                entries.append(_entry(protocol.ENTRY_DIR, f"{rel_dir}/{dirname}",
+                                      os.stat(os.path.join(dirpath, dirname))))
+            for filename in sorted(filenames):
+                source = os.path.join(dirpath, filename)
+                if os.path.isfile(source):  # Skips sockets, FIFOs and dangling links
+                    entries.append(_entry(protocol.ENTRY_FILE, f"{rel_dir}/{filename}", os.stat(source), source))
+    return entries
+
+
+def batch_name(paths):
+    """Returns: how the batch is called in the receiver's prompt"""
+    if len(paths) == 1:
+        return os.path.basename(os.path.abspath(paths[0]).rstrip(os.sep))
+    return f"{len(paths)} items"
+
+
+def resolve_entry_path(root, path):
+    """
+    Local path of a manifest entry under the destination root.
+    Raises: ValueError for paths that would escape root (absolute paths, "..", drive letters)
+    """
+    parts = path.split("/")
+    if not path or any(part in ("", ".", "..") or "\\" in part or ":" in part for part in parts):
+        raise ValueError(f"Refusing unsafe path in batch: {path!r}")
+    return os.path.join(root, *parts)
+
+
+class BatchWriter:
+    """
+    Writes the files of a batch under root as their bytes arrive, one at a time and
+    strictly in manifest order, then restores modification times with finish().
+    """
+
+    def __init__(self, root, entries):
+        self.root = root
+        self.entries = entries
+        self.paths = [resolve_entry_path(root, entry['path']) for entry in entries]
+        self.bytes_written = 0
+        self._index = -1
+        self._file = None
+        self._position = 0
+        self._directories = set()  # Directories known to exist, saves a makedirs per file
+
+    def create_directories(self):
+        os.makedirs(self.root, exist_ok=True)
+        self._directories.add(self.root)
+        for entry, path in zip(self.entries, self.paths):
+            if entry['kind'] == protocol.ENTRY_DIR:
+                os.makedirs(path, exist_ok=True)
+                self._directories.add(path)
+
+    def _next_file(self):
+        """Returns: index of the next file entry after the current one, or None after the last"""
+        for index in range(self._index + 1, len(self.entries)):
+            if self.entries[index]['kind'] == protocol.ENTRY_FILE:
+                return index
+        return None
+
+    def start_file(self, index):
+        """Close the current file and open entry index, which must be the next file of the manifest"""
+        expected = self._next_file()
+        if index != expected:
+            raise ValueError(f"Batch entry {index} arrived, expected {expected}")
+        self._close_file()
+        self._index = index
+        path = self.paths[index]
+        directory = os.path.dirname(path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        self._file = open(path, "wb")
+        self._position = 0
+
+    def check_range(self, offset, length):
+        """Raises: ValueError unless the range continues the current file within its announced size"""
+        if self._file is None or offset != self._position or offset + length > self.entries[self._index]['size']:
+            raise ValueError(f"Range {offset}+{length} does not continue batch entry {self._index}")
+
+    def write(self, offset, data):
+        self.check_range(offset, len(data))
+        self._file.write(data)
+        self._position += len(data)
+        self.bytes_written += len(data)
+
+    async def read_range(self, reader, offset, length, read_size):
+        """Copy length bytes from an asyncio StreamReader to the current file, read_size bytes at a time"""
+        self.check_range(offset, length)
+        while length:
+            data = await reader.read(min(read_size, length))
+            if not data:
+                raise ConnectionError("Stream closed in the middle of a range")
+            self._file.write(data)
+            self._position += len(data)
+            self.bytes_written += len(data)
+            length -= len(data)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        entry = self.entries[self._index]
+        if self._position != entry['size']:
+            raise ValueError(f"{entry['path']}: received {self._position} of {entry['size']} bytes")
+        os.utime(self.paths[self._index], ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+    def finish(self):
+        """Close the last file and check every file arrived. Returns: number of files written"""
+        self._close_file()
+        missing = self._next_file()
+        if missing is not None:
+            raise ValueError(f"{self.entries[missing]['path']} was not received")
+        # Deepest directories first, writing into a directory updates its mtime
+        for entry, path in sorted(zip(self.entries, self.paths), key=lambda item: -item[0]['path'].count("/")):
+            if entry['kind'] == protocol.ENTRY_DIR:
+                os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return sum(1 for entry in self.entries if entry['kind'] == protocol.ENTRY_FILE)
+
+    def close(self):
+        """Release the open file after a failed transfer"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
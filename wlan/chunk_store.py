@@ -0,0 +1,224 @@
+"""
+Content-addressed chunk store.
+
+Files are cut into variable-size chunks at content-defined boundaries, so the
+same data produces the same chunks even when it sits at a different offset
+(another file, or a new version with bytes inserted). Each chunk is named by
+its BLAKE2b hash. The receiver keeps recently seen chunks on disk, up to a size
+cap with least-recently-used eviction, and fills every chunk it already holds
+locally instead of receiving it again.
+"""
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+from collections import OrderedDict
+
+from . import app_dirs
+
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+ANCHOR_LEN = 6              # 6 symbols of 3 bits: a boundary roughly every 2**18 bytes past MIN_CHUNK
+MIN_CHUNKED_SIZE = 4 * MIN_CHUNK  # Smaller files are simply sent
+READ_SIZE = 8 * 1024 * 1024
+KEY_SIZE = 32
+STORE_LIMIT = 2 * 1024 * 1024 * 1024  # Bytes of chunks kept on disk
+
+# Boundaries are found without a per-byte Python loop: every byte is mapped to one
+# of 8 pseudo-random symbols with bytes.translate, then bytes.find looks for a fixed
+# symbol pattern. A boundary depends only on the ANCHOR_LEN bytes in front of it,
+# which is what makes it content-defined.
+_rng = random.Random(0x51534C56)
+_SYMBOL_TABLE = bytes(_rng.getrandbits(3) for _ in range(256))
+_ANCHOR = bytes(_rng.getrandbits(3) for _ in range(ANCHOR_LEN))
+
+
+def chunk_key(data):
+    return hashlib.blake2b(data, digest_size=KEY_SIZE).digest()
+
+
+def _next_boundary(symbols, start, available, eof):
+    """Returns: end offset of the chunk starting at start, or None if more data is needed"""
+    limit = min(available, start + MAX_CHUNK)
+    anchor = symbols.find(_ANCHOR, start + MIN_CHUNK - ANCHOR_LEN, limit)
+    if anchor >= 0:
+        return anchor + ANCHOR_LEN
+    if available >= start + MAX_CHUNK:
+        return start + MAX_CHUNK
+    if eof and available > start:
+        return available
+    return None
+
+
+def chunk_file(path):
+    """Yields: (length, key) for every chunk of the file, in file order"""
+    with open(path, "rb") as f:
+        buf = b""
+        symbols = b""
+        eof = False
+        while not eof:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf += data
+            symbols += data.translate(_SYMBOL_TABLE)
+            pos = 0
+            while (end := _next_boundary(symbols, pos, len(buf), eof)) is not None:
+                yield end - pos, chunk_key(memoryview(buf)[pos:end])
+                pos = end
+            buf = buf[pos:]
+            symbols = symbols[pos:]
+
+
+class ChunkStore:
+    """
+    Chunks on disk under root, one file per key. Reading a chunk marks it as
+    recently used; adding chunks evicts the least recently used ones once the
+    store holds more than limit bytes.
+    """
+
+    def __init__(self, root, limit=STORE_LIMIT):
+        self.root = root
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._chunks = OrderedDict()  # key -> size, least recently used first
+        self._size = 0
+        self._stats_path = os.path.join(root, "stats.json")
+        self.stats = {"hits": 0, "misses": 0, "bytes_avoided": 0, "bytes_received": 0}
+        self._load()
+
+    def _path(self, key):
+        name = key.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def _load(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if len(name) != KEY_SIZE * 2:
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                    entries.append((st.st_mtime, bytes.fromhex(name), st.st_size))
+                except (OSError, ValueError):
+                    continue
+        for _, key, size in sorted(entries):
+            self._chunks[key] = size
+            self._size += size
+        try:
+            with open(self._stats_path, "r") as f:
+                self.stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._chunks
+
+    def __len__(self):
+        with self._lock:
+            return len(self._chunks)
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def read(self, key):
+        """Returns: the chunk's bytes, or None if it is not here (or no longer matches its key)"""
+        with self._lock:
+            if key not in self._chunks:
+                return None
+            self._chunks.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if chunk_key(data) == key:
+                os.utime(path)  # Recency survives a restart through the mtime
+                return data
+        except OSError:
+            pass
+        self._discard(key)
+        return None
+
+    def add(self, key, data):
+        """Store a chunk whose key was already checked against data"""
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Concurrent transfers may store the same chunk: each writes its own temporary file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if key in self._chunks:  # Another transfer stored it meanwhile, with the same bytes
+                self._chunks.move_to_end(key)
+                return
+            self._chunks[key] = len(data)
+            self._size += len(data)
+            evicted = []
+            while self._size > self.limit and len(self._chunks) > 1:
+                old_key, old_size = self._chunks.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            self._remove_file(old_key)
+
+    def _discard(self, key):
+        with self._lock:
+            size = self._chunks.pop(key, None)
+            if size is not None:
+                self._size -= size
+        self._remove_file(key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def record_transfer(self, hits, bytes_avoided, misses, bytes_received):
+        """Add one transfer's outcome to the running totals kept next to the store"""
+        with self._lock:
+            self.stats["hits"] += hits
+            self.stats["misses"] += misses
+            self.stats["bytes_avoided"] += bytes_avoided
+            self.stats["bytes_received"] += bytes_received
+            stats = dict(self.stats)
+        try:
+            with open(self._stats_path, "w") as f:
+                json.dump(stats, f)
+        except OSError:
+            pass
+
+    @property
+    def hit_ratio(self):
+        with self._lock:
+            looked_up = self.stats["hits"] + self.stats["misses"]
+            return self.stats["hits"] / looked_up if looked_up else 0.0
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def default_store():
+    """Returns: the per-user chunk store, opened on first use"""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = ChunkStore(app_dirs.state_dir("chunks"))
+        return _default_store
@@ -0,0 +1,158 @@
+"""
+rsync-style delta encoding.
+
+The receiver splits its existing copy into fixed blocks and sends a weak
+(Adler-32) and strong (BLAKE2b) checksum per block. The sender slides a window
+over its file, rolling the weak checksum one byte at a time, and replaces every
+window whose checksums match a receiver block with a copy instruction. Whatever
+is left over is sent as literal data.
+"""
+import hashlib
+import math
+import zlib
+
+DELTA_SUFFIX = ".qsdelta"  # The new file is assembled here next to the old copy
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+SCAN_READ_SIZE = 8 * 1024 * 1024
+RESYNC_STRIDE = 16        # Blocks probed without rolling once a stretch has no matches
+MIN_RESYNC_BURST = 1024   # Bytes rolled between probe strides (at least block_size / 8)
+ADLER_MOD = 65521
+
+OP_COPY = 0     # (OP_COPY, dst_offset, src_offset, length)
+OP_LITERAL = 1  # (OP_LITERAL, dst_offset, length)
+
+
+def choose_block_size(size):
+    """Power of two near sqrt(size), like rsync, so signatures stay small for big files"""
+    if size <= 0:
+        return MIN_BLOCK_SIZE
+    block = 1 << round(math.log2(math.sqrt(size)))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def block_signatures(path, block_size):
+    """Yields: (weak, strong) for every full block of the file"""
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while f.readinto(view) == block_size:
+            yield zlib.adler32(view), strong_checksum(view)
+
+
+def build_table(signatures):
+    """signatures: iterable of (weak, strong) in block order. Returns: {weak: {strong: block_index}}"""
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def _roll(buf, i, stop, block_size, weak, table):
+    """
+    Roll the Adler-32 window at buf[i] forward one byte at a time up to stop.
+    Returns: index of the first window whose weak checksum is in table, or stop
+    """
+    a = weak & 0xffff
+    b = weak >> 16
+    while i < stop:
+        out_byte = buf[i]
+        a = (a - out_byte + buf[i + block_size]) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        i += 1
+        if a | (b << 16) in table:
+            break
+    return i
+
+
+def compute_delta(path, size, block_size, table, hasher=None):
+    """
+    Scan the file and yield OP_COPY / OP_LITERAL instructions that rebuild it
+    from the receiver's blocks. hasher: optional hashlib object fed every byte once.
+
+    Rolling byte by byte is slow in Python, so after a match the window rolls for
+    at most two blocks (enough to resync after an in-place change or an insertion
+    shorter than a block). Past that, the scan probes one block further at a time and rolls
+    a short burst every RESYNC_STRIDE blocks; each burst shifts the probe
+    alignment, so the scan still finds its way back after a long insertion
+    without paying per-byte cost across data that has no match at all.
+    """
+    burst = max(MIN_RESYNC_BURST, block_size // 8)
+    with open(path, "rb") as f:
+        buf = b""
+        buf_start = 0      # File offset of buf[0]
+        pos = 0            # File offset of the current window
+        literal_start = 0  # First byte not yet covered by an instruction
+        roll_budget = 2 * block_size
+        probes = 0
+
+        while pos + block_size <= size:
+            i = pos - buf_start
+            if i + block_size + 1 > len(buf) and buf_start + len(buf) < size:
+                # Keep the window plus the bytes ahead of it for rolling in memory
+                chunk = f.read(SCAN_READ_SIZE)
+                if hasher:
+                    hasher.update(chunk)
+                buf = buf[i:] + chunk
+                buf_start = pos
+                i = 0
+
+            window = buf[i:i + block_size]
+            weak = zlib.adler32(window)
+            candidates = table.get(weak)
+            block_index = candidates.get(strong_checksum(window)) if candidates else None
+            if block_index is not None:
+                if literal_start < pos:
+                    yield OP_LITERAL, literal_start, pos - literal_start
+                yield OP_COPY, pos, block_index * block_size, block_size
+                pos += block_size
+                literal_start = pos
+                roll_budget = 2 * block_size
+                probes = 0
+            elif roll_budget > 0:
+                stop = min(i + roll_budget, len(buf) - block_size, size - block_size - buf_start)
+                if stop <= i:
+                    pos += 1  # Last window of the file
+                    continue
+                new_i = _roll(buf, i, stop, block_size, weak, table)
+                roll_budget -= new_i - i
+                pos = buf_start + new_i
+            else:
+                pos += block_size
+                probes += 1
+                if probes >= RESYNC_STRIDE:
+                    roll_budget = burst
+                    probes = 0
+
+        if hasher:
+            # Whatever the scan did not need to look at still has to be hashed
+            while chunk := f.read(SCAN_READ_SIZE):
+                hasher.update(chunk)
+
+        if literal_start < size:
+            yield OP_LITERAL, literal_start, size - literal_start
+
+
+def coalesce(ops):
+    """Merge consecutive copies of consecutive blocks into one instruction"""
+    pending = None
+    for op in ops:
+        if op[0] == OP_COPY and pending is not None:
+            _, dst, src, length = pending
+            if op[1] == dst + length and op[2] == src + length:
+                pending = (OP_COPY, dst, src, length + op[3])
+                continue
+        if pending is not None:
+            yield pending
+            pending = None
+        if op[0] == OP_COPY:
+            pending = op
+        else:
+            yield op
+    if pending is not None:
+        yield pending
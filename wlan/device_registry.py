@@ -0,0 +1,145 @@
+"""
+Devices heard from on the LAN, kept up to date by a long-lived beacon listener
+(see ipReceiver.get_registry) instead of a fresh scan on every refresh.
+
+Devices are dicts with name, model, ip, mac, last_seen and ttl, plus whatever
+of discovery.CAPABILITIES the beacon advertised, indexed by MAC (the identity),
+IP and name. A device that stays silent for longer than its ttl, or says
+goodbye, is dropped. Readers take a snapshot, which is only rebuilt after a
+change, or subscribe to appear/update/disappear events.
+"""
+import logging
+import threading
+import time
+
+from . import discovery
+
+logger = logging.getLogger(__name__)
+
+DEVICE_TTL = 10.0  # Seconds without a beacon before a device is dropped (5 missed fixed 2 s beacons)
+
+EVENT_APPEAR = "appear"
+EVENT_UPDATE = "update"  # Name, model, IP or capabilities changed; a plain beacon only refreshes last_seen
+EVENT_DISAPPEAR = "disappear"
+
+FIELDS = ('name', 'model', 'ip', 'mac')
+COMPARED = FIELDS + discovery.CAPABILITIES  # A change in any of these is an EVENT_UPDATE
+
+
+class DeviceRegistry:
+    """Thread-safe: beacons arrive on the event loop, the UI reads from its own thread"""
+
+    def __init__(self, ttl=DEVICE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._devices = {}  # mac -> device; replaced on every beacon, never changed in place
+        self._by_ip = {}    # ip -> mac
+        self._by_name = {}  # name -> set of macs, names need not be unique
+        self._snapshot = None
+        self._subscribers = []
+
+    def update(self, info, now=None):
+        """
+        Record a beacon. info: dict with at least name, model, ip and mac, and
+        interval if the device says how long it may stay silent
+        Returns: EVENT_APPEAR, EVENT_UPDATE, or None if only last_seen changed
+        """
+        mac = info['mac'].lower()
+        device = {key: info[key] for key in FIELDS}
+        device['mac'] = mac
+        device.update((key, info[key]) for key in discovery.CAPABILITIES if key in info)
+        device['last_seen'] = time.time() if now is None else now
+        interval = info.get('interval')
+        device['ttl'] = max(self.ttl, discovery.beacon_ttl(interval)) if isinstance(interval, (int, float)) \
+            else self.ttl
+        with self._lock:
+            old = self._devices.get(mac)
+            self._devices[mac] = device
+            self._snapshot = None
+            if old is None:
+                event = EVENT_APPEAR
+            elif any(old.get(key) != device.get(key) for key in COMPARED):
+                event = EVENT_UPDATE
+                self._unindex(old)
+            else:
+                return None
+            self._by_ip[device['ip']] = mac
+            self._by_name.setdefault(device['name'], set()).add(mac)
+        self._notify(event, device)
+        return event
+
+    def remove(self, mac):
+        """Drop a device that said goodbye. Returns: the device, or None if it was not known"""
+        with self._lock:
+            device = self._devices.pop(mac.lower(), None)
+            if device is None:
+                return None
+            self._unindex(device)
+            self._snapshot = None
+        self._notify(EVENT_DISAPPEAR, device)
+        return device
+
+    def expire(self, now=None):
+        """Drop devices not heard from for their ttl. Returns: the dropped devices"""
+        now = time.time() if now is None else now
+        with self._lock:
+            dropped = [device for device in self._devices.values() if device['last_seen'] + device['ttl'] < now]
+            for device in dropped:
+                del self._devices[device['mac']]
+                self._unindex(device)
+            if dropped:
+                self._snapshot = None
+        for device in dropped:
+            self._notify(EVENT_DISAPPEAR, device)
+        return dropped
+
+    def snapshot(self):
+        """Returns: dict mac -> device of every known device; shared, do not modify"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot = dict(self._devices)
+        return snapshot
+
+    def get(self, mac):
+        return self._devices.get(mac.lower())
+
+    def find_ip(self, ip):
+        """Returns: the device currently at ip, or None"""
+        mac = self._by_ip.get(ip)
+        return self._devices.get(mac) if mac else None
+
+    def find_name(self, name):
+        """Returns: list of devices called name"""
+        with self._lock:
+            return [self._devices[mac] for mac in self._by_name.get(name, ())]
+
+    def subscribe(self, callback):
+        """
+        callback: function(event, device), called from the thread that recorded the change
+        Returns: function that unsubscribes callback again
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def _unindex(self, device):
+        if self._by_ip.get(device['ip']) == device['mac']:
+            del self._by_ip[device['ip']]
+        macs = self._by_name.get(device['name'])
+        if macs:
+            macs.discard(device['mac'])
+            if not macs:
+                del self._by_name[device['name']]
+
+    def _notify(self, event, device):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, device)
+            except Exception as e:
+                logger.warning("Device registry subscriber failed: %s", e)
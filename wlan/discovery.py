@@ -0,0 +1,183 @@
+"""
+How devices find each other on the LAN, shared by ipBroadcast (advertising)
+and ipReceiver (listening).
+
+A device that receives files broadcasts a beacon on BEACON_PORT. Beacons
+start every BEACON_MIN seconds and back off exponentially to BEACON_MAX
+while nothing about the device changes, so a quiet LAN carries little
+discovery traffic. A scanner that wants the full list right away broadcasts
+one probe on PROBE_PORT. Every advertising device answers it within
+PROBE_JITTER seconds, spread at random so the replies do not arrive in one
+burst, with its beacon sent straight to the scanner. A device that stops
+advertising sends a goodbye beacon, and one that vanishes is dropped once it
+has been silent for beacon_ttl().
+
+Beacons are binary (BEACON below): a fixed part with the address and what
+the receiver supports, so a sender can pick its transfer parameters before
+connecting, followed by the name and model. Newer versions only append
+fields, so older listeners read the part they know and ignore the rest.
+Listeners still accept the JSON beacons of older versions, and a device whose
+MAC cannot be packed falls back to sending JSON.
+"""
+import json
+import random
+import socket
+import struct
+import time
+
+BEACON_PORT = 12345  # Beacons and probe replies, ipReceiver listens here
+PROBE_PORT = 12346   # Probes, advertising devices listen here
+BEACON_MIN = 2.0     # Seconds between beacons after a start or change
+BEACON_MAX = 30.0    # Longest gap between beacons once nothing changes
+PROBE_JITTER = 0.1   # Replies to a probe are spread over this many seconds
+PROBE_REPLY_INTERVAL = 1.0  # A device answers one scanner at most this often
+
+PROBE_MESSAGE = json.dumps({'probe': 1}).encode()
+
+BEACON_MAGIC = b"QSB"
+BEACON_VERSION = 1
+# magic, version, flags, ip, mac, transfer port, protocol version, codec mask, feature mask,
+# max streams, max interval (s), free space (MiB), followed by name and model (length byte + UTF-8)
+BEACON = struct.Struct("!3sBB4s6sHBBIBBI")
+NAME_LENGTH = struct.Struct("!B")
+BEACON_BYE = 1 << 0  # flags: the device stops advertising
+CAPABILITIES = ('port', 'version', 'codecs', 'features', 'max_streams', 'free_space')
+DECODE_CACHE = 4096  # Decoded beacons kept, a device sends the same bytes until something changes
+
+
+def beacon_ttl(max_interval=BEACON_MAX):
+    """Returns: seconds of silence after which a device beaconing at most every max_interval is gone"""
+    return 2 * max_interval + BEACON_MIN
+
+
+def is_probe(data):
+    return data == PROBE_MESSAGE
+
+
+class BeaconSchedule:
+    """Beacon interval that doubles while nothing changes, and drops back to the minimum on a change"""
+
+    def __init__(self, min_interval=BEACON_MIN, max_interval=BEACON_MAX):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    def next_interval(self, changed):
+        """changed: whether the beacon just sent differs from the one before. Returns: seconds to wait"""
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
+
+
+class ReplyLimiter:
+    """Lets a device answer each scanner at most once per interval, so a probe flood cannot amplify"""
+
+    def __init__(self, interval=PROBE_REPLY_INTERVAL, capacity=4096):
+        self.interval = interval
+        self.capacity = capacity
+        self._last = {}  # scanner address -> time of the last reply
+
+    def allow(self, address, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self._last.get(address, -self.interval) < self.interval:
+            return False
+        if len(self._last) >= self.capacity:
+            self._last = {a: t for a, t in self._last.items() if now - t < self.interval}
+        self._last[address] = now
+        return True
+
+
+def reply_delay():
+    """Returns: seconds to wait before answering a probe"""
+    return random.uniform(0, PROBE_JITTER)
+
+
+def _pack_text(text):
+    data = text.encode("utf-8")[:255]
+    return NAME_LENGTH.pack(len(data)) + data
+
+
+def encode_beacon(info, bye=False):
+    """
+    info: dict with name, model, ip and mac, and optionally interval and the CAPABILITIES
+    Returns: the binary beacon, or a JSON one if the ip or mac cannot be packed
+    """
+    try:
+        ip = socket.inet_pton(socket.AF_INET, info['ip'])
+        mac = bytes.fromhex(info['mac'].replace(':', '').replace('-', ''))
+        if len(mac) != 6:
+            raise ValueError(info['mac'])
+    except (OSError, ValueError):
+        fields = {key: info[key] for key in ('name', 'model', 'ip', 'mac')}
+        if bye:
+            fields['bye'] = True
+        else:
+            fields.update((key, info[key]) for key in ('interval',) + CAPABILITIES if key in info)
+        return json.dumps(fields).encode()
+    return BEACON.pack(BEACON_MAGIC, BEACON_VERSION, BEACON_BYE if bye else 0, ip, mac,
+                       info.get('port', 0), info.get('version', 0), info.get('codecs', 0),
+                       info.get('features', 0), info.get('max_streams', 1),
+                       min(255, int(info.get('interval', BEACON_MIN))),
+                       min(0xFFFFFFFF, info.get('free_space', 0) >> 20)) \
+        + _pack_text(info['name']) + _pack_text(info['model'])
+
+
+def _decode_binary(data):
+    (_, version, flags, ip, mac, port, protocol_version, codecs, features, max_streams, interval,
+     free_mib) = BEACON.unpack_from(data)
+    name_end = BEACON.size + 1 + data[BEACON.size]
+    model_end = name_end + 1 + data[name_end]
+    if model_end > len(data):
+        raise ValueError("Truncated beacon")
+    info = {
+        'name': data[BEACON.size + 1:name_end].decode("utf-8", "replace"),
+        'model': data[name_end + 1:model_end].decode("utf-8", "replace"),
+        'ip': socket.inet_ntoa(ip),
+        'mac': mac.hex(':'),
+        'port': port,
+        'version': protocol_version,
+        'codecs': codecs,
+        'features': features,
+        'max_streams': max_streams,
+        'interval': interval,
+        'free_space': free_mib << 20,
+    }
+    if flags & BEACON_BYE:
+        info['bye'] = True
+    return info
+
+
+def _decode_json(data):
+    info = json.loads(data.decode())
+    if not isinstance(info, dict):
+        return None
+    return {k.lower(): v for k, v in info.items()}  # Older versions were not consistent about case
+
+
+_decoded = {}  # beacon bytes -> decoded dict
+
+
+def decode_beacon(data):
+    """
+    Parse a binary beacon, or a JSON one from an older version.
+    Returns: dict with name, model, ip and mac, plus interval and the CAPABILITIES
+    the beacon carries, or bye; None if data is no beacon. Shared, do not modify.
+    """
+    info = _decoded.get(data)
+    if info is not None:
+        return info
+    try:
+        if data[:3] == BEACON_MAGIC:
+            info = _decode_binary(data)
+        else:
+            info = _decode_json(data)
+    except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+        return None
+    if info is None:
+        return None
+    if len(_decoded) >= DECODE_CACHE:
+        _decoded.clear()
+    _decoded[bytes(data)] = info
+    return info
@@ -0,0 +1,127 @@
+"""
+The asyncio event loop that Wi-Fi transfers and discovery run on.
+
+Sending, receiving and scanning for devices are coroutines. Any number of them
+share one loop on one background thread, instead of a thread each plus socket
+timeouts polled every second to notice a stop request: stopping is cancelling
+the coroutine. Blocking work inside them (hashing, chunking, reading the chunk
+store, fsync) goes to worker threads with asyncio.to_thread.
+
+Code that is not async (the Tk UI, the CLIs) calls the coroutines through
+Engine.run(), which waits for the result and cancels the coroutine once the
+caller's stop flag is set.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import threading
+
+STOP_POLL = 0.1  # Seconds between checks of a caller's stop flag in Engine.run
+THREAD_BATCH = 64  # Items produced per worker thread hop by iterate_in_thread
+
+
+class Engine:
+    """An event loop running on its own daemon thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="quicksilver-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Start coro on the loop. Returns: a concurrent.futures.Future of its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, stop_flag=None):
+        """
+        Run coro on the loop and wait for it to finish.
+        stop_flag: threading.Event or similar; once set, coro is cancelled and
+                   run() returns after its cleanup has finished
+        Returns: the result of coro
+        Raises: what coro raised, asyncio.CancelledError if it was stopped
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Engine.run() called from the engine's own loop, await the coroutine instead")
+        result = concurrent.futures.Future()
+        started = concurrent.futures.Future()
+
+        def finished(task):
+            if task.cancelled():
+                result.set_exception(asyncio.CancelledError())
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        def start():
+            task = self.loop.create_task(coro)
+            task.add_done_callback(finished)
+            started.set_result(task)
+
+        self.loop.call_soon_threadsafe(start)
+        task = started.result()
+        while True:
+            try:
+                return result.result(timeout=STOP_POLL if stop_flag else None)
+            except concurrent.futures.TimeoutError:
+                if stop_flag.is_set():
+                    self.loop.call_soon_threadsafe(task.cancel)
+                    stop_flag = None  # Wait for the cancelled coroutine to clean up
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Returns: the engine shared by every transfer and scan, started on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine()
+        return _engine
+
+
+def run(coro, stop_flag=None):
+    """Run coro on the shared engine, see Engine.run"""
+    return get_engine().run(coro, stop_flag)
+
+
+class IdleTimeout:
+    """
+    asyncio.timeout() measured from the last sign of progress: the task gets a
+    TimeoutError once touch() has not been called for seconds. pause() stops the
+    clock, e.g. while the receiver's user picks a save location, touch() restarts it.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._timeout = None
+
+    async def __aenter__(self):
+        self._timeout = asyncio.timeout(self.seconds)
+        await self._timeout.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._timeout.__aexit__(exc_type, exc, tb)
+
+    def touch(self):
+        self._timeout.reschedule(asyncio.get_running_loop().time() + self.seconds)
+
+    def pause(self):
+        self._timeout.reschedule(None)
+
+
+async def iterate_in_thread(iterable, batch_size=THREAD_BATCH):
+    """
+    Async iterator over a blocking one (e.g. a generator hashing a file), which
+    is advanced in a worker thread batch_size items at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        items = await asyncio.to_thread(lambda: list(itertools.islice(iterator, batch_size)))
+        if not items:
+            return
+        for item in items:
+            yield item
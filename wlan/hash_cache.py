@@ -0,0 +1,169 @@
+"""
+On-disk cache of what the sender computes by reading a whole file: the leaf
+digests of integrity.py and the chunk manifest of chunk_store.py.
+
+Entries are keyed by the file's path and what was computed ("kind"), and are
+only valid while the file's inode, size and modification time are the ones
+they were computed for, so sending an unchanged file again reads none of it.
+The index is an SQLite database in WAL mode under app_dirs.state_dir("hashes"):
+several processes can read it while one writes. Entries whose file changed
+are dropped when looked up, and prune() evicts the least recently used ones
+past MAX_AGE or MAX_BYTES. Any database error only means a cache miss.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import app_dirs, chunk_store, integrity, protocol
+
+logger = logging.getLogger(__name__)
+
+ENABLED = True  # Off: hash every file on every send
+MAX_AGE = 30 * 24 * 3600.0  # Seconds an entry stays without being used
+MAX_BYTES = 256 * 1024 * 1024  # Digest bytes kept in total
+BUSY_TIMEOUT = 2.0  # Seconds to wait for another process's write before treating the cache as missing
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (path, kind)
+)
+"""
+
+
+def _identity(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _normalize(file_path):
+    return os.path.normcase(os.path.abspath(file_path))
+
+
+class HashCache:
+    """Thread-safe; one connection per instance, shared by the threads that hash files"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(_SCHEMA)
+
+    def get(self, file_path, kind, st):
+        """
+        st: os.stat() of the file now
+        Returns: the data stored for this version of the file, or None
+        """
+        path = _normalize(file_path)
+        with self._lock:
+            row = self._db.execute("SELECT inode, size, mtime_ns, data FROM entries WHERE path = ? AND kind = ?",
+                                   (path, kind)).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != _identity(st):
+                self._db.execute("DELETE FROM entries WHERE path = ? AND kind = ?", (path, kind))
+                return None
+            self._db.execute("UPDATE entries SET used = ? WHERE path = ? AND kind = ?", (time.time(), path, kind))
+            return row[3]
+
+    def put(self, file_path, kind, st, data):
+        """Store data computed from the file as it was at st, unless it changed since"""
+        try:
+            if _identity(os.stat(file_path)) != _identity(st):
+                return
+        except OSError:
+            return
+        inode, size, mtime_ns = _identity(st)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (_normalize(file_path), kind, inode, size, mtime_ns, bytes(data), time.time()))
+
+    def prune(self, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        """Evict entries unused for max_age seconds, then the least recently used past max_bytes"""
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE used < ?", (time.time() - max_age,))
+            total = 0
+            for path, kind, length in self._db.execute(
+                    "SELECT path, kind, length(data) FROM entries ORDER BY used DESC").fetchall():
+                total += length
+                if total > max_bytes:
+                    self._db.execute("DELETE FROM entries WHERE path = ? AND kind = ?", (path, kind))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def cached(file_path, kind, compute, encode, decode, cache=None):
+    """
+    Generator of what compute() yields for the file, taken from the cache while
+    the file is unchanged and stored there once compute() has run to the end.
+    Blocking, like compute().
+    encode: function(entry) -> bytes; decode: function(bytes) -> iterable of entries
+    cache: HashCache, default_cache() if None
+    """
+    cache = cache or default_cache()
+    st = os.stat(file_path)
+    if cache is not None:
+        try:
+            data = cache.get(file_path, kind, st)
+        except sqlite3.Error as e:
+            logger.debug("Hash cache lookup failed: %s", e)
+            data = None
+        if data is not None:
+            yield from decode(data)
+            return
+
+    data = bytearray()
+    for entry in compute():
+        data += encode(entry)
+        yield entry
+    if cache is not None:
+        try:
+            cache.put(file_path, kind, st, data)
+        except sqlite3.Error as e:
+            logger.debug("Hash cache update failed: %s", e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns: the cache shared by this process, pruned when first opened, or None if off or unusable"""
+    global _cache
+    if not ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = HashCache(os.path.join(app_dirs.state_dir("hashes"), "hashes.sqlite3"))
+                _cache.prune()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Cannot open the hash cache, files will be hashed every time: %s", e)
+                _cache = False
+        return _cache or None
+
+
+def leaf_hashes(path, filesize, leaf_size=integrity.LEAF_SIZE, cache=None):
+    """integrity.leaf_hashes(), cached"""
+    if os.stat(path).st_size != filesize:
+        return integrity.leaf_hashes(path, filesize, leaf_size)  # Changed since it was offered; fails while hashing
+    size = integrity.DIGEST_SIZE
+    return cached(path, f"leaves/{leaf_size}", lambda: integrity.leaf_hashes(path, filesize, leaf_size), bytes,
+                  lambda data: (data[pos:pos + size] for pos in range(0, len(data), size)), cache)
+
+
+def chunk_file(path, cache=None):
+    """chunk_store.chunk_file(), cached"""
+    kind = f"chunks/{chunk_store.MIN_CHUNK}-{chunk_store.MAX_CHUNK}-{chunk_store.ANCHOR_LEN}"
+    return cached(path, kind, lambda: chunk_store.chunk_file(path), lambda entry: protocol.MANIFEST_ENTRY.pack(*entry),
+                  protocol.decode_manifest, cache)
@@ -0,0 +1,154 @@
+"""
+Chunk-level integrity checks for Wi-Fi transfers (FEATURE_VERIFY).
+
+The file is cut into leaves of LEAF_SIZE bytes, each hashed with BLAKE2b in
+its tree mode (hashlib's fanout/depth/node parameters), and the root hashes
+the leaf digests in order. The sender hashes the file in a worker thread
+while it is being sent and passes the leaf digests along in HASHES frames;
+the root goes in the DONE frame. The receiver reads every leaf back once all
+of it arrived and its digest is known, again in a worker thread, so a bad
+leaf is found while the rest is still coming in. At the end it asks for
+exactly the leaves that failed (REPAIR) instead of failing the whole file.
+"""
+import asyncio
+import hashlib
+
+from .journal import RangeSet
+
+LEAF_SIZE = 1024 * 1024  # Bytes per leaf: what one corrupt spot costs to send again
+MIN_LEAF_SIZE = 64 * 1024
+MAX_LEAF_SIZE = 16 * 1024 * 1024
+DIGEST_SIZE = 32
+VERIFY_BATCH = 8  # Leaves the receiver checks per worker thread hop
+
+# Leaf states on the receiver
+_PENDING = 0   # Not all of it arrived yet
+_COMPLETE = 1  # Arrived, its digest has not
+_QUEUED = 2    # Waiting to be read back and checked
+_VERIFIED = 3
+_FAILED = 4
+
+
+def leaf_count(filesize, leaf_size=LEAF_SIZE):
+    return (filesize + leaf_size - 1) // leaf_size
+
+
+def leaf_hash(data, index, last, leaf_size=LEAF_SIZE):
+    """Returns: digest of leaf index of the tree, last: it is the file's final leaf"""
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE, fanout=0, depth=2, leaf_size=leaf_size,
+                           node_offset=index, node_depth=0, inner_size=DIGEST_SIZE, last_node=last).digest()
+
+
+def root_hash(leaves, leaf_size=LEAF_SIZE):
+    """Returns: digest of the tree over the leaf digests, in order"""
+    return hashlib.blake2b(b"".join(leaves), digest_size=DIGEST_SIZE, fanout=0, depth=2, leaf_size=leaf_size,
+                           node_offset=0, node_depth=1, inner_size=DIGEST_SIZE, last_node=True).digest()
+
+
+def leaf_hashes(path, filesize, leaf_size=LEAF_SIZE):
+    """Generator of the leaf digests of the file at path, reading it sequentially. Blocking."""
+    count = leaf_count(filesize, leaf_size)
+    buf = bytearray(leaf_size)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        for index in range(count):
+            n = f.readinto(buf)
+            if n < min(leaf_size, filesize - index * leaf_size):
+                raise EOFError(f"File shrank while hashing (offset {index * leaf_size + n})")
+            yield leaf_hash(view[:n], index, index == count - 1, leaf_size)
+
+
+class ChunkVerifier:
+    """
+    Receiver side: checks every leaf of a file being received against the
+    sender's digests. Used from the event loop; the reading and hashing runs
+    in worker threads.
+    """
+
+    def __init__(self, path, filesize, leaf_size=LEAF_SIZE):
+        self.path = path
+        self.filesize = filesize
+        self.leaf_size = leaf_size
+        self.count = leaf_count(filesize, leaf_size)
+        self.leaves = [None] * self.count  # Digests from the sender
+        self.verified = 0
+        self._state = bytearray(self.count)
+        self._queue = []
+        self._task = None
+
+    def _bounds(self, index):
+        start = index * self.leaf_size
+        return start, min(start + self.leaf_size, self.filesize)
+
+    def range_completed(self, start, end, received):
+        """Note that [start, end) arrived. received: RangeSet of everything that has"""
+        if end <= start:
+            return
+        for index in range(start // self.leaf_size, leaf_count(end, self.leaf_size)):
+            if self._state[index] == _PENDING and received.covers(*self._bounds(index)):
+                self._state[index] = _COMPLETE
+                if self.leaves[index] is not None:
+                    self._enqueue(index)
+
+    def add_leaves(self, first, digests):
+        """Digests of the leaves from index first on, as sent in a HASHES frame"""
+        if first + len(digests) > self.count or any(len(digest) != DIGEST_SIZE for digest in digests):
+            raise ValueError(f"Leaf hashes {first}+{len(digests)} do not fit the announced file")
+        for index, digest in enumerate(digests, first):
+            self.leaves[index] = digest
+            if self._state[index] == _COMPLETE:
+                self._enqueue(index)
+
+    def _enqueue(self, index):
+        self._state[index] = _QUEUED
+        self._queue.append(index)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._queue:
+            batch, self._queue = self._queue[:VERIFY_BATCH], self._queue[VERIFY_BATCH:]
+            digests = await asyncio.to_thread(self._hash_leaves, batch)
+            for index, digest in zip(batch, digests):
+                if self._state[index] != _QUEUED:
+                    continue
+                if digest == self.leaves[index]:
+                    self._state[index] = _VERIFIED
+                    self.verified += 1
+                else:
+                    self._state[index] = _FAILED
+
+    def _hash_leaves(self, indexes):
+        digests = []
+        with open(self.path, "rb") as f:
+            for index in indexes:
+                start, end = self._bounds(index)
+                f.seek(start)
+                digests.append(leaf_hash(f.read(end - start), index, index == self.count - 1, self.leaf_size))
+        return digests
+
+    async def settle(self):
+        """Wait until every leaf queued so far has been checked"""
+        while self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    def problem(self, root):
+        """Returns: why the leaf digests cannot be trusted, None if they are all here and add up to root"""
+        if any(digest is None for digest in self.leaves):
+            return "Leaf hashes missing"
+        if root_hash(self.leaves, self.leaf_size) != root:
+            return "Leaf hashes do not match the root hash"
+        return None
+
+    def take_failed(self):
+        """Returns: (start, end) ranges of the leaves that failed, which count as not received again"""
+        failed = RangeSet()
+        for index, state in enumerate(self._state):
+            if state == _FAILED:
+                self._state[index] = _PENDING
+                failed.add(*self._bounds(index))
+        return list(failed)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
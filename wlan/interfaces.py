@@ -0,0 +1,131 @@
+"""
+Network interfaces of this machine, read in-process.
+
+On Linux the interface list comes from socket.if_nameindex() and each
+interface's flags, IPv4 address, netmask and broadcast address from ioctl
+calls on a UDP socket, with the MAC address from /sys/class/net. That is a
+handful of system calls, no subprocess. Elsewhere there is no native path
+here yet and the caller falls back to its own enumeration (ipconfig on
+Windows), which InterfaceCache then only repeats when something changed.
+"""
+import ipaddress
+import socket
+import struct
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+HAVE_NATIVE = fcntl is not None and sys.platform.startswith("linux")
+REFRESH_INTERVAL = 30.0  # Seconds a cached list is trusted even if the interface set looks the same
+
+# ioctl requests and interface flags from <linux/sockios.h> and <net/if.h>
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891B
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFREQ = struct.Struct("16s16s")  # ifr_name, then the ifr_ifru union (a sockaddr_in for addresses)
+
+
+def is_lan_address(ip):
+    """Returns: True for a private IPv4 address another device on the LAN can reach"""
+    try:
+        address = ipaddress.IPv4Address(ip)
+    except ValueError:
+        return False
+    return address.is_private and not address.is_loopback and not address.is_link_local
+
+
+def _ioctl_address(sock, request, name):
+    """Returns: the IPv4 address an ioctl reports for interface name"""
+    result = fcntl.ioctl(sock.fileno(), request, IFREQ.pack(name.encode(), b""))
+    return socket.inet_ntoa(result[20:24])  # sin_addr, after the name, sin_family and sin_port
+
+
+def _read_mac(name):
+    try:
+        with open(f"/sys/class/net/{name}/address") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def enumerate_native():
+    """
+    List the interfaces that are up and have a LAN IPv4 address (Linux only).
+    Returns: list of dicts with name, ip, netmask, broadcast and mac
+    """
+    found = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            try:
+                result = fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, IFREQ.pack(name.encode(), b""))
+                flags = struct.unpack_from("H", result, 16)[0]
+                if not flags & IFF_UP or flags & IFF_LOOPBACK:
+                    continue
+                ip = _ioctl_address(sock, SIOCGIFADDR, name)
+                if not is_lan_address(ip):
+                    continue
+                netmask = _ioctl_address(sock, SIOCGIFNETMASK, name)
+                try:
+                    broadcast = _ioctl_address(sock, SIOCGIFBRDADDR, name)
+                except OSError:
+                    broadcast = None
+                if not broadcast or broadcast == "0.0.0.0":
+                    broadcast = str(ipaddress.IPv4Network(f"{ip}/{netmask}", strict=False).broadcast_address)
+            except OSError:
+                continue  # No IPv4 address, or the interface went away meanwhile
+            mac = _read_mac(name)
+            if mac and mac != "00:00:00:00:00:00":
+                found.append({'name': name, 'ip': ip, 'netmask': netmask, 'broadcast': broadcast, 'mac': mac})
+    return found
+
+
+def broadcast_addresses():
+    """Returns: the broadcast address of every LAN interface, or the limited broadcast address where unknown"""
+    if HAVE_NATIVE:
+        addresses = sorted({adapter['broadcast'] for adapter in enumerate_native()})
+        if addresses:
+            return addresses
+    return ["255.255.255.255"]
+
+
+def fingerprint():
+    """Returns: a cheap summary of the interface set, which changes when interfaces come or go"""
+    try:
+        return tuple(socket.if_nameindex())
+    except (OSError, AttributeError):
+        return ()
+
+
+class InterfaceCache:
+    """
+    The result of an enumeration function, re-run only when the interface set
+    changed or REFRESH_INTERVAL passed (e.g. for an address renewed over DHCP).
+    """
+
+    def __init__(self, enumerate=enumerate_native, refresh_interval=REFRESH_INTERVAL):
+        self.enumerate = enumerate
+        self.refresh_interval = refresh_interval
+        self.value = None
+        self._fingerprint = None
+        self._refreshed = 0.0
+
+    def get(self):
+        """Returns: (current result, whether it differs from the one returned before)"""
+        current = fingerprint()
+        now = time.monotonic()
+        if self.value is not None and current == self._fingerprint \
+                and now - self._refreshed < self.refresh_interval:
+            return self.value, False
+        value = self.enumerate()
+        self._fingerprint = current
+        self._refreshed = now
+        changed = value != self.value
+        self.value = value
+        return value, changed
@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import time
 import os
@@ -5,7 +6,16 @@ import platform
 import sys
 import ipaddress
 import json
+import logging
 import re
+import shutil
+
+from common import compression, log_sink
+from . import discovery, engine, interfaces, parallel, protocol
+
+logger = logging.getLogger(__name__)
+
+FREE_SPACE_STEP = 1 << 30  # Free space changes smaller than this are not worth a new beacon
 
 def is_valid_json(s):
     try:
@@ -19,7 +29,7 @@ def extract_ip(message):
         system_info = json.loads(message)  
         return system_info.get("ip")  
     except json.JSONDecodeError:
-        print("Error: Invalid JSON format in message.")
+        logger.warning("Invalid JSON format in message")
         return None
 
 def auto_start():
@@ -45,7 +55,7 @@ def get_all_system_info():
     try:
         # Get ipconfig output
         ipconfig_output = os.popen("ipconfig /all").read()
-        print("DEBUG: ipconfig output length:", len(ipconfig_output))  # Debug line
+        logger.debug("ipconfig output length: %d", len(ipconfig_output))
         
         # Split into sections by adapter
         sections = re.split(r'\n(?=\w)', ipconfig_output)
@@ -74,7 +84,7 @@ def get_all_system_info():
                             potential_ip.startswith('10.') or 
                             potential_ip.startswith('172.')):
                             ip_address = potential_ip
-                            print(f"DEBUG: Found IP: {ip_address}")  # Debug line
+                            logger.debug("Found IP: %s", ip_address)
                 
                 # Look for MAC address - support both English and Chinese
                 # English: "Physical Address" Chinese: "物理地址"
@@ -82,7 +92,7 @@ def get_all_system_info():
                     mac_match = re.search(r'([0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}', line)
                     if mac_match:
                         mac_address = mac_match.group(0)
-                        print(f"DEBUG: Found MAC: {mac_address}")  # Debug line
+                        logger.debug("Found MAC: %s", mac_address)
             
             # If we found both IP and MAC for this adapter, add it
             if ip_address and mac_address:
@@ -92,12 +102,12 @@ def get_all_system_info():
                     'ip': ip_address,
                     'mac': mac_address
                 })
-                print(f"DEBUG: Added adapter - IP: {ip_address}, MAC: {mac_address}")
+                logger.debug("Added adapter - IP: %s, MAC: %s", ip_address, mac_address)
     
     except Exception as e:
-        print(f"DEBUG: Error in get_all_system_info: {e}")
+        logger.debug("Error in get_all_system_info: %s", e)
     
-    print(f"DEBUG: Found {len(system_info_list)} valid adapters")
+    logger.debug("Found %d valid adapters", len(system_info_list))
     return system_info_list
 
 def get_all_system_info_english():
@@ -109,7 +119,7 @@ def get_all_system_info_english():
     try:
         # Try to force English output
         ipconfig_output = os.popen("chcp 437 && ipconfig /all").read()
-        print("DEBUG: English ipconfig output length:", len(ipconfig_output))
+        logger.debug("English ipconfig output length: %d", len(ipconfig_output))
         
         # Split into sections by adapter
         sections = re.split(r'\n(?=\w)', ipconfig_output)
@@ -134,14 +144,14 @@ def get_all_system_info_english():
                             potential_ip.startswith('10.') or 
                             potential_ip.startswith('172.')):
                             ip_address = potential_ip
-                            print(f"DEBUG: Found IP (English): {ip_address}")
+                            logger.debug("Found IP (English): %s", ip_address)
                 
                 # Look for MAC address
                 if "Physical Address" in line:
                     mac_match = re.search(r'([0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}', line)
                     if mac_match:
                         mac_address = mac_match.group(0)
-                        print(f"DEBUG: Found MAC (English): {mac_address}")
+                        logger.debug("Found MAC (English): %s", mac_address)
             
             if ip_address and mac_address:
                 system_info_list.append({
@@ -150,10 +160,10 @@ def get_all_system_info_english():
                     'ip': ip_address,
                     'mac': mac_address
                 })
-                print(f"DEBUG: Added adapter (English) - IP: {ip_address}, MAC: {mac_address}")
+                logger.debug("Added adapter (English) - IP: %s, MAC: %s", ip_address, mac_address)
     
     except Exception as e:
-        print(f"DEBUG: Error in get_all_system_info_english: {e}")
+        logger.debug("Error in get_all_system_info_english: %s", e)
     
     return system_info_list
 
@@ -170,7 +180,7 @@ def get_all_system_info_alternative():
         local_ip = s.getsockname()[0]
         s.close()
         
-        print(f"DEBUG: Socket method found IP: {local_ip}")
+        logger.debug("Socket method found IP: %s", local_ip)
         
         # For MAC address, we still need to parse ipconfig
         ipconfig_output = os.popen("ipconfig /all").read()
@@ -201,7 +211,7 @@ def get_all_system_info_alternative():
             })
         
     except Exception as e:
-        print(f"DEBUG: Error in alternative method: {e}")
+        logger.debug("Error in alternative method: %s", e)
     
     return system_info_list
 
@@ -215,11 +225,11 @@ def get_broadcast_address(target_ip):
         for i, line in enumerate(lines):
             if target_ip in line and ("IPv4" in line or "IP 地址" in line):
                 ip_line_index = i
-                print(f"DEBUG: Found target IP line at index {i}: {line.strip()}")
+                logger.debug("Found target IP line at index %d: %s", i, line.strip())
                 break
         
         if ip_line_index == -1:
-            print(f"DEBUG: Could not find target IP {target_ip} in ipconfig output")
+            logger.debug("Could not find target IP %s in ipconfig output", target_ip)
             return None
         
         # Look for subnet mask in nearby lines (both English and Chinese)
@@ -230,27 +240,27 @@ def get_broadcast_address(target_ip):
                 # Extract the subnet mask
                 if ":" in line:
                     netmask = line.split(":")[1].strip()
-                    print(f"DEBUG: Found subnet mask: {netmask}")
+                    logger.debug("Found subnet mask: %s", netmask)
                     break
         
         if not netmask:
-            print("DEBUG: Could not find subnet mask, using default /24")
+            logger.debug("Could not find subnet mask, using default /24")
             # Default to /24 if we can't find the subnet mask
             netmask = "255.255.255.0"  
         
         # Calculate broadcast address
         ip_network = ipaddress.IPv4Network(f"{target_ip}/{netmask}", strict=False)
         broadcast_addr = str(ip_network.broadcast_address)
-        print(f"DEBUG: Calculated broadcast address: {broadcast_addr}")
+        logger.debug("Calculated broadcast address: %s", broadcast_addr)
         return broadcast_addr
         
     except Exception as e:
-        print(f"DEBUG: Error in get_broadcast_address: {e}")
+        logger.debug("Error in get_broadcast_address: %s", e)
         # Fallback: assume /24 network
         try:
             ip_parts = target_ip.split('.')
             broadcast_fallback = f"{ip_parts[0]}.{ip_parts[1]}.{ip_parts[2]}.255"
-            print(f"DEBUG: Using fallback broadcast address: {broadcast_fallback}")
+            logger.debug("Using fallback broadcast address: %s", broadcast_fallback)
             return broadcast_fallback
         except:
             return None
@@ -258,110 +268,235 @@ def get_broadcast_address(target_ip):
 def broadcast_message(message):
     target_ip = extract_ip(message)
     if not target_ip:
-        print("Error: No valid IP address found in message.")
+        logger.warning("No valid IP address found in message")
         return
 
     broadcast_ip = get_broadcast_address(target_ip)
     if not broadcast_ip:
-        print(f"Error: No matching interface found for IP {target_ip}.")
+        logger.warning("No matching interface found for IP %s", target_ip)
         return
 
-    port = 12345
+    port = discovery.BEACON_PORT
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
     try:
         sock.sendto(message.encode(), (broadcast_ip, port))
-        print(f"DEBUG: Broadcasted to {broadcast_ip}:{port}")
+        logger.debug("Broadcasted to %s:%d", broadcast_ip, port)
     except Exception as e:
-        print(f"Failed to broadcast message: {e}")
+        logger.warning("Failed to broadcast message: %s", e)
     finally:
         sock.close()
 
-def broadcast_system_info_once():
+def _enumerate_adapters():
+    """
+    Returns: system info dicts (name, model, ip, mac) of the LAN adapters, each
+    with the broadcast address of its subnet
+    """
+    if interfaces.HAVE_NATIVE:
+        pc_name = socket.gethostname()
+        model = platform.system()
+        return [{'name': pc_name, 'model': model, 'ip': adapter['ip'], 'mac': adapter['mac'],
+                 'broadcast': adapter['broadcast']} for adapter in interfaces.enumerate_native()]
+
+    system_info_list = get_all_system_info()
+
+    # Try English version if first one fails
+    if not system_info_list:
+        logger.debug("First method failed, trying English version...")
+        system_info_list = get_all_system_info_english()
+
+    # Try alternative method if both fail
+    if not system_info_list:
+        logger.debug("English method failed, trying alternative...")
+        system_info_list = get_all_system_info_alternative()
+
+    for system_info in system_info_list:
+        system_info['broadcast'] = get_broadcast_address(system_info['ip'])
+    return system_info_list
+
+_adapters = interfaces.InterfaceCache(_enumerate_adapters)
+_beacon = []   # (payload, (broadcast address, port)) for every adapter
+_goodbye = []  # The same, announcing that this device stops advertising
+_built_for = None  # (capabilities, free space) the beacon was built with
+
+# What the beacon advertises about the receiver, see discovery.CAPABILITIES
+_capabilities = {
+    'port': 54321,
+    'version': protocol.VERSION,
+    'codecs': compression.ALL_CODECS,
+    'features': 0,
+    'max_streams': parallel.MAX_STREAMS,
+}
+
+def advertise(**capabilities):
+    """Change what the beacon advertises, e.g. the port and features of the receiver now listening"""
+    global _capabilities
+    _capabilities = dict(_capabilities, **capabilities)
+
+def _free_space():
+    """Returns: bytes free where received files go by default"""
     try:
-        system_info_list = get_all_system_info()
-        
-        # Try English version if first one fails
-        if not system_info_list:
-            print("DEBUG: First method failed, trying English version...")
-            system_info_list = get_all_system_info_english()
-        
-        # Try alternative method if both fail
-        if not system_info_list:
-            print("DEBUG: English method failed, trying alternative...")
-            system_info_list = get_all_system_info_alternative()
-        
-        if not system_info_list:
+        return shutil.disk_usage(os.path.expanduser("~")).free
+    except OSError:
+        return 0
+
+def get_beacon():
+    """
+    The messages to broadcast, serialized once and rebuilt only when the adapters
+    (see interfaces.InterfaceCache) or the advertised capabilities changed, so a
+    new list means something changed.
+    Returns: list of (payload bytes, (broadcast address, port))
+    """
+    global _beacon, _goodbye, _built_for
+    adapters, changed = _adapters.get()
+    free = _free_space()
+    if _built_for and abs(free - _built_for[1]) < FREE_SPACE_STEP:
+        free = _built_for[1]
+    built_for = (_capabilities, free)
+    if changed or built_for != _built_for:
+        beacon = []
+        goodbye = []
+        for adapter in adapters:
+            if not adapter['broadcast']:
+                logger.warning("No matching interface found for IP %s", adapter['ip'])
+                continue
+            system_info = {key: adapter[key] for key in ('name', 'model', 'ip', 'mac')}
+            address = (adapter['broadcast'], discovery.BEACON_PORT)
+            # interval: the longest this device stays silent, so listeners know when it is gone
+            beacon.append((discovery.encode_beacon(dict(system_info, interval=discovery.BEACON_MAX,
+                                                        free_space=built_for[1], **built_for[0])), address))
+            goodbye.append((discovery.encode_beacon(system_info, bye=True), address))
+            if changed:
+                logger.debug("Broadcasting %s to %s:%d", adapter['ip'], adapter['broadcast'], discovery.BEACON_PORT)
+        _beacon = beacon
+        _goodbye = goodbye
+        _built_for = built_for
+    return _beacon
+
+def open_broadcast_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return sock
+
+def broadcast_system_info_once(sock=None):
+    """
+    Send the beacon of every LAN adapter once.
+    sock: broadcast socket to reuse (see open_broadcast_socket), a new one if None
+    Returns: False if there was nothing to broadcast
+    """
+    try:
+        beacon = get_beacon()
+        if not beacon:
             return False
-        
-        for system_info in system_info_list:
-            message = json.dumps(system_info, indent=4)
-            if not is_valid_json(message):
-                return False
-            broadcast_message(message)
-        
+
+        own_socket = sock is None
+        if own_socket:
+            sock = open_broadcast_socket()
+        try:
+            for payload, address in beacon:
+                try:
+                    sock.sendto(payload, address)
+                except OSError as e:
+                    logger.warning("Failed to broadcast message: %s", e)
+        finally:
+            if own_socket:
+                sock.close()
         return True
     except Exception as e:
-        print(f"DEBUG: Exception in broadcast_system_info_once: {e}")
+        logger.warning("Exception in broadcast_system_info_once: %s", e)
         return False
 
+class _ProbeResponder(asyncio.DatagramProtocol):
+    """Answers probes from scanners with this device's beacon, sent straight to the scanner"""
+
+    def __init__(self):
+        self.transport = None
+        self.limiter = discovery.ReplyLimiter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if discovery.is_probe(data) and self.limiter.allow(addr[0]):
+            asyncio.get_running_loop().call_later(discovery.reply_delay(), self._reply, addr[0])
+
+    def _reply(self, ip):
+        if self.transport.is_closing():
+            return
+        for payload, _ in _beacon:
+            self.transport.sendto(payload, (ip, discovery.BEACON_PORT))
+
+async def _open_responder():
+    """Returns: the transport answering probes on PROBE_PORT, or None if the port cannot be bound"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(('', discovery.PROBE_PORT))
+    except OSError as e:
+        sock.close()
+        logger.warning("Cannot answer probes on port %d: %s", discovery.PROBE_PORT, e)
+        return None
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(_ProbeResponder, sock=sock)
+    return transport
+
+async def broadcasting_loop():
+    """
+    Advertise this device until cancelled or there is nothing to broadcast:
+    beacons backing off from BEACON_MIN to BEACON_MAX while nothing changes,
+    answers to probes, and a goodbye when stopped (see discovery.py).
+    """
+    responder = await _open_responder()
+    schedule = discovery.BeaconSchedule()
+    previous = None
+    with open_broadcast_socket() as sock:
+        try:
+            while await asyncio.to_thread(broadcast_system_info_once, sock):
+                beacon = _beacon
+                await asyncio.sleep(schedule.next_interval(changed=beacon is not previous))
+                previous = beacon
+        finally:
+            if responder:
+                responder.close()
+            for payload, address in _goodbye:
+                try:
+                    sock.sendto(payload, address)
+                except OSError:
+                    pass
+
 def start_broadcasting_loop(stop_flag=None):
-    while not (stop_flag and stop_flag.is_set()):
-        success = broadcast_system_info_once()
-        if not success:
-            break
-        time.sleep(2)
+    try:
+        engine.run(broadcasting_loop(), stop_flag)
+    except asyncio.CancelledError:
+        pass
 
 def main():
+    log_sink.configure_logging()
     print("Starting the program...")
 
-    while True:
-        system_info_list = get_all_system_info()
-
-        # Try English version if first fails
-        if not system_info_list:
-            print("DEBUG: Primary method failed, trying English version...")
-            system_info_list = get_all_system_info_english()
-
-        # Try alternative method if both fail
-        if not system_info_list:
-            print("DEBUG: English method failed, trying alternative...")
-            system_info_list = get_all_system_info_alternative()
-
-        if not system_info_list:
-            print("No valid network adapters found.")
-            print("DEBUG: This might be due to:")
-            print("1. Different ipconfig output format")
-            print("2. No private IP addresses (192.168.x.x, 10.x.x.x, 172.x.x.x)")
-            print("3. Parsing issues")
-            
-            # Let's see what ipconfig actually returns
-            print("\nDEBUG: Raw ipconfig output (first 1000 chars):")
-            try:
-                output = os.popen("ipconfig /all").read()
-                print(repr(output[:1000]))
-            except Exception as e:
-                print(f"Error getting ipconfig: {e}")
-            
-            time.sleep(5)  # Wait before trying again instead of breaking
-            continue
-
-        json_invalid = False
-        for system_info in system_info_list:
-            message = json.dumps(system_info, indent=4)
-            if not is_valid_json(message):
-                json_invalid = True
-            else:
-                print(f"DEBUG: Broadcasting: {message}")
-            broadcast_message(message)
-        
-        if json_invalid:
-            print("Message format is not JSON. Exiting.")
-            break
-        
-        time.sleep(2)
+    with open_broadcast_socket() as sock:
+        while True:
+            if not broadcast_system_info_once(sock):
+                print("No valid network adapters found.")
+                if not interfaces.HAVE_NATIVE:
+                    print("DEBUG: This might be due to:")
+                    print("1. Different ipconfig output format")
+                    print("2. No private IP addresses (192.168.x.x, 10.x.x.x, 172.x.x.x)")
+                    print("3. Parsing issues")
+
+                    # Let's see what ipconfig actually returns
+                    print("\nDEBUG: Raw ipconfig output (first 1000 chars):")
+                    try:
+                        output = os.popen("ipconfig /all").read()
+                        print(repr(output[:1000]))
+                    except Exception as e:
+                        print(f"Error getting ipconfig: {e}")
+
+                time.sleep(5)  # Wait before trying again instead of breaking
+                continue
+
+            time.sleep(discovery.BEACON_MIN)  # Nothing answers probes here, so no backing off
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,19 @@
+import asyncio
+import logging
 import socket
-import json
 from collections import defaultdict
 from typing import Dict, List, Optional
+import threading
 import time
 
+from . import discovery, engine, interfaces
+from .device_registry import DeviceRegistry
+
+logger = logging.getLogger(__name__)
+
+EXPIRE_INTERVAL = 1.0  # 检查过期设备的间隔(秒)
+BIND_RETRY = 5.0  # 端口被占用时重试绑定的间隔(秒)
+
 def format_time_ago(ts):
     delta = time.time() - ts
     if delta < 60:
@@ -14,19 +24,15 @@ def format_time_ago(ts):
         return f"{int(delta // 3600)}h ago"
 
 def parse_message(data: bytes) -> Optional[dict]:
-    """解析 JSON 格式的广播消息
+    """解析广播消息，二进制格式或旧版本的 JSON 格式(见 discovery.decode_beacon)
     
     Args:
         data: 接收到的字节数据
         
     Returns:
-        解析后的字典(所有键转为小写)，如果解析失败则返回None
+        解析后的字典(JSON 的键转为小写，与其他消息共用，不要修改)，如果解析失败则返回None
     """
-    try:
-        info = json.loads(data.decode())  # 解析 JSON
-        return {k.lower(): v for k, v in info.items()}  # 统一键为小写
-    except json.JSONDecodeError:
-        return None
+    return discovery.decode_beacon(data)
 
 def format_system_info(models: Dict[str, List[dict]]) -> str:
     """格式化系统信息为字符串
@@ -45,6 +51,110 @@ def format_system_info(models: Dict[str, List[dict]]) -> str:
         output.append("")  # 空行分隔
     return "\n".join(output)
 
+class _BeaconProtocol(asyncio.DatagramProtocol):
+    """把收到的广播记入设备表"""
+
+    def __init__(self, registry: DeviceRegistry):
+        self.registry = registry
+
+    def datagram_received(self, data, addr):
+        info = parse_message(data)
+
+        # 如果解析成功，更新设备信息
+        if info:
+            required_fields = ['name', 'model', 'ip', 'mac']
+            if info.get('bye') and 'mac' in info:
+                self.registry.remove(info['mac'])  # 设备停止广播
+            elif all(field in info for field in required_fields):
+                self.registry.update(info)
+
+async def listen(registry: DeviceRegistry):
+    """在事件循环上持续监听设备广播，并清除超过 TTL 未出现的设备，取消即停止
+
+    Args:
+        registry: 要更新的设备表
+    """
+    loop = asyncio.get_running_loop()
+    bind_failed = False  # 端口一直被占用时只警告一次
+    while True:
+        # 创建 UDP socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # 探测请求从这个 socket 广播
+        try:
+            sock.bind(('', discovery.BEACON_PORT))  # 绑定广播端口
+        except OSError as e:
+            sock.close()
+            log = logger.debug if bind_failed else logger.warning
+            log("Cannot listen for devices on port %s: %s", discovery.BEACON_PORT, e)
+            bind_failed = True
+            await asyncio.sleep(BIND_RETRY)
+            continue
+
+        bind_failed = False
+        global _transport
+        transport, _ = await loop.create_datagram_endpoint(lambda: _BeaconProtocol(registry), sock=sock)
+        _transport = transport
+        _send_probe()  # 不必等下一次广播，已在线的设备会直接回复
+        try:
+            while True:
+                await asyncio.sleep(EXPIRE_INTERVAL)
+                registry.expire()
+        finally:
+            _transport = None
+            transport.close()
+
+_transport = None  # 监听 socket，也用来发送探测请求
+
+def _send_probe():
+    transport = _transport
+    if transport is None or transport.is_closing():
+        return
+    for address in interfaces.broadcast_addresses():
+        try:
+            transport.sendto(discovery.PROBE_MESSAGE, (address, discovery.PROBE_PORT))
+        except OSError as e:
+            logger.warning("Failed to send probe to %s: %s", address, e)
+
+def probe():
+    """广播一次探测请求，在线设备会在 PROBE_JITTER 秒内直接回复，结果进入设备表"""
+    get_registry()
+    engine.get_engine().loop.call_soon_threadsafe(_send_probe)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> DeviceRegistry:
+    """获取后台持续更新的设备表，首次调用时在事件循环上启动监听
+
+    Returns:
+        DeviceRegistry，可随时读取 snapshot() 或 subscribe() 设备变化
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DeviceRegistry()
+            engine.get_engine().submit(listen(_registry))
+        return _registry
+
+async def execute_async(timeout: float = None) -> Dict[str, dict]:
+    """等待 timeout 秒，返回这段时间内发过广播的设备，取消即停止
+
+    Args:
+        timeout: 监听超时时间(秒)，None表示监听到被取消为止
+
+    Returns:
+        以MAC为键的设备字典，包含name, model, ip, mac信息
+    """
+    registry = get_registry()
+    start_time = time.time()
+    if timeout is None:
+        await asyncio.Future()  # 一直监听，直到被取消
+    else:
+        await asyncio.sleep(timeout)
+
+    return {mac: dict(device) for mac, device in registry.snapshot().items() if device['last_seen'] >= start_time}
+
 def execute(timeout: float = None) -> Dict[str, dict]:
     """监听设备广播并返回发现的设备
     
@@ -54,42 +164,21 @@ def execute(timeout: float = None) -> Dict[str, dict]:
     Returns:
         以MAC为键的设备字典，包含name, model, ip, mac信息
     """
-    devices = {}  # 设备列表（MAC 作为唯一标识）
-    start_time = time.time()
+    return engine.run(execute_async(timeout))
 
-    # 创建 UDP socket
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('', 12345))  # 绑定广播端口
-        sock.setblocking(False)  # 设置非阻塞模式
-
-        while True:
-            # 检查超时
-            if timeout is not None and (time.time() - start_time) > timeout:
-                break
-
-            # 尝试接收数据
-            try:
-                data, addr = sock.recvfrom(1024)
-                info = parse_message(data)
-
-                # 如果解析成功，更新设备信息
-                if info:
-                    required_fields = ['name', 'model', 'ip', 'mac']
-                    if all(field in info for field in required_fields):
-                        mac = info['mac'].lower()
-                        devices[mac] = {
-                            'name': info['name'],
-                            'model': info['model'],
-                            'ip': info['ip'],
-                            'mac': mac,
-                            'last_seen': time.time() # 记录最后一次接收时间
-                        }
-            except BlockingIOError:
-                time.sleep(0.25)  # 没有数据时短暂等待
-                continue
-
-    return devices
+def group_by_model(devices) -> Dict[str, List[dict]]:
+    """按型号分类设备
+
+    Args:
+        devices: 设备字典的可迭代对象
+
+    Returns:
+        按型号分类的设备字典
+    """
+    models = defaultdict(list)
+    for device in devices:
+        models[device['model']].append(device)
+    return dict(models)
 
 def get_devices_by_model(timeout: float = None) -> Dict[str, List[dict]]:
     """获取按型号分类的设备列表
@@ -100,11 +189,7 @@ def get_devices_by_model(timeout: float = None) -> Dict[str, List[dict]]:
     Returns:
         按型号分类的设备字典
     """
-    devices = execute(timeout)
-    models = defaultdict(list)
-    for device in devices.values():
-        models[device['model']].append(device)
-    return dict(models)
+    return group_by_model(execute(timeout).values())
 
 def get_devices_formatted(timeout: float = None) -> str:
     """获取格式化后的设备信息字符串
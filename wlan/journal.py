@@ -0,0 +1,184 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from . import app_dirs
+
+JOURNAL_SUFFIX = ".qspart"
+CHECKPOINT_INTERVAL = 2.0  # Seconds between journal rewrites while data is arriving
+
+
+class RangeSet:
+    """Sorted, non-overlapping [start, end) byte ranges"""
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        """Add a range, merging it with its neighbours. Returns: number of bytes not covered before"""
+        if end <= start:
+            return 0
+        i = bisect.bisect_left(self._ends, start)
+        new_start, new_end = start, end
+        covered = 0
+        j = i
+        while j < len(self._starts) and self._starts[j] <= end:
+            covered += min(end, self._ends[j]) - max(start, self._starts[j])
+            new_start = min(new_start, self._starts[j])
+            new_end = max(new_end, self._ends[j])
+            j += 1
+        self._starts[i:j] = [new_start]
+        self._ends[i:j] = [new_end]
+        return (end - start) - covered
+
+    def remove(self, start, end):
+        """Take a range out, splitting a range it falls inside. Returns: number of bytes that were covered"""
+        if end <= start:
+            return 0
+        i = bisect.bisect_right(self._ends, start)
+        j = i
+        removed = 0
+        keep = []
+        while j < len(self._starts) and self._starts[j] < end:
+            removed += min(end, self._ends[j]) - max(start, self._starts[j])
+            if self._starts[j] < start:
+                keep.append((self._starts[j], start))
+            if self._ends[j] > end:
+                keep.append((end, self._ends[j]))
+            j += 1
+        self._starts[i:j] = [r[0] for r in keep]
+        self._ends[i:j] = [r[1] for r in keep]
+        return removed
+
+    def covers(self, start, end):
+        """Returns: True if all of [start, end) is in the set"""
+        i = bisect.bisect_right(self._starts, start) - 1
+        return i >= 0 and self._ends[i] >= end
+
+    def missing(self, size):
+        """Returns: list of (start, end) ranges of [0, size) that are not covered"""
+        gaps = []
+        pos = 0
+        for start, end in self:
+            if start > pos:
+                gaps.append((pos, min(start, size)))
+            pos = max(pos, end)
+        if pos < size:
+            gaps.append((pos, size))
+        return gaps
+
+    @property
+    def total(self):
+        return sum(end - start for start, end in self)
+
+    def __iter__(self):
+        return iter(list(zip(self._starts, self._ends)))
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class TransferJournal:
+    """
+    Sidecar file next to a partial download ("<file>.qspart") recording which byte
+    ranges are already on disk, so an interrupted transfer can pick up where it
+    stopped, even after either side restarts.
+    """
+
+    def __init__(self, save_path, file_key, size, ranges=()):
+        self.save_path = save_path
+        self.path = save_path + JOURNAL_SUFFIX
+        self.file_key = file_key
+        self.size = size
+        self.ranges = RangeSet(ranges)
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+        self._dirty = False
+
+    @classmethod
+    def load(cls, save_path, file_key, size):
+        """Returns: the journal of a partial copy of this exact file at save_path, or None"""
+        try:
+            with open(save_path + JOURNAL_SUFFIX, "r") as f:
+                data = json.load(f)
+            if data["file_key"] != file_key.hex() or data["size"] != size or not os.path.isfile(save_path):
+                return None
+            return cls(save_path, file_key, size, [tuple(r) for r in data["ranges"]])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def record(self, start, end):
+        """
+        Note that [start, end) was written.
+        Returns: True once CHECKPOINT_INTERVAL has passed since the last checkpoint(),
+        the caller then runs one (off the event loop, it waits for fsync)
+        """
+        with self._lock:
+            self.ranges.add(start, end)
+            self._dirty = True
+            return time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL
+
+    def forget(self, start, end):
+        """Note that [start, end) has to be received again, e.g. because it failed verification"""
+        with self._lock:
+            self.ranges.remove(start, end)
+            self._dirty = True
+
+    def checkpoint(self):
+        """Flush the file data to disk, then atomically replace the journal"""
+        with self._checkpoint_lock:
+            with self._lock:
+                if not self._dirty and os.path.exists(self.path):
+                    return
+                ranges = [list(r) for r in self.ranges]
+                self._dirty = False
+                self._last_checkpoint = time.monotonic()
+
+            # Ranges are only written to the journal once the data behind them is durable
+            with open(self.save_path, "r+b") as f:
+                os.fsync(f.fileno())
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"file_key": self.file_key.hex(), "size": self.size, "ranges": ranges}, f)
+            os.replace(tmp_path, self.path)
+
+    def discard(self):
+        """The file is complete, drop the journal"""
+        with self._checkpoint_lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _index_path(file_key):
+    return os.path.join(app_dirs.state_dir("resume"), file_key.hex() + ".json")
+
+
+def find_partial(file_key, size):
+    """Returns: journal of an earlier, unfinished receive of this file, or None"""
+    try:
+        with open(_index_path(file_key), "r") as f:
+            save_path = json.load(f)["path"]
+    except (OSError, ValueError, KeyError):
+        return None
+    return TransferJournal.load(save_path, file_key, size)
+
+
+def remember_partial(file_key, save_path):
+    """Remember where a resumable receive is being written"""
+    with open(_index_path(file_key), "w") as f:
+        json.dump({"path": os.path.abspath(save_path)}, f)
+
+
+def forget_partial(file_key):
+    try:
+        os.remove(_index_path(file_key))
+    except FileNotFoundError:
+        pass
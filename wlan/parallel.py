@@ -0,0 +1,108 @@
+import threading
+import time
+
+AUTO_STREAMS = "auto"
+MAX_STREAMS = 8
+SEGMENT_SIZE = 4 * 1024 * 1024       # Byte range handed to a stream at a time
+MIN_PARALLEL_SIZE = 2 * SEGMENT_SIZE  # Smaller files go over a single stream
+
+PROBE_INTERVAL = 1.0        # Seconds of throughput measured before deciding to add a stream
+MIN_GAIN = 0.10             # An extra stream must add at least 10% throughput to be kept growing
+RTT_PER_EXTRA_STREAM = 0.005  # Start with one more stream for every 5 ms of round trip
+MAX_INITIAL_STREAMS = 4
+
+
+class SegmentQueue:
+    """
+    Hands out (offset, length) byte ranges of a file to stream workers.
+    ranges: (start, end) spans still to send, the whole file by default
+    Ranges a worker fails to deliver are given back and sent again by another stream.
+    """
+
+    def __init__(self, filesize, segment_size=SEGMENT_SIZE, ranges=None):
+        self.filesize = filesize
+        self.segment_size = segment_size
+        self._ranges = list(ranges) if ranges is not None else [(0, filesize)]
+        self._index = 0
+        self._next_offset = self._ranges[0][0] if self._ranges else 0
+        self._returned = []
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Returns: (offset, length) or None when every range has been handed out"""
+        with self._lock:
+            if self._returned:
+                return self._returned.pop()
+            while self._index < len(self._ranges):
+                start, end = self._ranges[self._index]
+                offset = max(self._next_offset, start)
+                if offset < end:
+                    length = min(self.segment_size, end - offset)
+                    self._next_offset = offset + length
+                    return offset, length
+                self._index += 1
+            return None
+
+    def give_back(self, segment):
+        with self._lock:
+            self._returned.append(segment)
+
+    def empty(self):
+        with self._lock:
+            if self._returned:
+                return False
+            return all(max(self._next_offset, start) >= end for start, end in self._ranges[self._index:])
+
+
+class StreamTuner:
+    """
+    Picks the number of concurrent streams for a transfer.
+
+    The starting count comes from the connection RTT (long, lossy paths need more
+    streams to fill the pipe), then streams are added one at a time for as long as
+    each addition raises the measured aggregate throughput by at least MIN_GAIN.
+    Passing a fixed count disables tuning.
+    """
+
+    def __init__(self, rtt, max_streams=MAX_STREAMS, fixed=None):
+        self.rtt = rtt
+        self.max_streams = max(1, max_streams)
+        self.fixed = fixed
+        self.settled = fixed is not None
+        self._best = 0.0
+        self._last_bytes = 0
+        self._last_time = None
+
+    def initial_streams(self):
+        if self.fixed is not None:
+            return max(1, min(self.fixed, self.max_streams))
+        extra = int(self.rtt / RTT_PER_EXTRA_STREAM)
+        return max(1, min(1 + extra, MAX_INITIAL_STREAMS, self.max_streams))
+
+    def observe(self, total_bytes, active_streams, now=None):
+        """
+        Feed the running byte count, called roughly every PROBE_INTERVAL.
+        Returns: True if another stream should be started
+        """
+        now = time.monotonic() if now is None else now
+        if self._last_time is None:
+            self._last_time, self._last_bytes = now, total_bytes
+            return False
+
+        elapsed = now - self._last_time
+        if self.settled or elapsed <= 0:
+            return False
+
+        throughput = (total_bytes - self._last_bytes) / elapsed
+        self._last_time, self._last_bytes = now, total_bytes
+
+        if throughput < self._best * (1 + MIN_GAIN):
+            # The last stream did not pay for itself, stay at the current count
+            self.settled = True
+            return False
+
+        self._best = throughput
+        if active_streams >= self.max_streams:
+            self.settled = True
+            return False
+        return True
@@ -0,0 +1,371 @@
+import asyncio
+import struct
+
+# Every connection starts with MAGIC and the protocol version, so the receiver can
+# tell it apart from the legacy "filename\n" + raw bytes format.
+MAGIC = b"QSLV"
+VERSION = 1
+
+PREAMBLE = struct.Struct("!4sB")     # magic, version
+FRAME_HEADER = struct.Struct("!BI")  # frame type, payload length
+MAX_CONTROL_FRAME = 1024 * 1024      # Frames other than DATA are read into memory, so cap them
+
+# Frame types
+FRAME_OFFER = 1   # sender -> receiver: announces a file, first frame of a transfer
+FRAME_JOIN = 2    # sender -> receiver: first frame of an extra data stream
+FRAME_ACCEPT = 3  # receiver -> sender: ready to receive, with the negotiated parameters
+FRAME_REJECT = 4  # receiver -> sender: transfer declined, payload is the reason
+FRAME_DATA = 5    # sender -> receiver: file offset followed by raw file bytes
+FRAME_END = 6     # sender -> receiver: no more ranges on this stream
+FRAME_DONE = 7    # sender -> receiver: every stream of the transfer has finished
+FRAME_RESULT = 8  # receiver -> sender: outcome of the transfer
+FRAME_SIGNATURES = 9  # receiver -> sender: block checksums of the receiver's existing copy (delta)
+FRAME_COPY = 10       # sender -> receiver: copy a byte range of the existing copy into the new file (delta)
+FRAME_MANIFEST = 11   # sender -> receiver: lengths and content keys of the file's chunks, ended by END
+FRAME_HAVE = 12       # receiver -> sender: byte ranges filled from the receiver's chunk store
+FRAME_ZDATA = 13      # sender -> receiver: like DATA, but one compressed block
+FRAME_BATCH = 14      # sender -> receiver: announces several files sent back to back, first frame instead of OFFER
+FRAME_ENTRIES = 15    # sender -> receiver: part of the batch manifest, ended by END
+FRAME_FILE = 16       # sender -> receiver: the DATA frames that follow belong to this manifest entry
+FRAME_HASHES = 17     # sender -> receiver: leaf digests of the file (see integrity.py), on the announcing connection
+FRAME_REPAIR = 18     # receiver -> sender: byte ranges that failed verification, to be sent again and ended by END
+
+# Feature bitmap, the receiver accepts the subset it supports
+FEATURE_MULTISTREAM = 1 << 0
+FEATURE_RESUME = 1 << 1
+FEATURE_DELTA = 1 << 2  # Rebuild the file from the receiver's existing copy plus the changed bytes
+FEATURE_CHUNKS = 1 << 3  # Skip chunks the receiver already holds in its content-addressed store
+FEATURE_KEEPALIVE = 1 << 4  # After a successful transfer the connection stays open for the next one
+FEATURE_VERIFY = 1 << 5  # Every leaf of the file is checked against the sender's hash tree, bad ones are sent again
+
+# OFFER extension tags
+EXT_FILE_KEY = 1     # 16 byte identity of the source file version, lets a receiver find a partial copy
+EXT_LEAF_SIZE = 2    # Leaf size of the hash tree, with FEATURE_VERIFY
+
+# ACCEPT extension tags
+EXT_HAVE_RANGES = 1  # (start, end) byte ranges the receiver already holds
+EXT_MAX_STREAMS = 2  # Connections the sender may open for a multi-stream transfer
+
+# REJECT reason of a receiver that has no room for another transfer right now; the sender retries later
+BUSY_REASON = "Receiver is busy"
+
+CODEC_NONE = 0  # OFFER/ACCEPT carry a mask of common.compression codec bits
+
+HASH_NONE = 0
+HASH_SHA256 = 1
+HASH_BLAKE2B = 2
+HASH_NAMES = {HASH_SHA256: "sha256", HASH_BLAKE2B: "blake2b"}
+
+# Manifest entry kinds of a batch
+ENTRY_FILE = 0
+ENTRY_DIR = 1
+
+STATUS_FAILED = 0
+STATUS_OK = 1
+
+OFFER = struct.Struct("!16sQIBBIH")  # transfer id, size, chunk size, codec, hash, features, name length
+JOIN = struct.Struct("!16s")         # transfer id
+ACCEPT = struct.Struct("!IBB")       # features, codec, hash
+DATA = struct.Struct("!Q")           # offset
+ZDATA = struct.Struct("!QIB")        # offset, uncompressed length, codec, followed by the compressed block
+RESULT = struct.Struct("!B")         # status, followed by a message
+EXTENSION = struct.Struct("!BH")     # tag, length, followed by the value
+RANGE = struct.Struct("!QQ")         # start, end
+MAX_STREAMS = struct.Struct("!B")    # stream count
+SIGNATURES = struct.Struct("!IQ")    # block size, total block count, followed by SIGNATURE entries
+SIGNATURE = struct.Struct("!I16s")   # weak (Adler-32) and strong (BLAKE2b) checksum of one block
+COPY = struct.Struct("!QQQ")         # destination offset, source offset, length
+MANIFEST_ENTRY = struct.Struct("!I32s")  # chunk length, content key
+HAVE = struct.Struct("!Q")           # total range count, followed by RANGE entries
+BATCH = struct.Struct("!16sQIIBH")   # transfer id, total size, entry count, chunk size, codec, name length
+ENTRY = struct.Struct("!BQqH")       # kind, size, modification time (ns), path length, followed by the path
+FILE = struct.Struct("!I")           # manifest entry index
+LEAF_SIZE = struct.Struct("!I")      # bytes per leaf
+HASHES = struct.Struct("!Q")         # index of the first leaf, followed by its and the next leaves' digests
+
+
+async def read_exact(reader, size):
+    """Read exactly size bytes from an asyncio StreamReader, raising ConnectionError if the peer closes early"""
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError(f"Connection closed after {len(e.partial)} of {size} bytes") from None
+
+
+async def read_magic(reader):
+    """
+    Read the start of a connection, stopping as soon as it can no longer be MAGIC.
+    Returns: (True, b"") if it opened with MAGIC, else (False, the bytes read so far)
+    """
+    head = b""
+    while len(head) < len(MAGIC):
+        part = await reader.read(len(MAGIC) - len(head))
+        head += part
+        if not part or not MAGIC.startswith(head):
+            return False, head
+    return True, b""
+
+
+def encode_preamble():
+    return PREAMBLE.pack(MAGIC, VERSION)
+
+
+async def read_version(reader):
+    """Returns: the peer's protocol version, the byte that follows MAGIC"""
+    return (await read_exact(reader, PREAMBLE.size - len(MAGIC)))[0]
+
+
+def encode_frame(frame_type, payload=b""):
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+async def send_frame(writer, frame_type, payload=b""):
+    writer.write(encode_frame(frame_type, payload))
+    await writer.drain()
+
+
+async def read_frame_header(reader):
+    """Returns: (frame_type, payload_length)"""
+    return FRAME_HEADER.unpack(await read_exact(reader, FRAME_HEADER.size))
+
+
+async def read_frame(reader, *expected):
+    """
+    Read a whole control frame.
+    expected: frame types allowed here; a REJECT is turned into a ConnectionRefusedError
+    Returns: (frame_type, payload)
+    """
+    frame_type, length = await read_frame_header(reader)
+    if length > MAX_CONTROL_FRAME:
+        raise ValueError(f"Frame of {length} bytes is too large")
+    payload = await read_exact(reader, length)
+    if frame_type == FRAME_REJECT and FRAME_REJECT not in expected:
+        raise ConnectionRefusedError(payload.decode(errors="replace") or "Transfer rejected")
+    if expected and frame_type not in expected:
+        raise ValueError(f"Unexpected frame type {frame_type}")
+    return frame_type, payload
+
+
+def _encode_extensions(extensions):
+    return b"".join(EXTENSION.pack(tag, len(value)) + value for tag, value in extensions.items())
+
+
+def _decode_extensions(data):
+    extensions = {}
+    pos = 0
+    while pos < len(data):
+        tag, length = EXTENSION.unpack_from(data, pos)
+        pos += EXTENSION.size
+        extensions[tag] = data[pos:pos + length]
+        pos += length
+    return extensions
+
+
+def encode_offer(transfer_id, name, size, chunk_size, codec=CODEC_NONE, hash_algo=HASH_NONE,
+                 features=0, extensions=None):
+    """
+    OFFER payload. extensions: {tag: bytes} for optional fields, receivers skip
+    tags they do not know.
+    """
+    name = name.encode()
+    return (OFFER.pack(transfer_id, size, chunk_size, codec, hash_algo, features, len(name))
+            + name + _encode_extensions(extensions or {}))
+
+
+def decode_offer(payload):
+    """Returns: dict with transfer_id, name, size, chunk_size, codec, hash_algo, features, extensions"""
+    transfer_id, size, chunk_size, codec, hash_algo, features, name_len = OFFER.unpack_from(payload)
+    name_end = OFFER.size + name_len
+    return {
+        'transfer_id': transfer_id,
+        'name': payload[OFFER.size:name_end].decode(),
+        'size': size,
+        'chunk_size': chunk_size,
+        'codec': codec,
+        'hash_algo': hash_algo,
+        'features': features,
+        'extensions': _decode_extensions(payload[name_end:]),
+    }
+
+
+def encode_accept(features, codec=CODEC_NONE, hash_algo=HASH_NONE, extensions=None):
+    return ACCEPT.pack(features, codec, hash_algo) + _encode_extensions(extensions or {})
+
+
+def decode_accept(payload):
+    """Returns: dict with features, codec, hash_algo, extensions"""
+    features, codec, hash_algo = ACCEPT.unpack_from(payload)
+    return {
+        'features': features,
+        'codec': codec,
+        'hash_algo': hash_algo,
+        'extensions': _decode_extensions(payload[ACCEPT.size:]),
+    }
+
+
+def encode_ranges(ranges):
+    return b"".join(RANGE.pack(start, end) for start, end in ranges)
+
+
+def decode_ranges(data):
+    """Returns: list of (start, end)"""
+    return [RANGE.unpack_from(data, pos) for pos in range(0, len(data), RANGE.size)]
+
+
+def encode_max_streams(streams):
+    return MAX_STREAMS.pack(streams)
+
+
+def decode_max_streams(value):
+    return MAX_STREAMS.unpack(value)[0]
+
+
+def encode_join(transfer_id):
+    return JOIN.pack(transfer_id)
+
+
+def decode_join(payload):
+    return JOIN.unpack(payload)[0]
+
+
+def encode_data_header(offset, length):
+    """Frame header and offset of a DATA frame; the length raw bytes follow separately"""
+    return FRAME_HEADER.pack(FRAME_DATA, DATA.size + length) + DATA.pack(offset)
+
+
+async def read_data_offset(reader, payload_length):
+    """Read the offset of a DATA frame. Returns: (offset, number of raw bytes that follow)"""
+    if payload_length < DATA.size:
+        raise ValueError("Truncated DATA frame")
+    return DATA.unpack(await read_exact(reader, DATA.size))[0], payload_length - DATA.size
+
+
+def encode_signatures(block_size, block_count, signatures):
+    """signatures: (weak, strong) entries; a frame carries part of the block_count entries"""
+    return SIGNATURES.pack(block_size, block_count) + b"".join(SIGNATURE.pack(w, s) for w, s in signatures)
+
+
+def decode_signatures(payload):
+    """Returns: (block_size, block_count, list of (weak, strong))"""
+    block_size, block_count = SIGNATURES.unpack_from(payload)
+    entries = [SIGNATURE.unpack_from(payload, pos) for pos in range(SIGNATURES.size, len(payload), SIGNATURE.size)]
+    return block_size, block_count, entries
+
+
+def encode_copy(dst_offset, src_offset, length):
+    return COPY.pack(dst_offset, src_offset, length)
+
+
+def decode_copy(payload):
+    """Returns: (dst_offset, src_offset, length)"""
+    return COPY.unpack(payload)
+
+
+def encode_manifest(entries):
+    """entries: (length, key) of consecutive chunks"""
+    return b"".join(MANIFEST_ENTRY.pack(length, key) for length, key in entries)
+
+
+def decode_manifest(payload):
+    """Returns: list of (length, key)"""
+    return [MANIFEST_ENTRY.unpack_from(payload, pos) for pos in range(0, len(payload), MANIFEST_ENTRY.size)]
+
+
+def encode_have(range_count, ranges):
+    """ranges: part of the range_count (start, end) ranges; large sets span several frames"""
+    return HAVE.pack(range_count) + encode_ranges(ranges)
+
+
+def decode_have(payload):
+    """Returns: (total range count, list of (start, end))"""
+    return HAVE.unpack_from(payload)[0], decode_ranges(payload[HAVE.size:])
+
+
+def encode_zdata(offset, raw_length, codec, payload):
+    """A whole ZDATA frame carrying one compressed block"""
+    return (FRAME_HEADER.pack(FRAME_ZDATA, ZDATA.size + len(payload))
+            + ZDATA.pack(offset, raw_length, codec) + payload)
+
+
+async def read_zdata(reader, payload_length, max_block):
+    """Read the rest of a ZDATA frame. Returns: (offset, uncompressed length, codec, compressed block)"""
+    if not ZDATA.size <= payload_length <= ZDATA.size + max_block:
+        raise ValueError(f"ZDATA frame of {payload_length} bytes")
+    offset, raw_length, codec = ZDATA.unpack(await read_exact(reader, ZDATA.size))
+    return offset, raw_length, codec, await read_exact(reader, payload_length - ZDATA.size)
+
+
+def encode_batch(transfer_id, name, size, entry_count, chunk_size, codec=CODEC_NONE):
+    """BATCH payload. name: what the batch is called in the receiver's prompt (a folder name, or "3 files")"""
+    name = name.encode()
+    return BATCH.pack(transfer_id, size, entry_count, chunk_size, codec, len(name)) + name
+
+
+def decode_batch(payload):
+    """Returns: dict with transfer_id, name, size, entry_count, chunk_size, codec"""
+    transfer_id, size, entry_count, chunk_size, codec, name_len = BATCH.unpack_from(payload)
+    return {
+        'transfer_id': transfer_id,
+        'name': payload[BATCH.size:BATCH.size + name_len].decode(),
+        'size': size,
+        'entry_count': entry_count,
+        'chunk_size': chunk_size,
+        'codec': codec,
+    }
+
+
+def encode_entries(entries):
+    """entries: dicts with kind, size, mtime_ns and a "/"-separated relative path"""
+    parts = []
+    for entry in entries:
+        path = entry['path'].encode()
+        parts.append(ENTRY.pack(entry['kind'], entry['size'], entry['mtime_ns'], len(path)) + path)
+    return b"".join(parts)
+
+
+def decode_entries(payload):
+    """Returns: list of dicts with kind, size, mtime_ns, path"""
+    entries = []
+    pos = 0
+    while pos < len(payload):
+        kind, size, mtime_ns, path_len = ENTRY.unpack_from(payload, pos)
+        pos += ENTRY.size
+        entries.append({'kind': kind, 'size': size, 'mtime_ns': mtime_ns,
+                        'path': payload[pos:pos + path_len].decode()})
+        pos += path_len
+    return entries
+
+
+def encode_file(index):
+    return encode_frame(FRAME_FILE, FILE.pack(index))
+
+
+def decode_file(payload):
+    return FILE.unpack(payload)[0]
+
+
+def encode_leaf_size(leaf_size):
+    return LEAF_SIZE.pack(leaf_size)
+
+
+def decode_leaf_size(value):
+    return LEAF_SIZE.unpack(value)[0]
+
+
+def encode_hashes(first, digests):
+    return HASHES.pack(first) + b"".join(digests)
+
+
+def decode_hashes(payload, digest_size):
+    """Returns: (index of the first leaf, list of digests)"""
+    first = HASHES.unpack_from(payload)[0]
+    return first, [payload[pos:pos + digest_size] for pos in range(HASHES.size, len(payload), digest_size)]
+
+
+def encode_result(status, message=""):
+    return RESULT.pack(status) + message.encode()
+
+
+def decode_result(payload):
+    """Returns: (status, message)"""
+    return RESULT.unpack_from(payload)[0], payload[RESULT.size:].decode(errors="replace")
@@ -0,0 +1,242 @@
+import asyncio
+import mmap
+import os
+
+BUFFER_SIZE = 1024 * 1024          # Largest read from a connection, and the copy buffer when not using mmap
+MMAP_WINDOW = 16 * 1024 * 1024     # Bytes of the destination mapped at a time per stream
+OVERFLOW_SIZE = 64 * 1024          # Buffer for bytes past the range, which the StreamReader gets back
+USE_MMAP = True
+DIRECT_RECEIVE = True              # Receive ranges straight into the file (see _RangeProtocol)
+
+
+def preallocate(f, size):
+    """Reserve size bytes for the open file so it does not grow (and fragment) chunk by chunk"""
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # Filesystem without fallocate support
+    f.truncate(size)
+
+
+def _stream_internals(reader):
+    """
+    Returns: (transport, bytes buffered in the reader) of an asyncio StreamReader,
+    or None where they cannot be reached. asyncio has no public API for either;
+    both attributes have been there since StreamReader exists.
+    """
+    transport = getattr(reader, "_transport", None)
+    buffered = getattr(reader, "_buffer", None)
+    if transport is None or buffered is None or not hasattr(transport, "set_protocol"):
+        return None
+    if transport.is_closing() or getattr(reader, "_eof", True) or reader.exception() is not None:
+        return None
+    return transport, len(buffered)
+
+
+class _RangeProtocol(asyncio.BufferedProtocol):
+    """
+    Stands in for a connection's StreamReaderProtocol while one range is received,
+    so the event loop receives straight into the destination: get_buffer() returns
+    the mmap window (or the reused buffer) at the current offset, limited to the
+    end of the range. Once the range is complete the StreamReaderProtocol is put
+    back; anything the transport still delivers to this protocol goes to it too.
+    """
+
+    def __init__(self, target, transport, offset, end, on_bytes):
+        self.target = target
+        self.transport = transport
+        self.original = transport.get_protocol()
+        self.offset = offset
+        self.end = end
+        self.on_bytes = on_bytes
+        self.done = asyncio.get_running_loop().create_future()
+        self._overflow = None
+
+    def get_buffer(self, sizehint):
+        if self.offset < self.end:
+            return self.target._receive_buffer(self.offset, self.end)
+        if self._overflow is None:
+            self._overflow = bytearray(OVERFLOW_SIZE)
+        return self._overflow
+
+    def buffer_updated(self, nbytes):
+        if self.offset >= self.end:
+            self.original.data_received(bytes(self._overflow[:nbytes]))
+            return
+        self.target._received(self.offset, nbytes)
+        self.offset += nbytes
+        if self.on_bytes:
+            self.on_bytes(nbytes)
+        if self.offset >= self.end:
+            self._restore()
+            if not self.done.done():
+                self.done.set_result(None)
+
+    def _restore(self):
+        if self.transport.get_protocol() is self:
+            self.transport.set_protocol(self.original)
+
+    def _fail(self, exc):
+        self._restore()
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+    def eof_received(self):
+        self._fail(ConnectionError("Stream closed in the middle of a range"))
+        return self.original.eof_received()
+
+    def connection_lost(self, exc):
+        self._fail(ConnectionError("Stream closed in the middle of a range"))
+        self.original.connection_lost(exc)
+
+    # Write-side flow control still belongs to the StreamWriter's drain()
+    def pause_writing(self):
+        self.original.pause_writing()
+
+    def resume_writing(self):
+        self.original.resume_writing()
+
+
+class RangeWriter:
+    """
+    Writes byte ranges read from a connection into a preallocated file, or
+    copies them from another file for ranges that are already on disk.
+
+    Ranges are received straight into a window of the destination mapping,
+    or into one reused buffer that is written at the range offset where the
+    file cannot be mapped, so receiving allocates nothing per read. Memory use
+    is bounded by one window and buffer, whatever the file size.
+    """
+
+    def __init__(self, f, filesize, use_mmap=USE_MMAP):
+        self.f = f
+        self.filesize = filesize
+        self.use_mmap = use_mmap and filesize > 0
+        self._map = None
+        self._view = None
+        self._window_start = 0
+        self._buf = None
+
+    async def read_range(self, reader, offset, length, on_bytes=None):
+        """Write length bytes read from an asyncio StreamReader at offset"""
+        end = offset + length
+        internals = _stream_internals(reader) if DIRECT_RECEIVE else None
+        if internals is not None:
+            transport, buffered = internals
+            if buffered:
+                # What the reader already holds comes first: at most its buffer limit, once per range
+                data = await reader.readexactly(min(buffered, length))
+                self.write(offset, data)
+                offset += len(data)
+                if on_bytes:
+                    on_bytes(len(data))
+            if offset < end:
+                receiver = _RangeProtocol(self, transport, offset, end, on_bytes)
+                transport.set_protocol(receiver)
+                try:
+                    await receiver.done
+                finally:
+                    receiver._restore()
+            return
+
+        # Plain reads, where the reader's transport is out of reach
+        while offset < end:
+            data = await reader.read(min(BUFFER_SIZE, end - offset))
+            if not data:
+                raise ConnectionError("Stream closed in the middle of a range")
+            self.write(offset, data)
+            offset += len(data)
+            if on_bytes:
+                on_bytes(len(data))
+
+    def _receive_buffer(self, offset, end):
+        """Returns: writable view for the bytes at offset, within the range ending at end"""
+        if self.use_mmap and self._map_window(offset):
+            start = offset - self._window_start
+            return self._view[start:min(end - self._window_start, len(self._view))]
+        return self._buffer()[:min(BUFFER_SIZE, end - offset)]
+
+    def _received(self, offset, n):
+        """nbytes arrived in the view _receive_buffer(offset, ...) returned"""
+        if not self.use_mmap:
+            self._pwrite(offset, self._buf[:n])
+
+    def _map_window(self, offset):
+        """Make sure the window holding offset is mapped. Returns: False if mmap is unusable"""
+        window_start = offset - offset % MMAP_WINDOW
+        if self._map is not None and window_start == self._window_start:
+            return True
+
+        self._unmap()
+        try:
+            window_len = min(MMAP_WINDOW, self.filesize - window_start)
+            self._map = mmap.mmap(self.f.fileno(), window_len, offset=window_start)
+        except (OSError, ValueError):
+            # Mapping not possible here (e.g. filesystem limits), use the buffer instead
+            self.use_mmap = False
+            return False
+        self._view = memoryview(self._map)
+        self._window_start = window_start
+        return True
+
+    def write(self, offset, data):
+        """Write bytes that are already in memory (e.g. a decompressed block) at offset"""
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self.use_mmap and self._map_window(offset + pos):
+                start = offset + pos - self._window_start
+                n = min(len(view) - pos, len(self._view) - start)
+                self._view[start:start + n] = view[pos:pos + n]
+            else:
+                n = len(view) - pos
+                self._pwrite(offset + pos, view[pos:])
+            pos += n
+
+    def copy_from(self, src, src_offset, offset, length, on_bytes=None):
+        """Write length bytes read from the open file src at src_offset to offset"""
+        end = offset + length
+        src.seek(src_offset)
+        while offset < end:
+            if self.use_mmap and self._map_window(offset):
+                start = offset - self._window_start
+                n = src.readinto(self._view[start:min(end - self._window_start, len(self._view))])
+            else:
+                n = src.readinto(self._buffer()[:min(BUFFER_SIZE, end - offset)])
+                if n:
+                    self._pwrite(offset, self._buf[:n])
+            if not n:
+                raise EOFError(f"Source file ended at {src_offset + length - (end - offset)}")
+            offset += n
+            if on_bytes:
+                on_bytes(n)
+
+    def _buffer(self):
+        if self._buf is None:
+            self._buf = memoryview(bytearray(BUFFER_SIZE))
+        return self._buf
+
+    def _pwrite(self, offset, data):
+        if hasattr(os, "pwrite"):
+            written = 0
+            while written < len(data):
+                written += os.pwrite(self.f.fileno(), data[written:], offset + written)
+        else:
+            self.f.seek(offset)
+            self.f.write(data)
+
+    def _unmap(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        self._unmap()
+        self.f.flush()
@@ -0,0 +1,128 @@
+"""
+Connections to receivers that outlive one transfer.
+
+A receiver that agrees to FEATURE_KEEPALIVE leaves the announcing connection
+open after a successful transfer and waits for the next preamble on it. The
+sender parks such connections in a SessionPool, so the next send to the same
+receiver skips the TCP handshake and starts on a connection whose congestion
+window has already grown. Parked connections are closed after POOL_IDLE
+seconds, well before the receiver gives up on them (KEEPALIVE_TIMEOUT there).
+"""
+import asyncio
+import time
+
+POOL_IDLE = 20  # Seconds a parked connection is kept before it is closed
+POOL_PER_PEER = 4  # Parked connections per receiver, enough for a few sends at once
+CONNECT_TIMEOUT = 45  # Seconds to wait for a new connection
+
+
+class Session:
+    """A connection to one receiver, possibly reused from earlier transfers"""
+
+    def __init__(self, peer, reader, writer, rtt):
+        self.peer = peer  # (host, port)
+        self.reader = reader
+        self.writer = writer
+        self.rtt = rtt  # Seconds the TCP handshake took when the connection was opened
+        self.reused = False  # Came out of the pool rather than being opened for this transfer
+        self._evict = None  # Timer closing the connection while it is parked
+
+    def alive(self):
+        """Returns: False once either side has closed the connection"""
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class SessionPool:
+    """
+    Parked connections to recently used receivers, keyed by (host, port).
+    Used from the event loop only.
+    """
+
+    def __init__(self, idle_timeout=POOL_IDLE, per_peer=POOL_PER_PEER):
+        self.idle_timeout = idle_timeout
+        self.per_peer = per_peer
+        self._parked = {}  # (host, port) -> Sessions, most recently parked last
+        self.hits = 0  # Sends that reused a parked connection
+        self.misses = 0  # Sends that had to open a new one
+        self.stale = 0  # Parked connections found closed by the receiver
+        self.evictions = 0  # Parked connections closed for idling or to make room
+
+    async def acquire(self, host, port):
+        """Returns: a parked Session to host:port if one is still open, else a new one"""
+        peer = (host, port)
+        parked = self._parked.get(peer, [])
+        while parked:
+            session = parked.pop()
+            session._evict.cancel()
+            if session.alive():
+                self.hits += 1
+                session.reused = True
+                return session
+            self.stale += 1
+            session.close()
+        self.misses += 1
+        return await self._open(peer)
+
+    async def reconnect(self, session):
+        """Swap the connection of a reused session the receiver turned out to have dropped for a new one"""
+        session.close()
+        self.stale += 1
+        self.hits -= 1
+        self.misses += 1
+        fresh = await self._open(session.peer)
+        session.reader, session.writer, session.rtt = fresh.reader, fresh.writer, fresh.rtt
+        session.reused = False
+
+    def release(self, session):
+        """Park a session after a transfer the receiver agreed to keep the connection open for"""
+        if not session.alive():
+            return
+        parked = self._parked.setdefault(session.peer, [])
+        if len(parked) >= self.per_peer:
+            self._drop(parked[0])
+        session._evict = asyncio.get_running_loop().call_later(self.idle_timeout, self._drop, session)
+        parked.append(session)
+
+    def _drop(self, session):
+        parked = self._parked.get(session.peer, [])
+        if session in parked:
+            parked.remove(session)
+            session._evict.cancel()
+            session.close()
+            self.evictions += 1
+        if not parked:
+            self._parked.pop(session.peer, None)
+
+    def close_all(self):
+        """Close every parked connection"""
+        for parked in list(self._parked.values()):
+            for session in list(parked):
+                self._drop(session)
+
+    def stats(self):
+        """Returns: dict with hits, misses, stale, evictions, parked and hit_ratio"""
+        attempts = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'parked': sum(len(parked) for parked in self._parked.values()),
+            'hit_ratio': self.hits / attempts if attempts else 0.0,
+        }
+
+    async def _open(self, peer):
+        started = time.monotonic()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*peer), CONNECT_TIMEOUT)
+        return Session(peer, reader, writer, time.monotonic() - started)
+
+
+_pool = SessionPool()
+
+
+def get_pool():
+    """Returns: the pool shared by every send on the engine's event loop"""
+    return _pool
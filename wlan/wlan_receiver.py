@@ -1,17 +1,29 @@
+import asyncio
+import hashlib
+import logging
 import socket
 import threading
 import os
 import errno
-import time
 
-from . import ipBroadcast
+from common import compression
+from . import (batch, chunk_store, delta, engine, integrity, ipBroadcast, journal, parallel, protocol,
+               range_writer)
+from .journal import RangeSet
+
+logger = logging.getLogger(__name__)
+
+ACCEPT_BACKLOG = 128  # Connections the OS queues before the server accepts them
+STALL_TIMEOUT = 30  # Seconds without progress before a multi-stream transfer is abandoned
+IDLE_TIMEOUT = 30  # Seconds a connection may go without data before it is closed
+KEEPALIVE_TIMEOUT = 60  # Seconds a kept-alive connection may wait for its next transfer
 
 def run_broadcast():
-    print("[Broadcast] Starting broadcast loop...")
+    logger.debug("Starting broadcast loop")
     try:
         ipBroadcast.main()
     except Exception as e:
-        print(f"[Broadcast] Error: {e}")
+        logger.warning("Broadcast loop failed: %s", e)
 
 def find_available_port(start_port=54321, max_attempts=10):
     """Find an available port starting from start_port"""
@@ -26,178 +38,1121 @@ def find_available_port(start_port=54321, max_attempts=10):
             continue
     return None
 
-def receive_file_blocking(host='0.0.0.0', port=54321, gui_callback=None, log_callback=None, stop_flag=None):
+# Features this receiver can accept from an OFFER
+SUPPORTED_FEATURES = (protocol.FEATURE_MULTISTREAM | protocol.FEATURE_RESUME | protocol.FEATURE_DELTA
+                      | protocol.FEATURE_CHUNKS | protocol.FEATURE_KEEPALIVE | protocol.FEATURE_VERIFY)
+SUPPORTED_CODECS = compression.ALL_CODECS
+USE_CHUNK_STORE = True  # Keep received chunks so later transfers of the same data can skip them
+MAX_HAVE_RANGES = 4000  # Held ranges reported in an ACCEPT; anything past that is simply sent again
+SIGNATURE_BATCH = 32768  # Block signatures per SIGNATURES frame
+SIGNATURE_BATCH_BYTES = 64 * 1024 * 1024  # ...and at most this much of the old copy hashed per frame
+MAX_REPAIR_ROUNDS = 3  # Times the leaves that failed verification are asked for again
+MAX_REPAIR_RANGES = 4096  # More corrupt ranges than this and the transfer just fails
+
+# Limits of the receiver server, see ReceiverServer
+MEMORY_LIMIT = 256 * 1024 * 1024     # Receive memory for all connections together
+CONNECTION_MEMORY = 8 * 1024 * 1024  # Buffers and compressed blocks one connection may hold
+MAX_BLOCK = 2 * compression.BLOCK_SIZE  # Largest compressed block a connection reads into memory
+CONNECTION_WINDOW = max(1, CONNECTION_MEMORY // (2 * MAX_BLOCK) - 1)  # Blocks decompressing per connection
+MAX_WORKERS = 2 * (MEMORY_LIMIT // CONNECTION_MEMORY)  # Connections served at once, the rest wait their turn
+EXTRA_STREAM_SHARE = 0.25  # Part of the free budget one transfer may take for extra streams
+
+
+class IncomingTransfer:
     """
-    Receive file in blocking mode with callbacks for GUI integration
-    gui_callback: function(filename) -> save_path or None
-    log_callback: function(message)
-    stop_flag: threading.Event or similar object with is_set() method
-    Returns: True if successful, False otherwise
+    A file arriving as DATA frames over one or more connections.
+    The file is preallocated to its announced size and every stream writes
+    through its own handle at the frame offset. With a journal, completed ranges
+    are recorded next to the file so an interrupted transfer can be resumed.
+    basis_path: existing copy of the file for a delta transfer; the new version
+    is then assembled in a temporary file that replaces it once verified.
+    store: chunk store to fill chunks from, and to add the received ones to.
+    With a verifier (see verify_leaves) every leaf is checked as it completes.
+    Used from the event loop only.
     """
-    def log(msg):
-        if log_callback:
-            log_callback(msg)
+
+    def __init__(self, offer, save_path, journal=None, basis_path=None, store=None):
+        self.transfer_id = offer['transfer_id']
+        self.file_key = offer['extensions'].get(protocol.EXT_FILE_KEY)
+        self.filesize = offer['size']
+        self.chunk_size = offer['chunk_size']
+        self.save_path = save_path
+        self.journal = journal
+        self.basis_path = basis_path
+        self.part_path = save_path + delta.DELTA_SUFFIX if basis_path else save_path
+        known_hash = offer['hash_algo'] in protocol.HASH_NAMES
+        self.hash_algo = offer['hash_algo'] if basis_path and known_hash else protocol.HASH_NONE
+        self.bytes_reused = 0
+        self.codecs = offer['codec'] & SUPPORTED_CODECS  # Codecs the sender may use for ZDATA frames
+        self.decompressor = compression.Decompressor()
+        self.store = store
+        self.manifest = []             # (length, key) of every chunk, when the store is used
+        self.from_store = RangeSet()   # Ranges filled from the store rather than received
+        self.finished = asyncio.Event()
+        self.success = False
+        self._received = RangeSet(journal.ranges if journal else ())
+        self._bytes_completed = self._received.total
+        self._progress = asyncio.Event()
+        self._checkpoint = None  # Journal checkpoint running in a worker thread
+        self._connections = []
+        self.max_streams = 1  # Connections the sender may use, raised when extra streams are granted
+        self.keep_alive = False  # Leave the announcing connection open for the next transfer once done
+        self.verifier = None  # integrity.ChunkVerifier with FEATURE_VERIFY
+
+        mode = 'r+b' if self._bytes_completed and os.path.exists(self.part_path) else 'wb'
+        with open(self.part_path, mode) as f:
+            range_writer.preallocate(f, self.filesize)
+            if mode == 'r+b' and os.path.getsize(self.part_path) > self.filesize:
+                f.truncate(self.filesize)
+
+    @property
+    def have_ranges(self):
+        return list(self._received)
+
+    def attach(self, writer):
+        """
+        Track a connection of this transfer so abort() can cut it.
+        Returns: False if the transfer already has max_streams connections
+        """
+        if len(self._connections) >= self.max_streams:
+            return False
+        self._connections.append(writer)
+        return True
+
+    def abort(self):
+        """Close every connection of the transfer, e.g. when the sender reconnects to resume"""
+        for writer in self._connections:
+            writer.transport.abort()
+
+    def verify_leaves(self, leaf_size):
+        """Check every leaf against the sender's hash tree, including the ones already here"""
+        self.verifier = integrity.ChunkVerifier(self.part_path, self.filesize, leaf_size)
+        for start, end in self._received:
+            self.verifier.range_completed(start, end, self._received)
+
+    def forget_ranges(self, ranges):
+        """Count ranges that failed verification as not received, so they are sent again"""
+        for start, end in ranges:
+            self._bytes_completed -= self._received.remove(start, end)
+            if self.journal:
+                self.journal.forget(start, end)
+
+    def complete_range(self, offset, length):
+        self._bytes_completed += self._received.add(offset, offset + length)
+        if self.verifier:
+            self.verifier.range_completed(offset, offset + length, self._received)
+        self._progress.set()
+        if self.journal and self.journal.record(offset, offset + length):
+            if self._checkpoint is None or self._checkpoint.done():
+                self._checkpoint = asyncio.create_task(self._checkpoint_journal())
+
+    async def _checkpoint_journal(self):
+        try:
+            await asyncio.to_thread(self.journal.checkpoint)
+        except OSError:
+            pass  # Tried again when the transfer ends, which reports the error
+
+    async def wait_complete(self):
+        """Wait until every byte arrived; gives up after STALL_TIMEOUT without progress"""
+        while self._bytes_completed < self.filesize:
+            self._progress.clear()
+            try:
+                await asyncio.wait_for(self._progress.wait(), STALL_TIMEOUT)
+            except TimeoutError:
+                return False
+        return True
+
+    @property
+    def bytes_completed(self):
+        return self._bytes_completed
+
+    async def verify(self, digest):
+        """Returns: True if digest matches the assembled file, or no hash was negotiated"""
+        if self.hash_algo == protocol.HASH_NONE or not digest:
+            return True
+
+        def file_digest():
+            hasher = hashlib.new(protocol.HASH_NAMES[self.hash_algo])
+            with open(self.part_path, 'rb') as f:
+                while chunk := f.read(range_writer.BUFFER_SIZE):
+                    hasher.update(chunk)
+            return hasher.digest()
+
+        return await asyncio.to_thread(file_digest) == digest
+
+    def finish_delta(self, success):
+        """Move the assembled file over the old copy, or drop it if the transfer failed"""
+        if success:
+            os.replace(self.part_path, self.save_path)
         else:
-            print(f"[WLAN Receiver] {msg}")
-    
-    # Try to find an available port if the default is in use
-    original_port = port
-    available_port = find_available_port(port)
-    
-    if available_port is None:
-        log(f"Error: Cannot find an available port starting from {port}")
+            try:
+                os.remove(self.part_path)
+            except FileNotFoundError:
+                pass
+
+
+class IncomingBatch:
+    """
+    Files of a batch arriving back to back over the announcing connection,
+    written under root by a batch.BatchWriter.
+    """
+
+    def __init__(self, offer, root, entries):
+        self.transfer_id = offer['transfer_id']
+        self.file_key = None  # Batches are not resumed
+        self.name = offer['name']
+        self.filesize = offer['size']
+        self.chunk_size = offer['chunk_size']
+        self.codecs = offer['codec'] & SUPPORTED_CODECS
+        self.decompressor = compression.Decompressor()
+        self.writer = batch.BatchWriter(root, entries)
+        self.finished = asyncio.Event()
+        self.success = False
+        self.max_streams = 1
+        self.keep_alive = True
+        self._connections = []
+
+    def attach(self, writer):
+        if self._connections:
+            return False
+        self._connections.append(writer)
+        return True
+
+    def abort(self):
+        for writer in self._connections:
+            writer.transport.abort()
+
+
+async def _receive_batch_files(reader, transfer, idle):
+    """Write the FILE / DATA / ZDATA frames of a batch until its END frame"""
+    writer = transfer.writer
+    while True:
+        frame_type, payload_length = await protocol.read_frame_header(reader)
+        idle.touch()
+        if frame_type == protocol.FRAME_END:
+            return
+        if frame_type == protocol.FRAME_FILE and payload_length == protocol.FILE.size:
+            writer.start_file(protocol.decode_file(await protocol.read_exact(reader, payload_length)))
+        elif frame_type == protocol.FRAME_DATA:
+            offset, length = await protocol.read_data_offset(reader, payload_length)
+            if length > transfer.chunk_size:
+                raise ValueError(f"DATA frame of {length} bytes is larger than announced")
+            await writer.read_range(reader, offset, length, range_writer.BUFFER_SIZE)
+            if transfer.codecs:
+                transfer.decompressor.stats.record(compression.CODEC_NONE, length, length)
+        elif frame_type == protocol.FRAME_ZDATA:
+            offset, raw_length, codec, block = await protocol.read_zdata(reader, payload_length, MAX_BLOCK)
+            if codec not in compression.CODEC_NAMES or not codec & transfer.codecs:
+                raise ValueError(f"Block compressed with codec {codec}, which was not negotiated")
+            if raw_length > MAX_BLOCK:
+                raise ValueError(f"Compressed block of {raw_length} bytes is too large")
+            writer.check_range(offset, raw_length)
+            data = await asyncio.wrap_future(transfer.decompressor.submit(codec, block, raw_length))
+            writer.write(offset, data)
+        else:
+            raise ValueError(f"Unexpected frame type {frame_type} in a batch")
+
+
+async def _receive_batch(reader, writer, transfer, log, idle):
+    """Receive the files of a batch, then wait for the sender's DONE frame and report back"""
+    try:
+        await asyncio.to_thread(transfer.writer.create_directories)
+        await _receive_batch_files(reader, transfer, idle)
+        idle.pause()
+        await protocol.read_frame(reader, protocol.FRAME_DONE)
+        files = await asyncio.to_thread(transfer.writer.finish)
+        transfer.success = True
+        await protocol.send_frame(writer, protocol.FRAME_RESULT, protocol.encode_result(protocol.STATUS_OK))
+        log(f"Received {transfer.name}: {files} files, {transfer.writer.bytes_written} bytes "
+            f"in {transfer.writer.root}")
+        stats = transfer.decompressor.stats
+        if stats.wire_bytes < stats.raw_bytes:
+            log(f"Compressed transfer: {stats.summary()}")
+    except Exception as e:
+        log(f"Error during file transfer: {e}")
+        try:
+            await protocol.send_frame(writer, protocol.FRAME_RESULT,
+                                      protocol.encode_result(protocol.STATUS_FAILED, str(e)))
+        except OSError:
+            pass
+    finally:
+        transfer.writer.close()
+        if not (transfer.success and transfer.keep_alive):
+            writer.close()
+        transfer.finished.set()
+
+
+async def _receive_ranges(reader, transfer, idle):
+    """
+    Write DATA frames from reader into the transfer's file until an END frame.
+    COPY frames of a delta transfer are filled from the old copy instead, and
+    HASHES frames go to the transfer's verifier.
+    """
+    def on_bytes(n):
+        idle.touch()
+
+    with open(transfer.part_path, 'r+b') as f:
+        writer = range_writer.RangeWriter(f, transfer.filesize)
+        basis = open(transfer.basis_path, 'rb') if transfer.basis_path else None
+        window = compression.ReorderWindow(min(transfer.decompressor.window, CONNECTION_WINDOW))
+        try:
+            while True:
+                frame_type, payload_length = await protocol.read_frame_header(reader)
+                idle.touch()
+                if frame_type == protocol.FRAME_END:
+                    _write_blocks(writer, transfer, await window.drain_async())
+                    break
+                if frame_type == protocol.FRAME_COPY and basis:
+                    await _copy_range(writer, basis, transfer, await protocol.read_exact(reader, payload_length))
+                    continue
+                if frame_type == protocol.FRAME_HASHES and transfer.verifier:
+                    if payload_length > protocol.MAX_CONTROL_FRAME:
+                        raise ValueError(f"Frame of {payload_length} bytes is too large")
+                    transfer.verifier.add_leaves(*protocol.decode_hashes(
+                        await protocol.read_exact(reader, payload_length), integrity.DIGEST_SIZE))
+                    continue
+                if frame_type == protocol.FRAME_ZDATA:
+                    block = await _receive_compressed(reader, transfer, payload_length)
+                    _write_blocks(writer, transfer, await window.add_async(*block))
+                    continue
+                if frame_type != protocol.FRAME_DATA:
+                    raise ValueError(f"Unexpected frame type {frame_type} in a data stream")
+
+                offset, length = await protocol.read_data_offset(reader, payload_length)
+                if length > transfer.chunk_size or offset + length > transfer.filesize:
+                    raise ValueError(f"Range {offset}+{length} does not fit the announced file")
+
+                await writer.read_range(reader, offset, length, on_bytes)
+                transfer.complete_range(offset, length)
+                if transfer.codecs:
+                    transfer.decompressor.stats.record(compression.CODEC_NONE, length, length)
+        finally:
+            writer.close()
+            if basis:
+                basis.close()
+
+
+async def _receive_compressed(reader, transfer, payload_length):
+    """
+    Read a ZDATA frame, one compressed block of the file, and start decompressing it.
+    Returns: ((offset, length), Future of the block's bytes)
+    """
+    max_block = min(transfer.chunk_size, MAX_BLOCK)
+    offset, raw_length, codec, block = await protocol.read_zdata(reader, payload_length, max_block)
+    if codec not in compression.CODEC_NAMES or not codec & transfer.codecs:
+        raise ValueError(f"Block compressed with codec {codec}, which was not negotiated")
+    if raw_length > max_block or offset + raw_length > transfer.filesize:
+        raise ValueError(f"Range {offset}+{raw_length} does not fit the announced file")
+    return (offset, raw_length), transfer.decompressor.submit(codec, block, raw_length)
+
+
+def _write_blocks(writer, transfer, done):
+    """Write decompressed blocks handed back by the stream's ReorderWindow"""
+    for (offset, length), data in done:
+        writer.write(offset, data)
+        transfer.complete_range(offset, length)
+
+
+async def _copy_range(writer, basis, transfer, payload):
+    """Apply a COPY frame: a range of the new file that is unchanged from the old copy"""
+    dst_offset, src_offset, length = protocol.decode_copy(payload)
+    if dst_offset + length > transfer.filesize or src_offset + length > os.fstat(basis.fileno()).st_size:
+        raise ValueError(f"Copy {src_offset}+{length} -> {dst_offset} does not fit the files")
+    await asyncio.to_thread(writer.copy_from, basis, src_offset, dst_offset, length)
+    transfer.bytes_reused += length
+    transfer.complete_range(dst_offset, length)
+
+
+def _copy_stored_chunks(transfer):
+    """Copy every chunk of the manifest that the store holds into the file, noting them in from_store"""
+    held = RangeSet(transfer.have_ranges)
+    offset = 0
+    with open(transfer.part_path, 'r+b') as f:
+        for length, key in transfer.manifest:
+            end = offset + length
+            if not held.covers(offset, end):
+                data = transfer.store.read(key)
+                if data is not None and len(data) == length:
+                    f.seek(offset)
+                    f.write(data)
+                    transfer.from_store.add(offset, end)
+            offset = end
+
+
+async def _fill_from_store(reader, writer, transfer, log, idle):
+    """
+    Read the sender's chunk manifest, copy every chunk the store already holds
+    into the file and tell the sender which ranges it does not need to send
+    """
+    while True:
+        frame_type, payload = await protocol.read_frame(reader, protocol.FRAME_MANIFEST, protocol.FRAME_END)
+        idle.touch()
+        if frame_type == protocol.FRAME_END:
+            break
+        transfer.manifest.extend(protocol.decode_manifest(payload))
+    if sum(length for length, _ in transfer.manifest) != transfer.filesize:
+        raise ValueError("Chunk manifest does not add up to the announced size")
+
+    idle.pause()
+    await asyncio.to_thread(_copy_stored_chunks, transfer)
+    idle.touch()
+    for start, end in transfer.from_store:
+        transfer.complete_range(start, end - start)
+
+    ranges = list(transfer.from_store)
+    for i in range(0, max(len(ranges), 1), MAX_HAVE_RANGES):
+        await protocol.send_frame(writer, protocol.FRAME_HAVE,
+                                  protocol.encode_have(len(ranges), ranges[i:i + MAX_HAVE_RANGES]))
+    if ranges:
+        log(f"{transfer.from_store.total} bytes already in the chunk store, receiving the rest")
+
+
+def _store_new_chunks(transfer, log):
+    """
+    Add the chunks that came over the network to the store and report the hit ratio.
+    Runs in a worker thread.
+    """
+    store = transfer.store
+    hits = misses = bytes_avoided = bytes_received = 0
+    keep = transfer.filesize <= store.limit  # A bigger file would only evict itself
+    offset = 0
+    with open(transfer.save_path, 'rb') as f:
+        for length, key in transfer.manifest:
+            end = offset + length
+            if transfer.from_store.covers(offset, end):
+                hits += 1
+                bytes_avoided += length
+            else:
+                misses += 1
+                bytes_received += length
+                if keep:
+                    f.seek(offset)
+                    data = f.read(length)
+                    if chunk_store.chunk_key(data) == key:
+                        store.add(key, data)
+            offset = end
+    store.record_transfer(hits, bytes_avoided, misses, bytes_received)
+    log(f"Chunk store: {hits} of {hits + misses} chunks were already here, {bytes_avoided} bytes not received "
+        f"(hit ratio {store.hit_ratio:.0%} over {store.stats['hits'] + store.stats['misses']} chunks, "
+        f"{store.stats['bytes_avoided']} bytes avoided in total)")
+
+
+async def _send_signatures(writer, basis_path, block_size):
+    """
+    Send the block checksums of the old copy so the sender can work out what changed.
+    The old copy is hashed in a worker thread, one frame's worth at a time.
+    """
+    block_count = os.path.getsize(basis_path) // block_size
+    batch_size = max(1, min(SIGNATURE_BATCH, SIGNATURE_BATCH_BYTES // block_size))
+    pending = []
+    async for signature in engine.iterate_in_thread(delta.block_signatures(basis_path, block_size), batch_size):
+        pending.append(signature)
+        if len(pending) == batch_size:
+            await protocol.send_frame(writer, protocol.FRAME_SIGNATURES,
+                                      protocol.encode_signatures(block_size, block_count, pending))
+            pending = []
+    if pending or not block_count:
+        await protocol.send_frame(writer, protocol.FRAME_SIGNATURES,
+                                  protocol.encode_signatures(block_size, block_count, pending))
+
+
+async def _receive_data_stream(reader, writer, transfer, log, idle):
+    """Handle one extra data connection of a multi-stream transfer"""
+    try:
+        await _receive_ranges(reader, transfer, idle)
+    except Exception as e:
+        log(f"Data stream error: {e}")
+    finally:
+        writer.close()
+
+
+async def _check_transfer(transfer, digest):
+    """
+    Check a transfer once the sender reported it done.
+    digest: from the DONE frame, the whole-file digest or with a verifier the root of the hash tree
+    Returns: (why it failed or None, (start, end) ranges that failed verification and can be sent again)
+    """
+    if not await transfer.wait_complete():
+        return f"Transfer incomplete: {transfer.bytes_completed} of {transfer.filesize} bytes", []
+    verifier = transfer.verifier
+    if verifier is None:
+        if not await transfer.verify(digest):
+            return "Checksum mismatch, the file changed on one side during the transfer", []
+        return None, []
+    await verifier.settle()
+    problem = verifier.problem(digest)
+    if problem:
+        return problem, []
+    failed = verifier.take_failed()
+    if failed:
+        return "Verification failed", failed
+    return None, []
+
+
+async def _receive_control_stream(reader, writer, transfer, log, idle):
+    """
+    Receive the ranges sent over the announcing connection, then wait for the
+    sender's DONE frame, check every byte arrived and report back
+    """
+    try:
+        if transfer.basis_path:
+            await _send_signatures(writer, transfer.basis_path, delta.choose_block_size(transfer.filesize))
+        elif transfer.store is not None:
+            await _fill_from_store(reader, writer, transfer, log, idle)
+        await _receive_ranges(reader, transfer, idle)
+        for repair_round in range(MAX_REPAIR_ROUNDS + 1):
+            idle.pause()  # The other streams may still be finishing
+            _, digest = await protocol.read_frame(reader, protocol.FRAME_DONE)
+            message, failed = await _check_transfer(transfer, digest)
+            if not failed:
+                break
+            transfer.forget_ranges(failed)  # Also when giving up, so a resume does not trust them
+            if repair_round == MAX_REPAIR_ROUNDS or len(failed) > MAX_REPAIR_RANGES:
+                message = f"{len(failed)} range(s) still corrupt after {repair_round} repair(s)"
+                break
+            log(f"{sum(end - start for start, end in failed)} bytes failed verification, asking for them again")
+            await protocol.send_frame(writer, protocol.FRAME_REPAIR, protocol.encode_ranges(failed))
+            idle.touch()
+            await _receive_ranges(reader, transfer, idle)
+        if message is None:
+            if transfer.basis_path:
+                transfer.finish_delta(True)
+            transfer.success = True
+
+        if transfer.success:
+            await protocol.send_frame(writer, protocol.FRAME_RESULT, protocol.encode_result(protocol.STATUS_OK))
+            reused = f" ({transfer.bytes_reused} reused from the existing copy)" if transfer.basis_path else ""
+            verified = f", {transfer.verifier.verified} leaves verified" if transfer.verifier else ""
+            log(f"File received successfully. Total bytes: {transfer.filesize}{reused}{verified}")
+            stats = transfer.decompressor.stats
+            if stats.wire_bytes < stats.raw_bytes:
+                log(f"Compressed transfer: {stats.summary()}")
+            if transfer.store is not None:
+                try:
+                    await asyncio.to_thread(_store_new_chunks, transfer, log)
+                except OSError as e:
+                    log(f"Could not update the chunk store: {e}")
+        else:
+            await protocol.send_frame(writer, protocol.FRAME_RESULT,
+                                      protocol.encode_result(protocol.STATUS_FAILED, message))
+            log(message)
+    except Exception as e:
+        log(f"Error during file transfer: {e}")
+    finally:
+        if transfer.verifier:
+            transfer.verifier.cancel()
+        if not (transfer.success and transfer.keep_alive):
+            writer.close()
+        if transfer.basis_path and not transfer.success:
+            transfer.finish_delta(False)
+        if transfer.journal:
+            try:
+                if transfer.success:
+                    transfer.journal.discard()
+                    journal.forget_partial(transfer.file_key)
+                else:
+                    await asyncio.to_thread(transfer.journal.checkpoint)
+                    log(f"Kept {transfer.bytes_completed} bytes, the transfer can be resumed")
+            except OSError as e:
+                log(f"Could not update the resume journal: {e}")
+        transfer.finished.set()
+
+
+async def _drop_stale_transfer(transfers, file_key, log):
+    """A sender reconnecting to resume replaces its interrupted transfer that has not timed out yet"""
+    for other in list(transfers.values()):
+        if other.file_key == file_key and not other.finished.is_set():
+            log("Sender reconnected, closing the interrupted transfer")
+            other.abort()
+            try:
+                await asyncio.wait_for(other.finished.wait(), STALL_TIMEOUT)
+            except TimeoutError:
+                pass
+
+
+async def _start_transfer(reader, writer, offer, server, reserved, idle):
+    """
+    Ask where to save an offered file and accept it.
+    A file whose earlier transfer was interrupted goes back to the same place and
+    the ACCEPT lists the ranges already held, so only the rest is sent. When the
+    chosen path holds an older version, the transfer becomes a delta against it.
+    reserved: connections the server reserved for the transfer
+    Returns: the IncomingTransfer, or None if it was declined
+    """
+    log = server.log
+    extra_streams = 0
+    try:
+        log(f"Incoming file: {offer['name']} ({offer['size']} bytes)")
+        file_key = offer['extensions'].get(protocol.EXT_FILE_KEY)
+        resumable = bool(offer['features'] & protocol.FEATURE_RESUME) and file_key is not None
+
+        partial = None
+        basis_path = None
+        if resumable:
+            await _drop_stale_transfer(server.transfers, file_key, log)
+            partial = journal.find_partial(file_key, offer['size'])
+
+        if partial:
+            save_path = partial.save_path
+            log(f"Resuming into {save_path} ({partial.ranges.total} of {offer['size']} bytes already here)")
+        else:
+            idle.pause()
+            save_path = await server.ask_save_path(offer['name'])
+            idle.touch()
+            if not save_path:
+                log("File save cancelled")
+                await protocol.send_frame(writer, protocol.FRAME_REJECT, b"Cancelled by the receiver")
+                writer.close()
+                return None
+            log(f"Saving to {save_path}")
+            if offer['features'] & protocol.FEATURE_DELTA and os.path.isfile(save_path) \
+                    and os.path.getsize(save_path) >= delta.MIN_BLOCK_SIZE:
+                # Overwriting an older version: only the changed blocks need to come over
+                basis_path = save_path
+                log("An older copy is already there, receiving only the changes")
+            elif resumable:
+                partial = journal.TransferJournal(save_path, file_key, offer['size'])
+
+        store = None
+        if offer['features'] & protocol.FEATURE_CHUNKS and USE_CHUNK_STORE and not basis_path:
+            store = await asyncio.to_thread(chunk_store.default_store)  # The first call scans the store on disk
+        transfer = IncomingTransfer(offer, save_path, partial, basis_path, store)
+        transfer.attach(writer)
+        extensions = {}
+        if partial:
+            await asyncio.to_thread(partial.checkpoint)
+            journal.remember_partial(file_key, save_path)
+            extensions[protocol.EXT_HAVE_RANGES] = protocol.encode_ranges(transfer.have_ranges[:MAX_HAVE_RANGES])
+
+        features = offer['features'] & SUPPORTED_FEATURES
+        if basis_path:
+            # The delta is assembled over the announcing connection into a temporary file, checked by its digest
+            features &= ~(protocol.FEATURE_MULTISTREAM | protocol.FEATURE_RESUME | protocol.FEATURE_CHUNKS
+                          | protocol.FEATURE_VERIFY)
+        else:
+            features &= ~protocol.FEATURE_DELTA
+        if store is None:
+            features &= ~protocol.FEATURE_CHUNKS
+        leaf_size = offer['extensions'].get(protocol.EXT_LEAF_SIZE)
+        leaf_size = protocol.decode_leaf_size(leaf_size) if leaf_size else 0
+        if not integrity.MIN_LEAF_SIZE <= leaf_size <= integrity.MAX_LEAF_SIZE:
+            features &= ~protocol.FEATURE_VERIFY
+        if features & protocol.FEATURE_VERIFY:
+            transfer.verify_leaves(leaf_size)
+        if features & protocol.FEATURE_MULTISTREAM:
+            extra_streams = server.reserve_extra_streams(parallel.MAX_STREAMS - reserved)
+            transfer.max_streams = reserved + extra_streams
+            if transfer.max_streams == 1:
+                features &= ~protocol.FEATURE_MULTISTREAM
+            extensions[protocol.EXT_MAX_STREAMS] = protocol.encode_max_streams(transfer.max_streams)
+        transfer.keep_alive = bool(features & protocol.FEATURE_KEEPALIVE)
+        server.transfers[transfer.transfer_id] = transfer
+        accept = protocol.encode_accept(features, transfer.codecs, transfer.hash_algo, extensions)
+        await protocol.send_frame(writer, protocol.FRAME_ACCEPT, accept)
+        return transfer
+    except Exception as e:
+        log(f"Error starting file transfer: {e}")
+        server.budget.release(extra_streams)
+        writer.close()
+        return None
+
+
+async def _start_batch(reader, writer, offer, server, idle):
+    """
+    Read the manifest of an offered batch, ask for a destination directory and accept it.
+    Returns: the IncomingBatch, or None if it was declined
+    """
+    log = server.log
+    try:
+        entries = []
+        while True:
+            frame_type, payload = await protocol.read_frame(reader, protocol.FRAME_ENTRIES, protocol.FRAME_END)
+            if frame_type == protocol.FRAME_END:
+                break
+            entries.extend(protocol.decode_entries(payload))
+            if len(entries) > offer['entry_count']:
+                break
+        if len(entries) != offer['entry_count'] or sum(entry['size'] for entry in entries) != offer['size']:
+            raise ValueError("Batch manifest does not match its announcement")
+        for entry in entries:
+            batch.resolve_entry_path("", entry['path'])  # Refuse unsafe paths before asking the user
+        files = sum(1 for entry in entries if entry['kind'] == protocol.ENTRY_FILE)
+        log(f"Incoming batch: {offer['name']} ({files} files, {offer['size']} bytes)")
+
+        idle.pause()
+        root = await server.ask_save_dir(offer['name'], files, offer['size'])
+        idle.touch()
+        if not root:
+            log("File save cancelled")
+            await protocol.send_frame(writer, protocol.FRAME_REJECT, b"Cancelled by the receiver")
+            writer.close()
+            return None
+        log(f"Saving to {root}")
+        transfer = IncomingBatch(offer, root, entries)
+        transfer.attach(writer)
+        server.transfers[transfer.transfer_id] = transfer
+        # BATCH carries no feature bits; senders that do not keep the connection simply close it
+        await protocol.send_frame(writer, protocol.FRAME_ACCEPT,
+                                  protocol.encode_accept(protocol.FEATURE_KEEPALIVE, transfer.codecs))
+        return transfer
+    except Exception as e:
+        log(f"Error starting file transfer: {e}")
+        try:
+            await protocol.send_frame(writer, protocol.FRAME_REJECT, str(e).encode())
+        except OSError:
+            pass
+        writer.close()
+        return None
+
+
+async def _handle_framed_connection(reader, writer, addr, server, idle):
+    """
+    Serve a connection that opened with the protocol preamble, until its transfer or stream ends.
+    Returns: True if the connection stays open for the sender's next transfer
+    """
+    log = server.log
+    version = await protocol.read_version(reader)
+    if version != protocol.VERSION:
+        log(f"Rejecting sender with unsupported protocol version {version}")
+        await protocol.send_frame(writer, protocol.FRAME_REJECT, f"Unsupported protocol version {version}".encode())
+        writer.close()
         return False
-    
-    if available_port != original_port:
-        log(f"Port {original_port} is in use. Using port {available_port} instead.")
-        port = available_port
-    
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
+
+    frame_type, payload = await protocol.read_frame(reader, protocol.FRAME_OFFER, protocol.FRAME_JOIN,
+                                                    protocol.FRAME_BATCH)
+    if frame_type == protocol.FRAME_JOIN:
+        transfer = server.transfers.get(protocol.decode_join(payload))
+        if transfer is None or transfer.finished.is_set():
+            log("Data stream for an unknown transfer, closing it")
+            writer.close()
+        elif not transfer.attach(writer):
+            log(f"Sender opened more than the {transfer.max_streams} streams agreed on, closing one")
+            writer.close()
+        else:
+            await _receive_data_stream(reader, writer, transfer, log, idle)
+        return False
+
+    log(f"Connection established from {addr[0]}")
+    if not server.admit():
+        log(f"Receiver is busy, {addr[0]} will retry")
+        await protocol.send_frame(writer, protocol.FRAME_REJECT, protocol.BUSY_REASON.encode())
+        writer.close()
+        return False
+
+    transfer = None
+    try:
+        if frame_type == protocol.FRAME_BATCH:
+            transfer = await _start_batch(reader, writer, protocol.decode_batch(payload), server, idle)
+            if transfer:
+                await _receive_batch(reader, writer, transfer, log, idle)
+        else:
+            transfer = await _start_transfer(reader, writer, protocol.decode_offer(payload), server, 1, idle)
+            if transfer:
+                await _receive_control_stream(reader, writer, transfer, log, idle)
+    finally:
+        server.finish(transfer)
+    return transfer is not None and transfer.success and transfer.keep_alive
+
+
+async def _read_legacy_filename(reader, head):
+    """
+    Read the "filename\n" line of a legacy sender, whose first bytes are head.
+    Returns: (filename, file bytes that arrived in the same segment)
+    """
+    data = head
+    while b"\n" not in data:
+        chunk = await reader.read(1024)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > 4096:
+            break  # No newline in sight, not a filename line
+    filename, _, leftover = data.partition(b"\n")
+    return filename.decode().strip(), leftover
+
+
+async def _receive_legacy(reader, writer, addr, server, head, idle):
+    """
+    Receive from a sender that predates the frame protocol: a "filename\n" line,
+    then the raw file bytes until the connection closes.
+    head: bytes already read while looking for the protocol preamble
+    Returns: True if a file was received
+    """
+    log = server.log
+    log(f"Connection established from {addr[0]}")
+
     try:
+        # Legacy sender: receive the filename line
+        filename, leftover = await _read_legacy_filename(reader, head)
+        if not filename:
+            log("Failed to receive filename.")
+            return False
+
+        log(f"Incoming file: {filename}")
+
+        # Get save path
+        idle.pause()
+        save_path = await server.ask_save_path(filename)
+        idle.touch()
+        if not save_path:
+            log("File save cancelled")
+            return False
+
+        # Receive the file
+        retry_count = 0
+        max_retries = 3
+
+        while retry_count < max_retries:
+            try:
+                with open(save_path, 'wb') as f:
+                    log(f"Saving to {save_path}")
+                    f.write(leftover)
+                    bytes_received = len(leftover)
+
+                    while True:
+                        try:
+                            # Legacy senders do not announce a size, the file ends with the connection
+                            data = await reader.read(range_writer.BUFFER_SIZE)
+                            if not data:
+                                break
+                            idle.touch()
+                            f.write(data)
+                            bytes_received += len(data)
+                        except ConnectionResetError:
+                            log("Connection was reset by sender")
+                            break
+                        except Exception as recv_error:
+                            log(f"Error receiving data: {recv_error}")
+                            break
+
+                log(f"File received successfully. Total bytes: {bytes_received}")
+                return True
+
+            except PermissionError:
+                idle.pause()
+                if server.gui_callback:
+                    log(f"Permission denied for {save_path}")
+                    save_path = await server.ask_save_path(filename)
+                    if not save_path:
+                        break
+                else:
+                    log(f"Permission denied for {save_path}. Please choose a different path.")
+                    save_path = (await asyncio.to_thread(
+                        input, "Where should I save this file? (Enter full path): ")).strip()
+                    if os.path.isdir(save_path):
+                        save_path = os.path.join(save_path, filename)
+                idle.touch()
+            except Exception as e:
+                log(f"Error saving file (attempt {retry_count + 1}): {e}")
+                retry_count += 1
+                if retry_count < max_retries:
+                    log(f"Retrying... ({retry_count + 1}/{max_retries})")
+                    await asyncio.sleep(1)
+                else:
+                    log("Max retries reached. File transfer failed.")
+                    break
+
+    except Exception as e:
+        log(f"Error during file transfer: {e}")
+    finally:
+        writer.close()
+    return False
+
+
+def prompt_save_path(filename):
+    """CLI mode: ask for a directory and return the full save path"""
+    while True:
+        save_path = input("Where should I save this file? (Enter full path): ").strip()
+        if os.path.isdir(save_path):
+            return os.path.join(save_path, filename)
+        print(f"[WLAN Receiver] Invalid directory: {save_path}. Please enter a valid directory.")
+
+
+def prompt_save_dir(name, file_count, total_size):
+    """CLI mode: ask for the directory a batch of files is saved in"""
+    while True:
+        save_dir = input(f"Where should I save {name} ({file_count} files, {total_size} bytes)? "
+                         "(Enter a directory): ").strip()
+        if os.path.isdir(save_dir):
+            return save_dir
+        print(f"[WLAN Receiver] Invalid directory: {save_dir}. Please enter a valid directory.")
+
+
+class MemoryBudget:
+    """
+    Receive memory shared by every connection of a server, handed out in whole
+    connections of CONNECTION_MEMORY bytes each
+    """
+
+    def __init__(self, limit=MEMORY_LIMIT, per_connection=CONNECTION_MEMORY):
+        self.limit = limit
+        self.per_connection = per_connection
+        self.used = 0
+
+    @property
+    def free_connections(self):
+        return (self.limit - self.used) // self.per_connection
+
+    def reserve(self, connections, share=1.0):
+        """
+        Reserve memory for up to connections connections, taking at most share of what is free.
+        Returns: number of connections reserved, possibly 0
+        """
+        granted = max(0, min(connections, int(self.free_connections * share)))
+        self.used += granted * self.per_connection
+        return granted
+
+    def release(self, connections):
+        self.used -= connections * self.per_connection
+
+
+class ReceiverServer:
+    """
+    Long-lived Wi-Fi listener that serves many senders at the same time.
+
+    The socket is bound once with a deep accept backlog. Every connection is
+    served by its own coroutine on the event loop, at most workers at a time;
+    connections past that wait until one finishes. Transfers are admitted
+    against a MemoryBudget: each connection a transfer may use reserves
+    CONNECTION_MEMORY, a sender arriving when the budget is spent is told the
+    receiver is busy and retries, and extra streams are only granted from a
+    share of what is left, so one transfer cannot lock the others out. Save
+    prompts are shown one at a time, in a worker thread. A sender that asked
+    for FEATURE_KEEPALIVE may start its next transfer on the same connection.
+    """
+
+    def __init__(self, host='0.0.0.0', port=54321, gui_callback=None, log_callback=None, dir_callback=None,
+                 memory_limit=MEMORY_LIMIT, workers=MAX_WORKERS):
+        self.host = host
+        self.port = port
+        self.gui_callback = gui_callback
+        self.dir_callback = dir_callback
+        self.log_callback = log_callback
+        self.budget = MemoryBudget(memory_limit)
+        self.transfers = {}  # transfer id -> IncomingTransfer or IncomingBatch
+        self.completed = 0   # Transfers received successfully
+        self._workers = asyncio.Semaphore(workers)
+        self._prompt_lock = asyncio.Lock()
+        self._transfer_done = asyncio.Event()
+        self._connections = set()  # Tasks serving a connection
+        self._waiting = set()  # Writers of kept-alive connections waiting for their next transfer
+        self._server = None
+
+    def log(self, msg):
+        if self.log_callback:
+            self.log_callback(msg)
+        else:
+            print(f"[WLAN Receiver] {msg}")
+
+    async def ask_save_path(self, filename):
+        """Returns: where to save an incoming file, or None if the user cancelled"""
+        async with self._prompt_lock:
+            return await asyncio.to_thread(self.gui_callback or prompt_save_path, filename)
+
+    async def ask_save_dir(self, name, file_count, total_size):
+        """Returns: the directory to save an incoming batch in, or None if the user cancelled"""
+        async with self._prompt_lock:
+            if self.dir_callback:
+                return await asyncio.to_thread(self.dir_callback, name, file_count, total_size)
+            if self.gui_callback:
+                # Without a folder prompt the batch goes next to the path picked for its name
+                save_path = await asyncio.to_thread(self.gui_callback, name)
+                return os.path.dirname(save_path) if save_path else None
+            return await asyncio.to_thread(prompt_save_dir, name, file_count, total_size)
+
+    def admit(self):
+        """Reserve the first connection of a new transfer. Returns: False if the receiver is busy"""
+        return self.budget.reserve(1) == 1
+
+    def reserve_extra_streams(self, wanted):
+        """Returns: how many more streams a multi-stream transfer may open, from a share of the free budget"""
+        return self.budget.reserve(wanted, EXTRA_STREAM_SHARE)
+
+    def finish(self, transfer):
+        """Hand back the budget of a transfer that ended (or None if it was never accepted)"""
+        self.budget.release(transfer.max_streams if transfer else 1)
+        if transfer:
+            self.transfers.pop(transfer.transfer_id, None)
+            if transfer.success:
+                self.completed += 1
+                self._transfer_done.set()
+
+    async def start(self):
+        """Open the listening socket and start accepting. Returns: False if no port could be bound"""
+        log = self.log
+
+        # Try to find an available port if the default is in use
+        original_port = self.port
+        available_port = find_available_port(self.port)
+
+        if available_port is None:
+            log(f"Error: Cannot find an available port starting from {self.port}")
+            return False
+
+        if available_port != original_port:
+            log(f"Port {original_port} is in use. Using port {available_port} instead.")
+            self.port = available_port
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Additional socket options to handle various network conditions
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        
+
         try:
-            server_socket.bind((host, port))
+            server_socket.bind((self.host, self.port))
         except OSError as e:
-            if e.errno == errno.EACCES or e.winerror == 10013:
-                log(f"Permission denied when binding to port {port}. Try running as administrator or use a different port.")
+            server_socket.close()
+            if e.errno == errno.EACCES or getattr(e, 'winerror', None) == 10013:
+                log(f"Permission denied when binding to port {self.port}. Try running as administrator or use a different port.")
                 log("Common solutions:")
                 log("1. Run the application as Administrator")
                 log("2. Check if another application is using this port")
                 log("3. Configure Windows Firewall to allow this application")
                 log("4. Try a different port number")
-                return False
-            elif e.errno == errno.EADDRINUSE or e.winerror == 10048:
-                log(f"Port {port} is already in use by another application")
-                return False
+            elif e.errno == errno.EADDRINUSE or getattr(e, 'winerror', None) == 10048:
+                log(f"Port {self.port} is already in use by another application")
             else:
-                log(f"Failed to bind to {host}:{port} - Error: {e}")
-                return False
-        
-        server_socket.listen(1)
-        server_socket.settimeout(1)  # Allow checking stop_flag
-        
-        log(f"Listening for incoming file on {host}:{port}...")
+                log(f"Failed to bind to {self.host}:{self.port} - Error: {e}")
+            return False
 
-        while not (stop_flag and stop_flag.is_set()):
-            try:
-                conn, addr = server_socket.accept()
-                log(f"Connection established from {addr[0]}")
+        self._server = await asyncio.start_server(self._serve_connection, sock=server_socket,
+                                                  backlog=ACCEPT_BACKLOG, limit=range_writer.BUFFER_SIZE)
+        ipBroadcast.advertise(port=self.port, features=SUPPORTED_FEATURES, codecs=SUPPORTED_CODECS)
+        log(f"Listening for incoming files on {self.host}:{self.port}...")
+        return True
 
-                try:
-                    # Set a timeout for the connection
-                    conn.settimeout(30)
-                    
-                    # Receive the filename
-                    filename_data = conn.recv(1024)
-                    if not filename_data:
-                        log("Failed to receive filename.")
-                        conn.close()
-                        continue
-
-                    filename = filename_data.decode().strip()
-                    log(f"Incoming file: {filename}")
-                    
-                    # Get save path
-                    if gui_callback:
-                        save_path = gui_callback(filename)
-                        if not save_path:
-                            log("File save cancelled")
-                            conn.close()
-                            continue
-                    else:
-                        # CLI mode
-                        while True:
-                            save_path = input("Where should I save this file? (Enter full path): ").strip()
-                            if os.path.isdir(save_path):
-                                save_path = os.path.join(save_path, filename)
-                                break
-                            else:
-                                print(f"[WLAN Receiver] Invalid directory: {save_path}. Please enter a valid directory.")
-                                continue
-
-                    # Receive the file
-                    retry_count = 0
-                    max_retries = 3
-                    
-                    while retry_count < max_retries:
+    async def serve(self, until_first=False):
+        """
+        Serve connections until cancelled, or with until_first, until a transfer
+        was received successfully. Cancelling also cuts the transfers in progress;
+        after until_first they finish in the background.
+        Returns: True if a transfer was received successfully
+        """
+        completed = self.completed
+        try:
+            if until_first:
+                while self.completed == completed:
+                    self._transfer_done.clear()
+                    await self._transfer_done.wait()
+            else:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            raise
+        finally:
+            self.close()
+        return self.completed > completed
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        addr = writer.get_extra_info('peername')
+        keep_alive = False
+        try:
+            # Replies are small frames the sender waits for; without this they sit in
+            # Nagle's buffer until the sender's delayed ACK once the connection is warm
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            async with self._workers:
+                async with engine.IdleTimeout(IDLE_TIMEOUT) as idle:
+                    framed, head = await protocol.read_magic(reader)
+                    if framed:
+                        keep_alive = await _handle_framed_connection(reader, writer, addr, self, idle)
+                    elif self.admit():
+                        success = False
                         try:
-                            with open(save_path, 'wb') as f:
-                                log(f"Saving to {save_path}")
-                                bytes_received = 0
-                                
-                                while not (stop_flag and stop_flag.is_set()):
-                                    try:
-                                        data = conn.recv(4096)
-                                        if not data:
-                                            break
-                                        f.write(data)
-                                        bytes_received += len(data)
-                                    except socket.timeout:
-                                        # Check if we're still supposed to be running
-                                        if stop_flag and stop_flag.is_set():
-                                            break
-                                        continue
-                                    except ConnectionResetError:
-                                        log("Connection was reset by sender")
-                                        break
-                                    except Exception as recv_error:
-                                        log(f"Error receiving data: {recv_error}")
-                                        break
-                                        
-                            log(f"File received successfully. Total bytes: {bytes_received}")
-                            server_socket.close()
-                            return True
-                            
-                        except PermissionError:
-                            if gui_callback:
-                                log(f"Permission denied for {save_path}")
-                                save_path = gui_callback(filename)
-                                if not save_path:
-                                    break
-                            else:
-                                log(f"Permission denied for {save_path}. Please choose a different path.")
-                                save_path = input("Where should I save this file? (Enter full path): ").strip()
-                                if os.path.isdir(save_path):
-                                    save_path = os.path.join(save_path, filename)
-                        except Exception as e:
-                            log(f"Error saving file (attempt {retry_count + 1}): {e}")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                log(f"Retrying... ({retry_count + 1}/{max_retries})")
-                                time.sleep(1)
-                            else:
-                                log("Max retries reached. File transfer failed.")
-                                break
-                    
-                except socket.timeout:
-                    log("Connection timed out while receiving file")
-                except Exception as e:
-                    log(f"Error during file transfer: {e}")
+                            success = await _receive_legacy(reader, writer, addr, self, head, idle)
+                        finally:
+                            self.budget.release(1)
+                        if success:
+                            self.completed += 1
+                            self._transfer_done.set()
+                    else:
+                        self.log(f"Receiver is busy, closing the connection from {addr[0]}")
+
+            # The sender may send its next transfer over the same connection, which
+            # holds no worker while it waits
+            while keep_alive and self._server is not None:
+                self._waiting.add(writer)
+                try:
+                    async with asyncio.timeout(KEEPALIVE_TIMEOUT):
+                        framed, _ = await protocol.read_magic(reader)
+                except TimeoutError:
+                    break
                 finally:
-                    try:
-                        conn.close()
-                    except:
-                        pass
-                        
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if not (stop_flag and stop_flag.is_set()):
-                    log(f"Socket error: {e}")
-    
-    except Exception as e:
-        log(f"Fatal error in receiver: {e}")
-    finally:
-        try:
-            server_socket.close()
-        except:
-            pass
-    
-    return False
+                    self._waiting.discard(writer)
+                if not framed:
+                    break  # Closed by the sender, or by close()
+                async with self._workers:
+                    async with engine.IdleTimeout(IDLE_TIMEOUT) as idle:
+                        keep_alive = await _handle_framed_connection(reader, writer, addr, self, idle)
+        except TimeoutError:
+            self.log(f"No data from {addr[0]} for {IDLE_TIMEOUT} seconds, closing the connection")
+        except asyncio.CancelledError:
+            pass  # Server stopped; end quietly, asyncio.start_server reports anything a handler raises
+        except Exception as e:
+            self.log(f"Error reading transfer header: {e}")
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    def close(self):
+        """
+        Stop listening and close the connections kept open between transfers;
+        transfers in progress are served to the end
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in self._waiting:
+            writer.close()
+
+
+async def serve_async(host='0.0.0.0', port=54321, gui_callback=None, log_callback=None, dir_callback=None,
+                      until_first=False):
+    """
+    Receive files on the running event loop until cancelled, or with until_first
+    until one transfer succeeded. Callbacks as for receive_file_blocking; they
+    are called from worker threads.
+    Returns: False if the port could not be bound, else as ReceiverServer.serve
+    """
+    server = ReceiverServer(host, port, gui_callback, log_callback, dir_callback)
+    if not await server.start():
+        return False
+    return await server.serve(until_first)
+
+
+def receive_file_blocking(host='0.0.0.0', port=54321, gui_callback=None, log_callback=None, stop_flag=None,
+                          dir_callback=None):
+    """
+    Receive file in blocking mode with callbacks for GUI integration
+    gui_callback: function(filename) -> save_path or None
+    log_callback: function(message)
+    stop_flag: threading.Event or similar object with is_set() method
+    dir_callback: function(name, file_count, total_size) -> directory to save a batch
+                  of files in, or None; without it a batch goes next to the path
+                  gui_callback picks for its name
+    Returns: True if successful, False otherwise
+    """
+    try:
+        return engine.run(serve_async(host, port, gui_callback, log_callback, dir_callback, until_first=True),
+                          stop_flag)
+    except asyncio.CancelledError:
+        return False
+
+
+def serve_forever(host='0.0.0.0', port=54321, gui_callback=None, log_callback=None, stop_flag=None,
+                  dir_callback=None):
+    """
+    Receive files from any number of senders until stop_flag is set, on one
+    listening socket (see ReceiverServer). Callbacks as for receive_file_blocking.
+    Returns: False if the port could not be bound, True once stopped
+    """
+    try:
+        return engine.run(serve_async(host, port, gui_callback, log_callback, dir_callback), stop_flag)
+    except asyncio.CancelledError:
+        return True
 
 
 def receive_file(host='0.0.0.0', port=54321):
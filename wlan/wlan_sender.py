@@ -1,10 +1,21 @@
+import asyncio
+import hashlib
 import os
-import socket
-import time
 
+from common import compression
+from . import batch, chunk_store, delta, engine, hash_cache, integrity, parallel, protocol, session
+from .journal import RangeSet
 from .ipReceiver import get_devices_by_model, format_system_info
 
 PORT = 54321  # Arbitrary port for file transfer
+SENDFILE_SEGMENT = 8 * 1024 * 1024  # Bytes per sendfile call, also the progress granularity
+BUFFER_SIZE = 1024 * 1024  # Read size of the fallback loop where sendfile is unavailable
+HAVE_SENDFILE = hasattr(os, "sendfile")
+RETRY_DELAYS = (2, 5, 10)  # Seconds to wait before each resume attempt
+MANIFEST_BATCH = 1024  # Chunk entries per MANIFEST frame, sent as the file is chunked
+IDLE_TIMEOUT = 45  # Seconds a connection may go without progress before it is given up
+VERIFY_LEAVES = True  # Offer FEATURE_VERIFY, so the receiver checks every leaf and asks for bad ones again
+HASHES_PER_FRAME = 1024  # Leaf digests per HASHES frame
 
 def flatten_devices_by_index(models):
     """Flatten the devices into a numbered list with references"""
@@ -29,67 +40,803 @@ def select_device(devices):
         except ValueError:
             print("Please enter a valid number.")
 
-def send_file(ip, file_path, progress_callback=None, log_callback=None):
+async def send_range(writer, f, offset, count, on_bytes=None, use_sendfile=HAVE_SENDFILE):
+    """
+    Send count bytes of the open file f starting at offset over an asyncio StreamWriter.
+    Uses the kernel sendfile path where the OS has one, so file data never passes
+    through Python; otherwise falls back to reading BUFFER_SIZE blocks.
+    on_bytes: function(n) called after every SENDFILE_SEGMENT (or buffer) sent
+    """
+    end = offset + count
+    if use_sendfile:
+        loop = asyncio.get_running_loop()
+        await writer.drain()
+        while offset < end:
+            sent = await loop.sendfile(writer.transport, f, offset, min(SENDFILE_SEGMENT, end - offset))
+            if sent == 0:
+                raise EOFError(f"File shrank while sending (offset {offset})")
+            offset += sent
+            if on_bytes:
+                on_bytes(sent)
+        return
+
+    while offset < end:
+        data = await asyncio.to_thread(_read_at, f, offset, min(BUFFER_SIZE, end - offset))
+        if not data:
+            raise EOFError(f"File shrank while sending (offset {offset})")
+        writer.write(data)
+        await writer.drain()
+        offset += len(data)
+        if on_bytes:
+            on_bytes(len(data))
+
+
+def _read_at(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+def _read_block(f, offset, length, compressor):
+    """
+    Pick the codec for one block from samples of it and read it if it is worth
+    compressing. Blocking, runs in a worker thread.
+    Returns: (codec, data), data None for CODEC_NONE
+    """
+    sample = b"".join(_read_at(f, offset + sample_offset, size)
+                      for sample_offset, size in compression.sample_ranges(length))
+    codec = compressor.choose(sample)
+    if codec == compression.CODEC_NONE:
+        return codec, None
+    return codec, _read_at(f, offset, length)
+
+
+async def _send_data(writer, f, offset, length, on_bytes=None, compressor=None):
+    """
+    Send length bytes of f at offset as a DATA frame. With a compressor, blocks
+    that compress go as ZDATA frames instead, compressed in parallel and sent in
+    order; the rest still goes through sendfile.
+    """
+    if compressor is None:
+        writer.write(protocol.encode_data_header(offset, length))
+        await send_range(writer, f, offset, length, on_bytes)
+        return
+
+    plain = [offset, offset]  # [start, end) of the run of blocks sent as they are
+
+    async def emit(done):
+        for (block_offset, n), (codec, payload) in done:
+            if codec == compression.CODEC_NONE:
+                plain[1] = block_offset + n
+                continue
+            if plain[0] < plain[1]:
+                await _send_data(writer, f, plain[0], plain[1] - plain[0], on_bytes)
+            writer.write(protocol.encode_zdata(block_offset, n, codec, payload))
+            await writer.drain()
+            if on_bytes:
+                on_bytes(n)
+            plain[0] = plain[1] = block_offset + n
+
+    window = compression.ReorderWindow(compressor.window)
+    end = offset + length
+    while offset < end:
+        n = min(compressor.block_size, end - offset)
+        codec, data = await asyncio.to_thread(_read_block, f, offset, n, compressor)
+        if codec == compression.CODEC_NONE:
+            compressor.pass_through(n)
+            job = compression.completed((codec, None))
+        else:
+            job = compressor.submit(data, codec)
+        await emit(await window.add_async((offset, n), job))
+        offset += n
+    await emit(await window.drain_async())
+    if plain[0] < plain[1]:
+        await _send_data(writer, f, plain[0], plain[1] - plain[0], on_bytes)
+
+
+class _LeafHashes:
+    """
+    Leaf digests of the file (see integrity.py), computed in a worker thread
+    while the file is sent. The announcing connection passes them on in
+    HASHES frames between its segments.
+    """
+
+    def __init__(self, file_path, filesize, leaf_size=integrity.LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.leaves = []
+        self._sent = 0
+        self._task = asyncio.create_task(self._compute(file_path, filesize))
+
+    async def _compute(self, file_path, filesize):
+        async for digest in engine.iterate_in_thread(hash_cache.leaf_hashes(file_path, filesize, self.leaf_size)):
+            self.leaves.append(digest)
+
+    async def flush(self, writer, wait=False):
+        """Send the digests computed so far. wait: all of them, once hashing finished"""
+        if wait:
+            await self._task
+        while len(self.leaves) - self._sent >= (1 if wait else HASHES_PER_FRAME):
+            digests = self.leaves[self._sent:self._sent + HASHES_PER_FRAME]
+            await protocol.send_frame(writer, protocol.FRAME_HASHES, protocol.encode_hashes(self._sent, digests))
+            self._sent += len(digests)
+
+    def root(self):
+        return integrity.root_hash(self.leaves, self.leaf_size)
+
+    def cancel(self):
+        self._task.cancel()
+
+
+async def _send_segments(writer, f, segments, on_bytes, compressor=None, hashes=None):
+    """
+    Keep sending byte ranges taken from segments over writer until none are left
+    hashes: _LeafHashes to pass on between the ranges, on the announcing connection
+    """
+    while True:
+        if hashes:
+            await hashes.flush(writer)
+        segment = segments.take()
+        if segment is None:
+            break
+
+        offset, length = segment
+        sent = 0
+
+        def on_segment_bytes(n):
+            nonlocal sent
+            sent += n
+            on_bytes(n)
+
+        try:
+            await _send_data(writer, f, offset, length, on_segment_bytes, compressor)
+        except BaseException:
+            # Another stream sends this range again from the start
+            segments.give_back(segment)
+            on_bytes(-sent)
+            raise
+
+    if hashes:
+        await hashes.flush(writer, wait=True)
+    await protocol.send_frame(writer, protocol.FRAME_END)
+
+
+async def _connect(ip, port=PORT):
+    """Returns: (reader, writer) of a new connection to the receiver at ip"""
+    return await asyncio.wait_for(asyncio.open_connection(ip, port), IDLE_TIMEOUT)
+
+
+async def _send_data_stream(ip, transfer_id, file_path, segments, on_bytes, compressor=None, port=PORT):
+    """One extra data connection of a multi-stream transfer"""
+    _, writer = await _connect(ip, port)
+    try:
+        async with engine.IdleTimeout(IDLE_TIMEOUT) as idle:
+            def on_stream_bytes(n):
+                idle.touch()
+                on_bytes(n)
+
+            with open(file_path, "rb") as f:
+                writer.write(protocol.encode_preamble()
+                             + protocol.encode_frame(protocol.FRAME_JOIN, protocol.encode_join(transfer_id)))
+                await _send_segments(writer, f, segments, on_stream_bytes, compressor)
+    finally:
+        writer.close()
+
+
+def file_key(file_path):
+    """
+    Stable identity of this version of the file (name, size, modification time).
+    The receiver uses it to find a partial copy when a transfer is resumed,
+    also after either side restarted.
+    """
+    st = os.stat(file_path)
+    identity = f"{os.path.basename(file_path)}\0{st.st_size}\0{st.st_mtime_ns}".encode()
+    return hashlib.blake2b(identity, digest_size=16).digest()
+
+
+async def _read_signatures(reader):
+    """Returns: (block_size, table built from the receiver's SIGNATURES frames)"""
+    signatures = []
+    while True:
+        _, payload = await protocol.read_frame(reader, protocol.FRAME_SIGNATURES)
+        block_size, block_count, entries = protocol.decode_signatures(payload)
+        signatures.extend(entries)
+        if len(signatures) >= block_count:
+            return block_size, delta.build_table(signatures)
+
+
+async def _send_delta(reader, writer, f, file_path, filesize, hash_algo, on_bytes, log, compressor=None):
+    """
+    Send the file as COPY frames for blocks the receiver's older copy already has
+    and DATA frames for everything else. The file is scanned in a worker thread.
+    Returns: digest of the whole file for the DONE frame (empty if no hash was agreed)
+    """
+    block_size, table = await _read_signatures(reader)
+    hasher = hashlib.new(protocol.HASH_NAMES[hash_algo]) if hash_algo in protocol.HASH_NAMES else None
+    literal = reused = 0
+    ops = delta.coalesce(delta.compute_delta(file_path, filesize, block_size, table, hasher))
+    async for op in engine.iterate_in_thread(ops):
+        if op[0] == delta.OP_COPY:
+            _, offset, src_offset, length = op
+            await protocol.send_frame(writer, protocol.FRAME_COPY, protocol.encode_copy(offset, src_offset, length))
+            reused += length
+            on_bytes(length)
+            continue
+
+        _, offset, length = op
+        literal += length
+        end = offset + length
+        while offset < end:  # DATA frames stay within the announced chunk size
+            n = min(parallel.SEGMENT_SIZE, end - offset)
+            await _send_data(writer, f, offset, n, on_bytes, compressor)
+            offset += n
+    await protocol.send_frame(writer, protocol.FRAME_END)
+
+    saved = 100 * reused / filesize if filesize else 0
+    log(f"Sent {literal} changed bytes, reused {reused} bytes already on the receiver ({saved:.0f}% saved)")
+    return hasher.digest() if hasher else b""
+
+
+async def _exchange_manifest(reader, writer, file_path, idle):
+    """
+    Send the file's chunk manifest, chunking the file in a worker thread, then read
+    which ranges the receiver filled from its chunk store.
+    Returns: list of (start, end) ranges that need not be sent
+    """
+    pending = []
+    async for entry in engine.iterate_in_thread(hash_cache.chunk_file(file_path)):
+        pending.append(entry)
+        if len(pending) == MANIFEST_BATCH:
+            await protocol.send_frame(writer, protocol.FRAME_MANIFEST, protocol.encode_manifest(pending))
+            idle.touch()
+            pending = []
+    if pending:
+        await protocol.send_frame(writer, protocol.FRAME_MANIFEST, protocol.encode_manifest(pending))
+    await protocol.send_frame(writer, protocol.FRAME_END)
+
+    # The receiver reads its stored chunks before answering
+    idle.pause()
+    ranges = []
+    while True:
+        _, payload = await protocol.read_frame(reader, protocol.FRAME_HAVE)
+        range_count, part = protocol.decode_have(payload)
+        ranges.extend(part)
+        if len(ranges) >= range_count:
+            idle.touch()
+            return ranges
+
+
+def _log_compression(compressor, log):
+    if compressor and compressor.stats.raw_bytes:
+        log(f"Compressed transfer: {compressor.stats.summary()}")
+
+
+async def _finish_transfer(reader, writer, idle, digest=b"", repair=None):
+    """
+    Tell the receiver every range was sent and wait for its verdict
+    repair: coroutine function(ranges) sending ranges again that failed the receiver's verification
+    """
+    expected = (protocol.FRAME_RESULT, protocol.FRAME_REPAIR) if repair else (protocol.FRAME_RESULT,)
+    while True:
+        await protocol.send_frame(writer, protocol.FRAME_DONE, digest)
+        idle.pause()  # The receiver may still be checking the file
+        frame_type, payload = await protocol.read_frame(reader, *expected)
+        if frame_type == protocol.FRAME_RESULT:
+            break
+        idle.touch()
+        await repair(protocol.decode_ranges(payload))
+    status, message = protocol.decode_result(payload)
+    if status != protocol.STATUS_OK:
+        raise ConnectionError(f"Receiver reported a failed transfer: {message}")
+
+
+async def _read_accept(reader, log):
+    """
+    Wait for the receiver's answer to an OFFER or BATCH.
+    Returns: the decoded ACCEPT, or None if the receiver declined
+    Raises: ConnectionError if the receiver is busy, so the send is retried later
+    """
+    try:
+        _, payload = await protocol.read_frame(reader, protocol.FRAME_ACCEPT)
+    except ConnectionRefusedError as e:
+        if str(e) == protocol.BUSY_REASON:
+            raise ConnectionError(protocol.BUSY_REASON)
+        log(f"Transfer was cancelled by the receiver: {e}")
+        return None
+    return protocol.decode_accept(payload)
+
+
+async def _announce(pool, conn, announce, idle, log):
+    """
+    Send the opening frames of a transfer and wait for the receiver's answer.
+    A pooled connection the receiver closed in the meantime is replaced by a new one.
+    announce: coroutine function(writer) sending the preamble and the OFFER or BATCH
+    Returns: the decoded ACCEPT, or None if the receiver declined
+    """
+    while True:
+        try:
+            await announce(conn.writer)
+            idle.pause()  # The receiver may be waiting for the user to pick a save location
+            accepted = await _read_accept(conn.reader, log)
+        except ConnectionError as e:
+            if not conn.reused or str(e) == protocol.BUSY_REASON:
+                raise
+            log("The kept connection was closed by the receiver, reconnecting...")
+            await pool.reconnect(conn)
+            continue
+        idle.touch()
+        return accepted
+
+
+def _connected_message(conn):
+    return "Reusing the open connection." if conn.reused else "Connected."
+
+
+def _advertised(peer):
+    """
+    peer: the receiver's device from the registry, or None
+    Returns: peer if its beacon advertised a receiver (see discovery.CAPABILITIES), else None
+    """
+    return peer if peer and peer.get('port') else None
+
+
+def _check_free_space(peer, size, log):
+    if peer and peer['free_space'] and size > peer['free_space']:
+        log(f"The receiver reported only {peer['free_space'] / 1e6:.0f} MB free, the transfer may fail")
+
+
+async def _send_attempt(ip, file_path, progress_callback, log, streams, compress=True, peer=None):
+    """
+    One connection attempt of send_file_async.
+    Returns: True if successful, False if the receiver declined
+    Raises: ConnectionError or TimeoutError when the transfer broke off and is worth resuming
+    """
+    filesize = os.path.getsize(file_path)
+    filename = os.path.basename(file_path)
+    transfer_id = os.urandom(16)
+
+    if filesize < parallel.MIN_PARALLEL_SIZE:
+        streams = 1
+    peer = _advertised(peer)
+    port = peer['port'] if peer else PORT
+    if peer and (peer['max_streams'] <= 1 or not peer['features'] & protocol.FEATURE_MULTISTREAM):
+        streams = 1
+
+    log(f"Connecting to {ip}:{port}...")
+    pool = session.get_pool()
+    conn = await pool.acquire(ip, port)
+    keep_alive = False
+    hashes = None  # _LeafHashes with FEATURE_VERIFY
+    tasks = set()  # Streams of a multi-stream send
+    try:
+        async with engine.IdleTimeout(IDLE_TIMEOUT) as idle:
+            with open(file_path, "rb") as f:
+                log(f"{_connected_message(conn)} Sending metadata...")
+                features = protocol.FEATURE_RESUME | protocol.FEATURE_DELTA | protocol.FEATURE_KEEPALIVE
+                if streams != 1:
+                    features |= protocol.FEATURE_MULTISTREAM
+                if filesize >= chunk_store.MIN_CHUNKED_SIZE:
+                    features |= protocol.FEATURE_CHUNKS
+                extensions = {protocol.EXT_FILE_KEY: file_key(file_path)}
+                if VERIFY_LEAVES:
+                    features |= protocol.FEATURE_VERIFY
+                    extensions[protocol.EXT_LEAF_SIZE] = protocol.encode_leaf_size(integrity.LEAF_SIZE)
+                # Only the cheap codec keeps up with Wi-Fi, heavier ones would slow the transfer down
+                codecs = compression.CODEC_ZLIB if compress else protocol.CODEC_NONE
+                if peer:
+                    codecs &= peer['codecs']
+                _check_free_space(peer, filesize, log)
+                offer = protocol.encode_offer(transfer_id, filename, filesize, parallel.SEGMENT_SIZE, codecs,
+                                              hash_algo=protocol.HASH_BLAKE2B, features=features,
+                                              extensions=extensions)
+
+                async def announce(writer):
+                    writer.write(protocol.encode_preamble() + protocol.encode_frame(protocol.FRAME_OFFER, offer))
+
+                accepted = await _announce(pool, conn, announce, idle, log)
+                if accepted is None:
+                    return False
+                reader, writer, rtt = conn.reader, conn.writer, conn.rtt
+                compressor = None
+                if accepted['codec'] & codecs:
+                    compressor = compression.Compressor(accepted['codec'] & codecs, compression.PROFILE_FAST)
+
+                if accepted['features'] & protocol.FEATURE_DELTA:
+                    log("Receiver has an older copy, sending only the changes...")
+                    delta_sent = 0
+
+                    def on_delta_bytes(n):
+                        nonlocal delta_sent
+                        idle.touch()
+                        delta_sent += n
+                        if progress_callback:
+                            progress_callback(delta_sent, filesize)
+
+                    digest = await _send_delta(reader, writer, f, file_path, filesize, accepted['hash_algo'],
+                                               on_delta_bytes, log, compressor)
+                    await _finish_transfer(reader, writer, idle, digest)
+                    _log_compression(compressor, log)
+                    keep_alive = bool(accepted['features'] & protocol.FEATURE_KEEPALIVE)
+                    return True
+
+                if accepted['features'] & protocol.FEATURE_VERIFY:
+                    # Hashing overlaps the manifest exchange and the send; the receiver checks every leaf
+                    hashes = _LeafHashes(file_path, filesize)
+
+                    async def repair(ranges):
+                        log(f"Receiver found {sum(end - start for start, end in ranges)} corrupt bytes, "
+                            f"sending them again...")
+                        for start, end in ranges:
+                            while start < end:  # DATA frames stay within the announced chunk size
+                                n = min(parallel.SEGMENT_SIZE, end - start)
+                                await _send_data(writer, f, start, n)
+                                start += n
+                        await protocol.send_frame(writer, protocol.FRAME_END)
+
+                have = RangeSet(protocol.decode_ranges(accepted['extensions'].get(protocol.EXT_HAVE_RANGES, b"")))
+                if accepted['features'] & protocol.FEATURE_CHUNKS:
+                    log("Sending chunk manifest...")
+                    for start, end in await _exchange_manifest(reader, writer, file_path, idle):
+                        have.add(start, end)
+                if have.total:
+                    log(f"Receiver already has {have.total} of {filesize} bytes, sending the rest")
+
+                if not accepted['features'] & protocol.FEATURE_MULTISTREAM:
+                    streams = 1
+                fixed = None if streams == parallel.AUTO_STREAMS else int(streams)
+                max_streams = accepted['extensions'].get(protocol.EXT_MAX_STREAMS)
+                max_streams = protocol.decode_max_streams(max_streams) if max_streams else parallel.MAX_STREAMS
+                tuner = parallel.StreamTuner(rtt, max_streams=max_streams, fixed=fixed)
+                segments = parallel.SegmentQueue(filesize, ranges=have.missing(filesize))
+                state = {"bytes_sent": have.total, "failures": 0}
+
+                def on_bytes(n):
+                    idle.touch()
+                    state["bytes_sent"] += n
+                    if progress_callback:
+                        progress_callback(state["bytes_sent"], filesize)
+
+                def start_data_stream():
+                    tasks.add(asyncio.create_task(
+                        _send_data_stream(ip, transfer_id, file_path, segments, on_bytes, compressor, port)))
+
+                # The announcing connection is always the first stream
+                control_stream = asyncio.create_task(_send_segments(writer, f, segments, on_bytes, compressor,
+                                                                    hashes))
+                tasks.add(control_stream)
+                for _ in range(tuner.initial_streams() - 1):
+                    start_data_stream()
+                log(f"Sending file: {filename} ({filesize} bytes) over {len(tasks)} stream(s), "
+                    f"RTT {rtt * 1000:.1f} ms...")
+
+                loop = asyncio.get_running_loop()
+                tuner.observe(state["bytes_sent"], len(tasks))
+                next_probe = loop.time() + parallel.PROBE_INTERVAL
+                while True:
+                    done, _ = await asyncio.wait(tasks, timeout=max(0, next_probe - loop.time()),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        tasks.discard(task)
+                        if task.exception() is None:
+                            continue
+                        if task is control_stream:
+                            raise task.exception()
+                        state["failures"] += 1
+                        log(f"Stream error: {task.exception()}")
+                    if segments.empty() and not tasks:
+                        break
+                    if state["failures"] > parallel.MAX_STREAMS:
+                        raise ConnectionError("Too many stream failures")
+                    if not tasks:
+                        start_data_stream()  # Every stream finished or died with ranges left over
+                    elif loop.time() >= next_probe:
+                        next_probe += parallel.PROBE_INTERVAL
+                        if tuner.observe(state["bytes_sent"], len(tasks)):
+                            start_data_stream()
+                            log(f"Throughput still rising, now using {len(tasks)} streams")
+
+                if hashes:
+                    await _finish_transfer(reader, writer, idle, hashes.root(), repair)
+                else:
+                    await _finish_transfer(reader, writer, idle)
+                _log_compression(compressor, log)
+                keep_alive = bool(accepted['features'] & protocol.FEATURE_KEEPALIVE)
+        return True
+    finally:
+        if hashes:
+            hashes.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if keep_alive:
+            pool.release(conn)
+        else:
+            conn.close()
+
+
+async def send_file_async(ip, file_path, progress_callback=None, log_callback=None, streams=1,
+                          retries=len(RETRY_DELAYS), compress=True, peer=None):
     """
     Send a file to the selected IP over TCP
+    The file is announced in an OFFER frame, then sent as DATA frames that the
+    receiver writes at their offsets, over the announcing connection plus any
+    extra streams the receiver agreed to. If the connection breaks, the send is
+    retried and the receiver reports which ranges it already holds, so only the
+    missing ones are sent again. If the receiver already has an older version of
+    the file, only the changed blocks are sent (see delta.py), and chunks it holds
+    in its chunk store from earlier transfers are skipped (see chunk_store.py).
+    Runs on the caller's event loop; cancelling it stops the send.
     progress_callback: function(bytes_sent, total_size)
     log_callback: function(message)
-    Returns: True if successful, False otherwise
+    streams: number of parallel connections, or parallel.AUTO_STREAMS to tune it
+             from the measured RTT and throughput
+    retries: reconnect attempts after a broken transfer
+    compress: zlib-compress blocks that shrink, if the receiver supports it
+    peer: the receiver's device from ipReceiver's registry; the port, codecs and
+          streams its beacon advertised are used without asking it first
+    Returns: True if successful, None if the receiver declined, False otherwise
     """
     def log(msg):
         if log_callback:
             log_callback(msg)
         else:
             print(msg)
-    
+
+    attempt = 0
+    while True:
+        try:
+            if not await _send_attempt(ip, file_path, progress_callback, log, streams, compress, peer):
+                return None
+            log("File sent successfully.")
+            return True
+        except (ConnectionError, TimeoutError) as e:
+            if isinstance(e, TimeoutError):
+                log(f"No data sent for {IDLE_TIMEOUT} seconds. Closing connection.")
+            else:
+                log(f"Error sending file: {e}")
+            if attempt >= retries:
+                return False
+            delay = RETRY_DELAYS[min(attempt, len(RETRY_DELAYS) - 1)]
+            attempt += 1
+            log(f"Resuming in {delay} s (attempt {attempt} of {retries})...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            log(f"Error sending file: {e}")
+            return False
+
+
+def send_file(ip, file_path, progress_callback=None, log_callback=None, streams=1, retries=len(RETRY_DELAYS),
+              compress=True, stop_flag=None, peer=None):
+    """
+    send_file_async for code outside the event loop, run on the shared engine.
+    stop_flag: threading.Event or similar, cancels the send once set
+    Returns: True if successful, None if the receiver declined, False otherwise
+    """
     try:
-        filesize = os.path.getsize(file_path)
-        filename = os.path.basename(file_path)
+        return engine.run(send_file_async(ip, file_path, progress_callback, log_callback, streams, retries,
+                                          compress, peer), stop_flag)
+    except asyncio.CancelledError:
+        return False
 
-        log(f"Connecting to {ip}:{PORT}...")
-        with socket.create_connection((ip, PORT), timeout=45) as sock:
-            log("Connected. Sending metadata...")
-            sock.sendall(filename.encode() + b"\n")
 
-            with open(file_path, "rb") as f:
-                log(f"Sending file: {filename} ({filesize} bytes)...")
-                bytes_sent = 0
-                last_sent_time = time.time()
-                
-                while chunk := f.read(4096):
-                    try:
-                        sock.sendall(chunk)
-                        bytes_sent += len(chunk)
-                        last_sent_time = time.time()
-                        
-                        if progress_callback:
-                            progress_callback(bytes_sent, filesize)
-                            
-                    except socket.timeout:
-                        if time.time() - last_sent_time > 30:
-                            log("No data sent for 30 seconds. Closing connection.")
-                            return False
-                        else:
-                            log("Still sending data, hang tight...")
-                            continue
+def _pack_small_files(entries, compressor):
+    """
+    Read small files of a batch and frame them for sending, compressed where that
+    pays. Blocking, runs in a worker thread.
+    entries: list of (manifest index, entry)
+    Returns: bytearray of their FILE and DATA/ZDATA frames
+    """
+    packed = bytearray()
+    for index, entry in entries:
+        size = entry['size']
+        with open(entry['source'], "rb") as f:
+            data = f.read(size)
+        if len(data) != size:
+            raise EOFError(f"{entry['source']} shrank while sending")
+        packed += protocol.encode_file(index)
+        codec = compression.CODEC_NONE
+        if compressor and data:
+            codec, payload = compressor.compress(data, compressor.choose(compression.sample(data)))
+        if codec != compression.CODEC_NONE:
+            packed += protocol.encode_zdata(0, size, codec, payload)
+        elif data:
+            packed += protocol.encode_data_header(0, size) + data
+    return packed
+
+
+async def _send_batch_files(writer, entries, on_bytes, compressor=None):
+    """
+    Stream the files of a batch in manifest order. Small files are read and packed
+    with their frames in a worker thread, up to SEND_BUFFER bytes per write; larger
+    ones go through _send_data.
+    """
+    small = []  # (index, entry) of small files not sent yet
+    small_bytes = 0
+
+    async def flush():
+        nonlocal small, small_bytes
+        if small:
+            writer.write(await asyncio.to_thread(_pack_small_files, small, compressor))
+            await writer.drain()
+            if small_bytes:
+                on_bytes(small_bytes)
+            small, small_bytes = [], 0
 
-        log("File sent successfully.")
+    for index, entry in enumerate(entries):
+        if entry['kind'] != protocol.ENTRY_FILE:
+            continue
+        size = entry['size']
+        if size <= batch.SMALL_FILE:
+            small.append((index, entry))
+            small_bytes += size
+            if small_bytes >= batch.SEND_BUFFER:
+                await flush()
+            continue
+
+        await flush()
+        with open(entry['source'], "rb") as f:
+            writer.write(protocol.encode_file(index))
+            for offset in range(0, size, parallel.SEGMENT_SIZE):
+                await _send_data(writer, f, offset, min(parallel.SEGMENT_SIZE, size - offset), on_bytes, compressor)
+    await flush()
+    await protocol.send_frame(writer, protocol.FRAME_END)
+
+
+async def send_files_async(ip, paths, progress_callback=None, log_callback=None, compress=True, peer=None,
+                           retries=len(RETRY_DELAYS)):
+    """
+    Send several files and/or directories to the selected IP as one transfer:
+    a manifest of relative paths, sizes and modification times, then every file
+    back to back over the same connection (see batch.py). The receiver picks
+    one destination directory and recreates the directories under it.
+    Batches are not resumed, delta-encoded or split over several streams.
+    progress_callback: function(bytes_sent, total_size) over all files
+    log_callback: function(message)
+    compress: zlib-compress files and blocks that shrink, if the receiver supports it
+    peer: the receiver's device from ipReceiver's registry, see send_file_async
+    retries: reconnect attempts after a broken batch, which starts over
+    Returns: True if successful, None if the receiver declined, False otherwise
+    """
+    def log(msg):
+        if log_callback:
+            log_callback(msg)
+        else:
+            print(msg)
+
+    try:
+        entries = await asyncio.to_thread(batch.collect_entries, paths)
+    except (OSError, ValueError) as e:
+        log(f"Error sending files: {e}")
+        return False
+
+    attempt = 0
+    while True:
+        try:
+            if not await _send_batch_attempt(ip, entries, batch.batch_name(paths), progress_callback, log, compress,
+                                             peer):
+                return None
+            log("Files sent successfully.")
+            return True
+        except (ConnectionError, TimeoutError) as e:
+            if isinstance(e, TimeoutError):
+                log(f"No data sent for {IDLE_TIMEOUT} seconds. Closing connection.")
+            else:
+                log(f"Error sending files: {e}")
+            if attempt >= retries:
+                return False
+            delay = RETRY_DELAYS[min(attempt, len(RETRY_DELAYS) - 1)]
+            attempt += 1
+            log(f"Sending the files again in {delay} s (attempt {attempt} of {retries})...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            log(f"Error sending files: {e}")
+            return False
+
+
+async def _send_batch_attempt(ip, entries, name, progress_callback, log, compress=True, peer=None):
+    """
+    One connection attempt of send_files_async; a batch that broke off is sent again from the start.
+    Returns: True if successful, False if the receiver declined
+    """
+    files = sum(1 for entry in entries if entry['kind'] == protocol.ENTRY_FILE)
+    total = sum(entry['size'] for entry in entries)
+    peer = _advertised(peer)
+    port = peer['port'] if peer else PORT
+
+    log(f"Connecting to {ip}:{port}...")
+    pool = session.get_pool()
+    conn = await pool.acquire(ip, port)
+    keep_alive = False
+    try:
+        async with engine.IdleTimeout(IDLE_TIMEOUT) as idle:
+            log(f"{_connected_message(conn)} Sending the list of {files} files...")
+            codecs = compression.CODEC_ZLIB if compress else protocol.CODEC_NONE
+            if peer:
+                codecs &= peer['codecs']
+            _check_free_space(peer, total, log)
+            transfer_id = os.urandom(16)
+
+            async def announce(writer):
+                writer.write(protocol.encode_preamble() + protocol.encode_frame(
+                    protocol.FRAME_BATCH,
+                    protocol.encode_batch(transfer_id, name, total, len(entries), parallel.SEGMENT_SIZE, codecs)))
+                for i in range(0, len(entries), batch.ENTRIES_BATCH):
+                    await protocol.send_frame(writer, protocol.FRAME_ENTRIES,
+                                              protocol.encode_entries(entries[i:i + batch.ENTRIES_BATCH]))
+                await protocol.send_frame(writer, protocol.FRAME_END)
+
+            accepted = await _announce(pool, conn, announce, idle, log)
+            if accepted is None:
+                return False
+            reader, writer = conn.reader, conn.writer
+            compressor = None
+            if accepted['codec'] & codecs:
+                compressor = compression.Compressor(accepted['codec'] & codecs, compression.PROFILE_FAST)
+
+            log(f"Sending {name}: {files} files, {total} bytes...")
+            bytes_sent = 0
+
+            def on_bytes(n):
+                nonlocal bytes_sent
+                idle.touch()
+                bytes_sent += n
+                if progress_callback:
+                    progress_callback(bytes_sent, total)
+
+            await _send_batch_files(writer, entries, on_bytes, compressor)
+            await _finish_transfer(reader, writer, idle)
+            _log_compression(compressor, log)
+            # Receivers that keep the connection say so in the ACCEPT, batches carry no feature bits
+            keep_alive = bool(accepted['features'] & protocol.FEATURE_KEEPALIVE)
         return True
-    except Exception as e:
-        log(f"Error sending file: {e}")
+    finally:
+        if keep_alive:
+            pool.release(conn)
+        else:
+            conn.close()
+
+
+def send_files(ip, paths, progress_callback=None, log_callback=None, compress=True, stop_flag=None, peer=None,
+               retries=len(RETRY_DELAYS)):
+    """
+    send_files_async for code outside the event loop, run on the shared engine.
+    stop_flag: threading.Event or similar, cancels the send once set
+    Returns: True if successful, None if the receiver declined, False otherwise
+    """
+    try:
+        return engine.run(send_files_async(ip, paths, progress_callback, log_callback, compress, peer, retries),
+                          stop_flag)
+    except asyncio.CancelledError:
         return False
 
 
-def send_file_to_device(device_ip, file_path, progress_callback=None, log_callback=None):
+def send_file_to_device(device_ip, file_path, progress_callback=None, log_callback=None,
+                        streams=parallel.AUTO_STREAMS, peer=None, retries=len(RETRY_DELAYS)):
     """
     Wrapper function for UI - sends file to specific device IP
+    retries: resume attempts after a broken transfer, 0 where the caller retries itself
+    Returns: see send_file
     """
     if not os.path.isfile(file_path):
         if log_callback:
             log_callback("File not found")
         return False
-    
-    return send_file(device_ip, file_path, progress_callback, log_callback)
+
+    return send_file(device_ip, file_path, progress_callback, log_callback, streams, retries, peer=peer)
+
+
+def send_files_to_device(device_ip, paths, progress_callback=None, log_callback=None, peer=None,
+                         retries=len(RETRY_DELAYS)):
+    """
+    Wrapper function for UI - sends several files and/or folders to specific device IP
+    retries: attempts after a broken connection, 0 where the caller retries itself
+    Returns: see send_files
+    """
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        if log_callback:
+            log_callback(f"Not found: {missing[0]}")
+        return False
+
+    return send_files(device_ip, paths, progress_callback, log_callback, peer=peer, retries=retries)
 
 
 def get_available_devices(timeout=2):